@@ -1,27 +1,52 @@
 ﻿# ===============================
 # app_online_movil.py — Cámara + Código + AutoPrint + Subida a tu web (Render/PC)
 # ===============================
-import os, io, json, base64, hashlib, time, threading
+import os, io, sys, gzip, json, base64, functools, hashlib, hmac, logging, math, random, sqlite3, time, threading, uuid, shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
 from datetime import datetime, timedelta
 from typing import List
-from flask import Flask, request, jsonify, send_file, render_template_string, redirect, url_for, session
-from PIL import Image, ImageOps, ImageDraw, ImageFont
-from fpdf import FPDF
+from flask import Flask, Response, request, jsonify, send_file, redirect, url_for, session
+from PIL import Image, ImageColor, ImageOps, ImageDraw, ImageFont
 import requests, jwt
+try: import brotli                   # opcional: Content-Encoding br para páginas y CSS/JS
+except ImportError: brotli = None
+try: import tomllib                  # opcional (Python 3.11+): layouts en TOML además de JSON
+except ImportError: tomllib = None
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))   # postal_common.py, en la raíz del repo
+from postal_common import (CAPTURE_JS, CARD_IN, BudgetEncoder, Metrics, Profiler, Storage, card_page, file_code, iter_pdf,
+                           log_event, outbox_js, setup_logging, write_atomic, write_pdf)
 
 # ---------- Rutas y configuración ----------
 BASE = Path(__file__).resolve().parent
 DATA = Path(os.getenv("DATA_DIR", BASE.parent / "data"))
 UPL  = DATA / "uploads"
 PDFS = DATA / "pdfs"
-for d in (DATA, UPL, PDFS): d.mkdir(parents=True, exist_ok=True)
+CACHE = DATA / "cache"
+VARIANTS = DATA / "variants"    # tamaños reducidos para /local_img y /local_comp (?w=)
+for d in (DATA, UPL, PDFS, CACHE, VARIANTS): d.mkdir(parents=True, exist_ok=True)
 
 HOST = os.getenv("HOST","0.0.0.0")
 PORT = int(os.getenv("PORT","5000"))
 
-# Layout de impresión: square | fullbleed
+# Layout de impresión: square | fullbleed | <nombre> de un LAYOUTS_DIR/<nombre>.json|.toml (ver "Layouts")
 PRINT_LAYOUT = os.getenv("PRINT_LAYOUT","square").lower()
+PRINT_MARGIN = int(os.getenv("PRINT_MARGIN","120"))            # sólo square
+PRINT_ANCHOR = os.getenv("PRINT_ANCHOR","center").lower()       # sólo square: top | center | bottom
+LAYOUTS_DIR  = Path(os.getenv("LAYOUTS_DIR", DATA / "layouts"))  # layouts de evento, sin tocar código
+PRINT_QUALITY = 92
+
+# Derivados de cada subida (todos salen de una sola decodificación)
+REMOTE_MAX_PX = int(os.getenv("REMOTE_MAX_PX","2048"))          # lado mayor del JPG para tu web; 0 = original
+THUMB_W       = int(os.getenv("THUMB_W","480"))
+
+# Anchos servibles con ?w= en /local_img y /local_comp (se generan una vez y se guardan)
+VARIANT_WIDTHS = tuple(int(x) for x in os.getenv("VARIANT_WIDTHS","480,960,1600").split(","))
+
+# Caché de postales compuestas (tier en memoria, en MB, sobre el tier en disco DATA/cache)
+RENDER_CACHE_MB = int(os.getenv("RENDER_CACHE_MB","64"))
 
 # Auto-impresión
 AUTO_PRINT_MODE  = os.getenv("AUTO_PRINT_MODE","off").lower()   # email | sumatra | off
@@ -30,155 +55,1487 @@ SENDER_EMAIL     = os.getenv("SENDER_EMAIL","").strip()
 SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY","").strip()
 EMAIL_ENABLED    = bool(PRINTER_EMAIL and SENDER_EMAIL and SENDGRID_API_KEY)
 SUMATRA_PATH     = os.getenv("SUMATRA_PATH", r"C:\Program Files\SumatraPDF\SumatraPDF.exe")
+SENDGRID_HOST    = os.getenv("SENDGRID_HOST","https://api.sendgrid.com")   # p. ej. un doble HTTP local para pruebas
+
+# Cola de impresión (SQLite en DATA): un hilo por destino, reintentos con backoff
+PRINT_MAX_ATTEMPTS = int(os.getenv("PRINT_MAX_ATTEMPTS","5"))
+PRINT_BACKOFF      = float(os.getenv("PRINT_BACKOFF","5"))      # s; se duplica por intento (tope 300 s)
+PRINT_TIMEOUT      = int(os.getenv("PRINT_TIMEOUT","120"))      # s máx. de SumatraPDF por trabajo
+
+# Imposición: varias postales por hoja y un solo trabajo de impresión (1 = una postal por trabajo)
+IMPOSE_UP     = int(os.getenv("IMPOSE_UP","1"))              # 1 | 2 | 4
+IMPOSE_PAPER  = os.getenv("IMPOSE_PAPER","letter").lower()   # letter | a4
+IMPOSE_WINDOW = float(os.getenv("IMPOSE_WINDOW","20"))       # s máx. esperando a completar la hoja
+IMPOSE_MARGIN = float(os.getenv("IMPOSE_MARGIN","0.25"))     # pulgadas libres al borde (ahí van las marcas de corte)
 
 # Subida a tu web principal (Render grande)
 REMOTE_UPLOAD_URL   = os.getenv("REMOTE_UPLOAD_URL","").strip()      # ej: https://www.postcardporto.com/subir_postal
 REMOTE_UPLOAD_TOKEN = os.getenv("REMOTE_UPLOAD_TOKEN","").strip()    # = UPLOAD_TOKEN de tu web
 VIEW_BASE_URL       = os.getenv("VIEW_BASE_URL","").strip()          # ej: https://www.postcardporto.com/view_image
 
+# Outbox de subidas (SQLite en DATA): workers fijos, sesiones keep-alive y backoff con jitter
+OUTBOX_WORKERS      = int(os.getenv("OUTBOX_WORKERS","2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS","8"))
+OUTBOX_BACKOFF      = float(os.getenv("OUTBOX_BACKOFF","2"))       # s; se duplica por intento (tope 300 s)
+REMOTE_UPLOAD_BATCH = int(os.getenv("REMOTE_UPLOAD_BATCH","1"))    # >1 sólo si tu web acepta varias "imagen" por POST
+
+# Adjunto ePrint con presupuesto de bytes (0 = se adjunta el PDF de impresión tal cual)
+EPRINT_BUDGET_KB   = int(os.getenv("EPRINT_BUDGET_KB","0"))
+EPRINT_MIN_QUALITY = int(os.getenv("EPRINT_MIN_QUALITY","50"))    # suelo de calidad JPEG
+EPRINT_MIN_PX      = int(os.getenv("EPRINT_MIN_PX","1000"))       # suelo de resolución (lado mayor)
+EPRINT_COLOR       = os.getenv("EPRINT_COLOR","color").lower()    # color | gray (perfil de la impresora)
+
+# Almacenamiento: cuota de DATA y retención de originales (ver "Almacenamiento")
+# Desactivado por defecto: se activa con STORAGE_QUOTA_MB y/o STORAGE_MIN_FREE_MB.
+STORAGE_QUOTA_MB    = int(os.getenv("STORAGE_QUOTA_MB","0"))         # 0 = sin cuota
+STORAGE_MIN_FREE_MB = int(os.getenv("STORAGE_MIN_FREE_MB","0"))      # libre mínimo en el disco de DATA; 0 = no mirar
+STORAGE_LOW_PCT     = float(os.getenv("STORAGE_LOW_PCT","90"))       # al pasarse, se libera hasta este % (histéresis)
+STORAGE_SWEEP_SECS  = float(os.getenv("STORAGE_SWEEP_SECS","60"))
+STORAGE_MIN_AGE     = float(os.getenv("STORAGE_MIN_AGE","600"))      # s: lo usado hace menos no se desaloja
+STORAGE_BATCH       = int(os.getenv("STORAGE_BATCH","200"))          # archivos máx. por pasada
+STORAGE_IO_MB       = float(os.getenv("STORAGE_IO_MB","20"))         # MB/s máx. al archivar originales
+RETENTION_DAYS      = float(os.getenv("RETENTION_DAYS","0"))         # originales ya subidos a tu web; 0 = para siempre
+RETENTION_ARCHIVE   = os.getenv("RETENTION_ARCHIVE","").strip()      # dir de archivo (p. ej. disco externo); vacío = borrar
+
 # Tickets para subida web (browser)
 UPLOAD_JWT_SECRET = os.getenv("UPLOAD_JWT_SECRET","ul_secret_cambia_esto")
 
+# Render/impresión en segundo plano (procesos worker; 0 = en hilo, sin procesos)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+JOB_TTL        = int(os.getenv("JOB_TTL","3600"))       # segundos que se guarda el estado de un trabajo terminado
+
+# Límites de subida (se aplican mientras se recibe, sin cargar el archivo en memoria)
+MAX_UPLOAD_MB     = int(os.getenv("MAX_UPLOAD_MB","40"))
+MAX_UPLOAD_PIXELS = int(os.getenv("MAX_UPLOAD_PIXELS","60000000"))   # 60 MP
+UPLOAD_CHUNK      = 256 * 1024
+UPLOAD_FORMATS    = {"JPEG","MPO","PNG","WEBP"}   # formatos que se aceptan (según la cabecera, no la extensión)
+Image.MAX_IMAGE_PIXELS = MAX_UPLOAD_PIXELS         # Pillow rechaza bombas (>2×) al abrir; hasta 2× sólo avisa y
+                                                   # lo para la comprobación de píxeles de publish_upload
+
+# Admisión por memoria (coste = bytes RGB decodificados, estimado con la cabecera)
+RENDER_BACKLOG_MB = int(os.getenv("RENDER_BACKLOG_MB","2048"))  # renders admitidos sin terminar; si no cabe → 429
+DECODE_BUDGET_MB  = int(os.getenv("DECODE_BUDGET_MB","512"))    # decodificaciones simultáneas por proceso; el resto espera
+
+# Subidas reanudables desde /capturar (sesiones en UPL/.sessions)
+UPLOAD_SESSION_CHUNK = int(os.getenv("UPLOAD_SESSION_CHUNK", str(512*1024)))
+UPLOAD_SESSION_TTL   = int(os.getenv("UPLOAD_SESSION_TTL","86400"))   # s sin actividad → se borra
+
+# Decodificación rápida: DCT-scaling de libjpeg (draft) + reduce() entero antes del LANCZOS final
+FAST_DECODE = os.getenv("FAST_DECODE","1") != "0"
+
+# Perfil de captura (/capture_profile): /capturar recorta y escala a esto en el navegador antes de subir
+CAPTURE_BPP         = float(os.getenv("CAPTURE_BPP","3"))          # presupuesto del JPG en bits por píxel
+CAPTURE_QUALITY     = float(os.getenv("CAPTURE_QUALITY","0.92"))   # calidad inicial; baja hasta caber
+CAPTURE_MIN_QUALITY = float(os.getenv("CAPTURE_MIN_QUALITY","0.7"))
+
 # Lienzo 7×5.5" @ 300dpi
 W,H = 2100,1650
+PREVIEW_STEP = 64   # /preview?w= se redondea a múltiplos de esto (pocas variantes en caché)
+
+# Logs estructurados (una línea JSON por evento) y /metrics en formato Prometheus
+LOG_LEVEL = os.getenv("LOG_LEVEL","INFO").upper()
+
+# Perfilado bajo demanda de peticiones (DATA/profiles, ver /profiles)
+PROFILE_TOKEN       = os.getenv("PROFILE_TOKEN","").strip()       # cabecera X-Profile: <token> → se perfila esa petición
+PROFILE_SAMPLE      = float(os.getenv("PROFILE_SAMPLE","0"))      # fracción de peticiones perfiladas al azar (0 = ninguna)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS","5")) # periodo de muestreo de la pila
+PROFILE_KEEP        = int(os.getenv("PROFILE_KEEP","50"))         # perfiles que se conservan
+
+# Rutas de operador (/export, /api/postcards): cabecera X-Admin-Token: <token> o ?token=. Sin
+# ADMIN_TOKEN quedan cerradas (403): listan los códigos y bajan las fotos de todos los invitados.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN","").strip()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY","movil_public_secret")
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB*1024*1024 + 64*1024   # + cabeceras multipart
+
+# ---------- Métricas y logs ----------
+# Registro y logger compartidos con la variante de la raíz (postal_common): histogramas
+# de latencia por etapa (timed) y por ruta, contadores de resultados y gauges que se
+# calculan al leer (colas, trabajos, memoria; ver metric_gauges).
+log = setup_logging(LOG_LEVEL)
+metrics_registry = Metrics({
+    "postal_uploads_total":  ("counter", "Subidas por resultado (new, duplicate o el error)"),
+    "postal_exports_total":  ("counter", "Exportaciones completas por tipo (cards, contact, zip)"),
+}, gauges=lambda: metric_gauges())
+observe, inc, timed, stage_trace = metrics_registry.observe, metrics_registry.inc, metrics_registry.timed, metrics_registry.stage_trace
+metrics_text = metrics_registry.text
+
+# ---------- Índice de postales ----------
+# SHA-1 completo → código, metadatos y etapas ya hechas. Una subida repetida (doble
+# toque, reintento del móvil) devuelve el código existente sin recomponer/reimprimir/
+# resubir; si el prefijo de 8 hex ya es de OTRO contenido se asigna un código más largo.
+# También respalda /api/postcards (listado paginado, sólo para el operador) sin recorrer
+# UPL/PDFS, y /view_image/<code> busca ahí antes de mirar el disco.
+INDEX_DB = DATA / "postcards.sqlite3"
+_index_lock = threading.Lock()
+
+def _index_db() -> sqlite3.Connection:
+    con = sqlite3.connect(INDEX_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    return con
+
+with _index_db() as _con:
+    _con.execute("PRAGMA journal_mode=WAL")
+    _con.execute("""CREATE TABLE IF NOT EXISTS postcards(
+        sha1 TEXT PRIMARY KEY, code TEXT UNIQUE NOT NULL, created REAL NOT NULL, updated REAL NOT NULL,
+        orig_bytes INTEGER, width INTEGER, height INTEGER,
+        rendered TEXT,      -- LAYOUT_VERSION con el que se generaron los derivados
+        layout TEXT, print_bytes INTEGER, pdf_bytes INTEGER,
+        printed REAL,       -- última impresión OK
+        print_status TEXT,  -- queued | ok | error | off
+        remote REAL,        -- encolada en la outbox
+        remote_status TEXT) -- pending | sending | sent | failed""")
+    if "archived" not in {r[1] for r in _con.execute("PRAGMA table_info(postcards)")}:
+        _con.execute("ALTER TABLE postcards ADD COLUMN archived TEXT")   # ruta de archivo | deleted (ver Almacenamiento)
+    _con.execute("CREATE INDEX IF NOT EXISTS postcards_created ON postcards(created, code)")
+    _con.execute("CREATE INDEX IF NOT EXISTS postcards_print ON postcards(print_status, created, code)")
+    _con.execute("CREATE INDEX IF NOT EXISTS postcards_remote ON postcards(remote_status, created, code)")
+_con.close()
+
+def _file_sha1(path:Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""): h.update(chunk)
+    return h.hexdigest()
+
+def index_claim(digest:str, **meta) -> tuple:
+    """(code, duplicado) para un contenido recién recibido; meta = orig_bytes/width/height."""
+    with _index_lock, _index_db() as con:
+        r = con.execute("SELECT code FROM postcards WHERE sha1=?", (digest,)).fetchone()
+        if r: return r["code"], True
+        for n in range(8, 41, 2):
+            code = digest[:n]
+            if con.execute("SELECT 1 FROM postcards WHERE code=?", (code,)).fetchone(): continue
+            legacy = UPL / f"{code}.jpg"   # subidas anteriores al índice
+            if legacy.exists() and _file_sha1(legacy) != digest: continue
+            now = time.time()
+            cols = ("sha1", "code", "created", "updated", *meta)
+            con.execute(f"INSERT INTO postcards({', '.join(cols)}) VALUES({', '.join('?'*len(cols))})",
+                        (digest, code, now, now, *meta.values()))
+            return code, legacy.exists()
+    raise ValueError("code_collision")
+
+def index_get(code:str):
+    with _index_db() as con:
+        r = con.execute("SELECT * FROM postcards WHERE code=?", (code,)).fetchone()
+    return dict(r) if r else None
+
+POSTCARD_FILTERS = {"print_status", "remote_status", "layout"}
+
+def index_list(limit:int=50, after:str="", since:float=None, until:float=None, **filters) -> dict:
+    """Página de postales, más recientes primero. Paginación por clave (created, code):
+    `after` es el cursor `next` de la página anterior."""
+    where, args = [], []
+    for k, v in filters.items():
+        if k in POSTCARD_FILTERS and v: where.append(f"{k}=?"); args.append(v)
+    if since is not None: where.append("created>=?"); args.append(since)
+    if until is not None: where.append("created<?"); args.append(until)
+    if after:
+        ts, _, code = after.partition("_")
+        where.append("(created<? OR (created=? AND code<?))"); args += [float(ts), float(ts), code]
+    q = "SELECT * FROM postcards" + (" WHERE " + " AND ".join(where) if where else "")
+    with _index_db() as con:
+        rows = [dict(r) for r in con.execute(q + " ORDER BY created DESC, code DESC LIMIT ?", (*args, limit+1))]
+    nxt = f"{rows[limit-1]['created']!r}_{rows[limit-1]['code']}" if len(rows) > limit else None
+    return {"items": rows[:limit], "next": nxt}
+
+def index_stats() -> dict:
+    with _index_db() as con:
+        total = con.execute("SELECT COUNT(*) FROM postcards").fetchone()[0]
+        by = lambda col: {r[0] or "none": r[1] for r in con.execute(f"SELECT {col}, COUNT(*) FROM postcards GROUP BY {col}")}
+        return {"total": total, "print_status": by("print_status"), "remote_status": by("remote_status")}
+
+def index_backfill() -> int:
+    """Registra originales de UPL anteriores al índice (una vez, p.ej. tras actualizar)."""
+    n = 0
+    with _index_db() as con: known = {r[0] for r in con.execute("SELECT code FROM postcards")}
+    for p in UPL.glob("*.jpg"):
+        if p.stem in known: continue
+        try:
+            with Image.open(p) as im: w, h = im.size
+        except Exception: w = h = None
+        st = p.stat()
+        with _index_lock, _index_db() as con:
+            n += con.execute("""INSERT OR IGNORE INTO postcards(sha1, code, created, updated, orig_bytes, width, height)
+                                VALUES(?,?,?,?,?,?,?)""", (_file_sha1(p), p.stem, st.st_mtime, time.time(),
+                                                           st.st_size, w, h)).rowcount
+    return n
+
+def index_mark(code:str, **fields):
+    if not fields: return
+    cols = ", ".join(f"{k}=?" for k in fields)
+    with _index_lock, _index_db() as con:
+        con.execute(f"UPDATE postcards SET {cols}, updated=? WHERE code=?", (*fields.values(), time.time(), code))
 
 # ---------- Helpers de imagen ----------
 def _sha8(b: bytes) -> str: return hashlib.sha1(b).hexdigest()[:8]
 
-def open_image(path: Path) -> Image.Image:
+def ingest_upload(f) -> tuple:
+    """Copia el archivo subido por trozos a UPL calculando el SHA-1 al vuelo y aplicando
+    MAX_UPLOAD_MB / MAX_UPLOAD_PIXELS; lo publica como <code>.jpg con un rename atómico.
+    Devuelve (code, ruta, sha1, duplicado) o lanza ValueError("empty" | "too_large" | "too_many_pixels" |
+    "invalid_image" | "busy")."""
+    h = hashlib.sha1(); size = 0; limit = MAX_UPLOAD_MB*1024*1024
+    tmp = UPL / f".{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                chunk = f.stream.read(UPLOAD_CHUNK)
+                if not chunk: break
+                size += len(chunk)
+                if size > limit: raise ValueError("too_large")
+                h.update(chunk); out.write(chunk)
+        return publish_upload(tmp, size, h.hexdigest())
+    finally:
+        try: tmp.unlink()
+        except FileNotFoundError: pass
+
+def publish_upload(tmp:Path, size:int, digest:str) -> tuple:
+    """Valida el archivo ya recibido y lo publica como <code>.jpg (ver ingest_upload)."""
+    if not size: raise ValueError("empty")
+    try:
+        with Image.open(tmp) as im: w, hh, fmt = *im.size, im.format   # sólo cabecera, sin decodificar
+    except Image.DecompressionBombError: raise ValueError("too_many_pixels")
+    except Exception: raise ValueError("invalid_image")
+    if fmt not in UPLOAD_FORMATS or not (w and hh): raise ValueError("invalid_image")
+    if w*hh > MAX_UPLOAD_PIXELS: raise ValueError("too_many_pixels")
+    if not render_admit(digest, decode_cost(w, hh, fmt, print_cover())): raise ValueError("busy")
+    code, dup = index_claim(digest, orig_bytes=size, width=w, height=hh)
+    img_path = UPL / f"{code}.jpg"
+    if not (dup and img_path.exists()): os.replace(tmp, img_path); storage.note(img_path)
+    return code, img_path, digest, dup
+
+# ---------- Admisión por memoria ----------
+# El coste de una imagen sale de su cabecera, sin decodificarla: bytes RGB a la escala DCT
+# que usará open_image más el lienzo de la postal. Dos topes:
+#  · RENDER_BACKLOG_MB: suma de los renders admitidos que aún no terminaron. Una subida nueva
+#    que no cabe recibe 429 + Retry-After (el outbox del navegador reintenta) en vez de encolarse.
+#  · DECODE_BUDGET_MB: decodificaciones a la vez en este proceso (/preview, variantes, outbox);
+#    las que no caben esperan turno en lugar de agotar la memoria.
+ADMISSION = {"rejected": 0, "decode_waits": 0, "decode_peak": 0, "worker_peak_rss_mb": None}
+_decode_cond = threading.Condition()
+_decode_inflight = 0
+
+def decode_cost(w:int, h:int, fmt:str="JPEG", cover=None) -> int:
+    """Bytes que ocupa decodificar una imagen w×h para cubrir `cover` (más el lienzo W×H)."""
+    s = 1
+    if FAST_DECODE and cover and fmt == "JPEG":
+        tw, th = cover
+        r = min(w/tw, h/th, w/th, h/tw)   # sin mirar la orientación EXIF: la peor de las dos
+        s = next((k for k in (8,4,2) if k <= r), 1)
+    return math.ceil(w/s) * math.ceil(h/s) * 3 + W*H*3
+
+def image_cost(path:Path, layout:str=None) -> int:
+    try:
+        with Image.open(path) as im: return decode_cost(im.width, im.height, im.format, print_cover(layout))
+    except Exception: return 0
+
+@contextmanager
+def decode_slot(cost:int):
+    """Reserva `cost` bytes del presupuesto de decodificación; espera si no caben
+    (una imagen mayor que todo el presupuesto pasa cuando no hay otra en curso)."""
+    global _decode_inflight
+    budget = DECODE_BUDGET_MB*1024*1024
+    with _decode_cond:
+        if _decode_inflight and _decode_inflight + cost > budget: ADMISSION["decode_waits"] += 1
+        while _decode_inflight and _decode_inflight + cost > budget: _decode_cond.wait()
+        _decode_inflight += cost
+        ADMISSION["decode_peak"] = max(ADMISSION["decode_peak"], _decode_inflight)
+    try: yield
+    finally:
+        with _decode_cond:
+            _decode_inflight -= cost; _decode_cond.notify_all()
+
+def render_backlog() -> tuple:
+    """(bytes, trabajos) de los renders admitidos que aún no han terminado."""
+    with JOBS_COND:
+        live = [j["cost"] for j in JOBS.values()
+                if j.get("cost") and j["stages"]["render"]["state"] in ("pending","running")]
+    return sum(live), len(live)
+
+def render_admit(digest:str, cost:int) -> bool:
+    """¿Cabe un render más? Un contenido ya renderizado con este layout no cuesta nada."""
+    with _index_db() as con:
+        r = con.execute("SELECT rendered FROM postcards WHERE sha1=?", (digest,)).fetchone()
+    if r and r["rendered"] == LAYOUT_VERSION: return True
+    used, n = render_backlog()
+    if not n or used + cost <= RENDER_BACKLOG_MB*1024*1024: return True
+    ADMISSION["rejected"] += 1
+    return False
+
+def retry_after() -> int:
+    """Segundos que sugerimos esperar: renders en cola × mediana reciente de render / workers."""
+    with JOBS_COND:
+        secs = sorted(j["stages"]["render"]["secs"] for j in JOBS.values() if j["stages"]["render"].get("secs"))
+    _, n = render_backlog()
+    per = secs[len(secs)//2] if secs else 2.0
+    return max(1, min(60, math.ceil(per * n / max(1, RENDER_WORKERS))))
+
+def peak_rss_mb():
+    """Pico de memoria residente de este proceso (MB); None si no se puede medir."""
+    try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss   # KB en Linux, bytes en macOS
+        return round(r / (2**20 if sys.platform == "darwin" else 1024), 1)
+    except ImportError: pass
+    try:   # Windows: PeakWorkingSetSize de GetProcessMemoryInfo
+        import ctypes
+        class PMC(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong)] + \
+                       [(n, ctypes.c_size_t) for n in ("PeakWorkingSetSize", "WorkingSetSize",
+                        "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                        "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+        c = PMC(); c.cb = ctypes.sizeof(c)
+        ok = ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(c), c.cb)
+        return round(c.PeakWorkingSetSize / 2**20, 1) if ok else None
+    except Exception: return None
+
+def admission_stats() -> dict:
+    used, n = render_backlog()
+    return {"render_backlog_mb": round(used/2**20, 1), "render_backlog_jobs": n, "render_budget_mb": RENDER_BACKLOG_MB,
+            "decode_inflight_mb": round(_decode_inflight/2**20, 1), "decode_peak_mb": round(ADMISSION["decode_peak"]/2**20, 1),
+            "decode_budget_mb": DECODE_BUDGET_MB, "decode_waits": ADMISSION["decode_waits"],
+            "rejected": ADMISSION["rejected"], "retry_after": retry_after(), "max_image_pixels": Image.MAX_IMAGE_PIXELS,
+            "peak_rss_mb": peak_rss_mb(), "worker_peak_rss_mb": ADMISSION["worker_peak_rss_mb"]}
+
+_EXIF_TRANSPOSE = {2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+                   4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+                   6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+                   8: Image.Transpose.ROTATE_90}
+
+def open_image(path: Path, cover=None) -> Image.Image:
+    """cover=(tw,th): tamaño (ya orientado) que la imagen debe seguir cubriendo;
+    con FAST_DECODE se decodifica reducida y se orienta después de reducir.
+    La decodificación ocupa su coste en decode_slot (espera si el proceso va justo de memoria)."""
     im = Image.open(path)
-    im = ImageOps.exif_transpose(im)  # corrige EXIF
-    return im.convert("RGB")
-
-def resize_cover(img: Image.Image, tw:int, th:int) -> Image.Image:
-    w,h = img.size
-    scale = max(tw/w, th/h)
-    nw, nh = int(w*scale), int(h*scale)
-    img = img.resize((nw,nh), Image.LANCZOS)
-    left = max(0,(nw-tw)//2); top = max(0,(nh-th)//2)
-    return img.crop((left, top, left+tw, top+th))
-
-def compose_fullbleed(code:str, img_path:Path) -> Image.Image:
-    base = Image.new("RGB",(W,H),(255,255,255))
-    user = open_image(img_path)
-    user = resize_cover(user, W, H)
-    base.paste(user, (0,0))
-    d = ImageDraw.Draw(base)
-    try: font = ImageFont.truetype("DejaVuSans-Bold.ttf", 72)
-    except: font = ImageFont.load_default()
-    tw = d.textlength(code, font=font); pad=30
-    d.rectangle([W-int(tw)-pad*2, H-130, W-30, H-30], fill=(255,255,255,230))
-    d.text((W-int(tw)-pad*1.5, H-120), code, fill=(20,20,20), font=font)
-    return base
-
-def compose_square(code:str, img_path:Path, margin:int=120, anchor:str="center") -> Image.Image:
-    base = Image.new("RGB",(W,H),(255,255,255))
-    side = min(W,H) - 2*margin
-    x,y = (W-side)//2, (H-side)//2
-    im = open_image(img_path)
-    sq = min(im.width, im.height)
-    if anchor=="top":    left, top = (im.width-sq)//2, 0
-    elif anchor=="bottom": left, top = (im.width-sq)//2, im.height-sq
-    else:                left, top = (im.width-sq)//2, (im.height-sq)//2
-    crop = im.crop((left, top, left+sq, top+sq)).resize((side,side), Image.LANCZOS)
-    base.paste(crop, (x,y))
-    d = ImageDraw.Draw(base)
-    d.rectangle([x,y,x+side,y+side], outline=(230,230,230), width=6)
-    try: font = ImageFont.truetype("DejaVuSans-Bold.ttf", 46)
-    except: font = ImageFont.load_default()
-    tw = d.textlength(code, font=font); pad=24
-    d.rectangle([W-int(tw)-pad*2, H-92, W-30, H-30], fill=(255,255,255,210))
-    d.text((W-int(tw)-pad*1.5, H-82), code, fill=(20,20,20), font=font)
-    return base
+    with decode_slot(decode_cost(im.width, im.height, im.format, cover)), timed("decode"):
+        return _decode(im, cover)
+
+def _decode(im:Image.Image, cover) -> Image.Image:
+    if not (FAST_DECODE and cover):
+        with timed("exif"): im = ImageOps.exif_transpose(im)  # corrige EXIF
+        return im.convert("RGB")
+    orient = im.getexif().get(0x0112, 1)
+    tw, th = cover
+    if orient in (5,6,7,8): tw, th = th, tw   # a coordenadas del archivo (sin rotar)
+    r = min(im.width/tw, im.height/th)
+    if r > 1 and im.format == "JPEG":
+        im.draft("RGB", (math.ceil(im.width/r), math.ceil(im.height/r)))  # escala DCT 1/2, 1/4, 1/8
+    im = im.convert("RGB")
+    k = int(min(im.width/tw, im.height/th) // 2)   # deja ≥2× de margen para el LANCZOS final
+    if k >= 2: im = im.reduce(k)
+    if orient in _EXIF_TRANSPOSE:
+        with timed("exif"): im = im.transpose(_EXIF_TRANSPOSE[orient])
+    return im
+
+def _source(src, cover) -> Image.Image:
+    """src: ruta del original o imagen ya decodificada (compartida entre derivados)."""
+    return src if isinstance(src, Image.Image) else open_image(src, cover=cover)
+
+def _fit(im:Image.Image, tw:int, th:int, anchor:str="center") -> Image.Image:
+    """Recorta al aspecto tw:th según anchor y escala a tw×th en un solo resize (box=, sin copia intermedia)."""
+    w, h = im.size
+    cw, ch = (round(h*tw/th), h) if w*th > h*tw else (w, round(w*th/tw))
+    left = 0 if anchor == "left" else w-cw if anchor == "right" else (w-cw)//2
+    top  = 0 if anchor == "top" else h-ch if anchor == "bottom" else (h-ch)//2
+    with timed("resize"): return im.resize((tw,th), Image.LANCZOS, box=(left, top, left+cw, top+ch))
+
+# scale: tamaño de salida respecto al de impresión (W×H). Márgenes, borde, fuente y
+# etiqueta se escalan con él, así que un composite a 0.25 es el de impresión reducido,
+# pero se decodifica y se compone ya a ese tamaño (≈ scale² de trabajo y bytes).
+def _canvas(scale:float) -> tuple:
+    return (W, H) if scale >= 1 else (max(1, round(W*scale)), max(1, round(H*scale)))
+
+# ---------- Layouts ----------
+# Un layout es un documento declarativo: los integrados (square, fullbleed) y uno por
+# archivo LAYOUTS_DIR/<nombre>.json (o .toml con Python 3.11+), que se elige con
+# PRINT_LAYOUT=<nombre>. El lienzo es siempre la postal W×H; medidas en px a 300 dpi:
+#   {"background": "#ffffff",
+#    "photo":    {"box": [285, 120, 1530, 1410], "anchor": "center"},   # x, y, ancho, alto
+#    "frame":    {"width": 6, "color": "#e6e6e6"},                     # borde sobre la foto (opcional)
+#    "label":    {"font": "DejaVuSans-Bold.ttf", "size": 46, "color": "#141414",
+#                 "background": "#ffffff", "pad": 24, "height": 62,
+#                 "right": 30, "bottom": 30, "offset": 10},            # el código (opcional)
+#    "overlays": [{"image": "marco.png", "x": 0, "y": 0, "over": true}]} # PNG de LAYOUTS_DIR
+# Cada (layout, scale) se compila una vez en un plan: fondo y capas bajo la foto ya
+# rasterizados, borde y capas encima como recortes listos para pegar, fuente cargada.
+# Componer = copiar el fondo, pegar la foto y las capas y escribir los 8 caracteres.
+ANCHORS = ("center", "top", "bottom", "left", "right")
+
+def _builtin_layouts() -> dict:
+    side = min(W,H) - 2*PRINT_MARGIN
+    label = {"font": "DejaVuSans-Bold.ttf", "color": "#141414", "background": "#ffffff",
+             "right": 30, "bottom": 30, "offset": 10}
+    return {"square":    {"photo": {"box": [(W-side)//2, (H-side)//2, side, side], "anchor": PRINT_ANCHOR},
+                          "frame": {"width": 6, "color": "#e6e6e6"},
+                          "label": dict(label, size=46, pad=24, height=62)},
+            "fullbleed": {"photo": {"box": [0, 0, W, H], "anchor": "center"},
+                          "label": dict(label, size=72, pad=30, height=100)}}
+
+def _check_layout(spec:dict) -> dict:
+    x, y, w, h = (int(v) for v in spec["photo"]["box"])
+    if min(x, y) < 0 or min(w, h) <= 0 or x+w > W or y+h > H:
+        raise ValueError(f"photo.box {spec['photo']['box']} fuera del lienzo {W}x{H}")
+    if spec["photo"].get("anchor", "center") not in ANCHORS:
+        raise ValueError("photo.anchor debe ser " + " | ".join(ANCHORS))
+    for o in spec.get("overlays", ()):   # el contenido del PNG cuenta para LAYOUT_VERSION
+        o["sha1"] = hashlib.sha1((LAYOUTS_DIR / o["image"]).read_bytes()).hexdigest()[:12]
+    _compile(spec, 1.0)   # colores, fuentes y capas válidos antes de aceptarlo
+    return spec
+
+def load_layouts() -> dict:
+    layouts = _builtin_layouts()
+    for f in sorted(LAYOUTS_DIR.glob("*.*")) if LAYOUTS_DIR.is_dir() else ():
+        if f.suffix not in (".json", ".toml"): continue
+        if f.suffix == ".toml" and tomllib is None:
+            log_event("layout_skipped", logging.WARNING, file=f.name, reason="TOML requiere Python 3.11+"); continue
+        try:
+            text = f.read_text("utf-8")
+            layouts[f.stem.lower()] = _check_layout(json.loads(text) if f.suffix == ".json" else tomllib.loads(text))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_event("layout_invalid", logging.ERROR, file=f.name, error=str(e))
+    return layouts
+
+def layout_spec(layout:str=None) -> dict:
+    layout = layout or PRINT_LAYOUT
+    if layout not in LAYOUTS: raise ValueError(f"layout desconocido: {layout}")
+    return LAYOUTS[layout]
+
+@functools.lru_cache(maxsize=16)
+def _font(name:str, size:int):
+    path = LAYOUTS_DIR / name
+    try: return ImageFont.truetype(str(path) if path.is_file() else name, size)
+    except OSError:
+        log_event("font_missing", logging.WARNING, font=name)
+        return ImageFont.load_default()
+
+def _compile(spec:dict, scale:float) -> dict:
+    cw, ch = _canvas(scale)
+    pos = lambda v: round(v*scale); px = lambda v: max(1, round(v*scale))
+    x, y, w, h = spec["photo"]["box"]
+    box = (pos(x), pos(y), min(px(w), cw-pos(x)), min(px(h), ch-pos(y)))
+    under, over = [], []
+    for o in spec.get("overlays", ()):
+        with Image.open(LAYOUTS_DIR / o["image"]) as im:
+            im = im.convert("RGBA")
+            if scale < 1: im = im.resize((px(im.width), px(im.height)), Image.LANCZOS)
+        bb = im.getchannel("A").getbbox()   # sólo la parte visible: menos píxeles que mezclar por postal
+        if bb: (over if o.get("over", True) else under).append((im.crop(bb), (pos(o["x"])+bb[0], pos(o["y"])+bb[1])))
+    fr = spec.get("frame")
+    if fr:   # cuatro tiras opacas: se pegan sin máscara sobre la foto
+        fw, col = px(fr["width"]), ImageColor.getrgb(fr["color"])[:3]
+        bx, by, bw, bh = box
+        for (sx, sy, sw, sh) in ((bx, by, bw, fw), (bx, by+bh-fw, bw, fw), (bx, by, fw, bh), (bx+bw-fw, by, fw, bh)):
+            over.append((Image.new("RGB", (sw, sh), col), (sx, sy)))
+    bg = ImageColor.getrgb(spec.get("background", "#ffffff"))[:3]
+    base = None
+    if box != (0, 0, cw, ch) or under:   # la foto a sangre ya es el lienzo: nada que copiar
+        base = Image.new("RGB", (cw, ch), bg)
+        for im, p in under: base.paste(im, p, im)
+    lb = spec.get("label")
+    if lb:
+        lb = {"font": _font(lb.get("font", "DejaVuSans-Bold.ttf"), px(lb["size"])), "pad": px(lb["pad"]),
+              "top": ch-px(lb["bottom"]+lb["height"]), "bottom": ch-px(lb["bottom"]), "right": cw-px(lb["right"]),
+              "text_y": ch-px(lb["bottom"]+lb["height"]-lb["offset"]),
+              "color": ImageColor.getrgb(lb["color"])[:3], "background": ImageColor.getrgb(lb["background"])[:3]}
+    return {"size": (cw, ch), "base": base, "box": box, "anchor": spec["photo"].get("anchor", "center"),
+            "over": over, "label": lb}
+
+@functools.lru_cache(maxsize=32)   # (layout, scale): /preview cuantiza el ancho, son pocos
+def layout_plan(layout:str, scale:float) -> dict:
+    return _compile(layout_spec(layout), scale)
+
+LAYOUTS = load_layouts()
+if PRINT_LAYOUT not in LAYOUTS:
+    log_event("layout_invalid", logging.ERROR, layout=PRINT_LAYOUT, error="no existe; se usa square")
+    PRINT_LAYOUT = "square"
+
+def print_cover(layout:str=None):
+    """Tamaño que el original (orientado) debe cubrir para el layout de impresión."""
+    _, _, w, h = layout_spec(layout)["photo"]["box"]
+    return (w, h)
+
+def capture_profile(layout:str=None) -> dict:
+    """Lo que el navegador debe subir: los píxeles justos para 300 DPI, ya recortados al aspecto del layout."""
+    layout = layout or PRINT_LAYOUT
+    tw, th = print_cover(layout)
+    return {"layout": layout, "width": tw, "height": th, "dpi": 300,
+            "anchor": layout_spec(layout)["photo"].get("anchor", "center"),
+            "mime": "image/jpeg", "max_bytes": int(tw*th*CAPTURE_BPP/8),
+            "quality": CAPTURE_QUALITY, "min_quality": CAPTURE_MIN_QUALITY,
+            "camera": {"width": max(tw, math.ceil(th*16/9)), "height": th}}   # 16:9 que cubra el recorte
+
+def compose(code:str, src, layout:str=None, scale:float=1.0) -> Image.Image:
+    plan = layout_plan(layout or PRINT_LAYOUT, min(scale, 1.0))
+    with timed("compose"):   # incluye decode/resize si src es una ruta
+        x, y, w, h = plan["box"]
+        photo = _fit(_source(src, (w,h)), w, h, plan["anchor"])
+        if plan["base"] is None: base = photo
+        else:
+            base = plan["base"].copy()
+            base.paste(photo, (x,y))
+        for im, p in plan["over"]: base.paste(im, p, im if im.mode == "RGBA" else None)
+        lb = plan["label"]
+        if lb:
+            d = ImageDraw.Draw(base)
+            tw = int(d.textlength(code, font=lb["font"])); cw = base.width
+            d.rectangle([cw-tw-lb["pad"]*2, lb["top"], lb["right"], lb["bottom"]], fill=lb["background"])
+            d.text((cw-tw-lb["pad"]*1.5, lb["text_y"]), code, fill=lb["color"], font=lb["font"])
+        return base
+
+# ---------- PDF ----------
+# Escritor de postal_common (iter_pdf/write_pdf): cada JPEG se incrusta tal cual como
+# stream DCTDecode y el PDF sale por trozos, a disco o a la respuesta.
+def jpeg_bytes(img:Image.Image, quality:int=PRINT_QUALITY) -> bytes:
+    b = io.BytesIO()
+    with timed("jpeg"): img.save(b, "JPEG", quality=quality)
+    return b.getvalue()
+
+PAPER_IN = {"letter": (8.5, 11.0), "a4": (8.27, 11.69)}
+CUT_MARK = (0.0625, 0.1875)   # separación y largo de las marcas de corte (pulgadas)
+
+def sheet_grid(n:int, paper:str=None):
+    """Mejor rejilla para n postales en la hoja: (escala, ancho, alto, filas, columnas).
+    Prueba hoja vertical/apaisada y todas las filas×columnas; nunca amplía (escala ≤ 1)."""
+    pw, ph = PAPER_IN[paper or IMPOSE_PAPER]
+    best = None
+    for sw, sh in ((pw, ph), (ph, pw)):
+        for rows in (r for r in range(1, n+1) if n % r == 0):
+            cols = n // rows
+            k = min(1.0, (sw-2*IMPOSE_MARGIN)/(cols*CARD_IN[0]), (sh-2*IMPOSE_MARGIN)/(rows*CARD_IN[1]))
+            if not best or k > best[0]: best = (k, sw, sh, rows, cols)
+    return best
+
+def sheet_page(jpegs, n:int=None, paper:str=None):
+    """Página de imposición: hasta n postales (JPEG ya codificados) a tope, centradas,
+    con marcas de corte en el margen prolongando cada línea de corte."""
+    k, sw, sh, rows, cols = sheet_grid(n or len(jpegs), paper)
+    w, h = CARD_IN[0]*k, CARD_IN[1]*k
+    x0, y0 = (sw - cols*w)/2, (sh - rows*h)/2
+    x1, y1 = x0 + cols*w, y0 + rows*h
+    images = [(jpeg, x0 + (i % cols)*w, y0 + (i // cols)*h, w, h) for i, jpeg in enumerate(jpegs)]
+    gap, ln = CUT_MARK
+    lines = []
+    for c in range(cols+1):
+        x = x0 + c*w; lines += [(x, y0-gap-ln, x, y0-gap), (x, y1+gap, x, y1+gap+ln)]
+    for r in range(rows+1):
+        y = y0 + r*h; lines += [(x0-gap-ln, y, x0-gap, y), (x1+gap, y, x1+gap+ln, y)]
+    return (sw, sh, images, lines)
 
 def save_pdf(img:Image.Image, pdf_path:Path):
-    pdf = FPDF(orientation='L', unit='in', format=(7.0,5.5))
-    pdf.add_page()
-    tmp = pdf_path.with_suffix(".tmp.jpg")
-    img.save(tmp, quality=92)
-    pdf.image(str(tmp), x=0, y=0, w=7.0, h=5.5)
-    pdf.output(pdf_path)
-    try: tmp.unlink()
-    except: pass
+    pages = [card_page(jpeg_bytes(img))]
+    with timed("pdf"): write_pdf(pages, pdf_path)
 
-# ---------- Impresión ----------
-def send_eprint(pdf_path:Path, code:str) -> bool:
-    if not EMAIL_ENABLED:
-        print("ℹ️ ePrint no configurado"); return False
-    try:
-        from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
-        subject = f"Print {code} {datetime.utcnow().strftime('%H:%M:%S')}"
-        enc = base64.b64encode(pdf_path.read_bytes()).decode()
-        msg = Mail(from_email=SENDER_EMAIL, to_emails=PRINTER_EMAIL, subject=subject, plain_text_content=subject)
-        msg.attachment = Attachment(FileContent(enc), FileName(f"postal_{code}.pdf"), FileType("application/pdf"), Disposition("attachment"))
-        sg = SendGridAPIClient(api_key=SENDGRID_API_KEY)
-        resp = sg.send(msg)
-        ok = resp.status_code in (200,202)
-        print(("✅ ePrint OK" if ok else "❌ ePrint ERROR"), "status=", resp.status_code)
-        return ok
-    except Exception as e:
-        print("❌ ePrint excepción:", e); return False
+# ---------- Codificador con presupuesto ----------
+# postal_common.BudgetEncoder: la mayor resolución (hasta EPRINT_MIN_PX) y, en ella, la mejor
+# calidad y submuestreo que caben en N bytes. Lo elegido se recuerda por clave (layout, color,
+# presupuesto) en DATA/eprint_params.json: las postales siguientes aciertan a la primera.
+budget_encoder = BudgetEncoder(DATA / "eprint_params.json", EPRINT_MIN_QUALITY, EPRINT_MIN_PX)
+
+def encode_budget(img:Image.Image, budget:int, key:str, min_q:int=None, min_px:int=None) -> tuple:
+    """JPEG de img en ≤ budget bytes → (bytes, params); ver BudgetEncoder.encode."""
+    with timed("eprint_encode"): return budget_encoder.encode(img, budget, key, min_q, min_px)
+
+# ---------- Derivados ----------
+# Cada subida se decodifica UNA vez (al tamaño que cubre al derivado más exigente) y
+# de esa imagen y del composite salen todos los archivos, en el orden declarado.
+def _d_print(ctx):  ctx["print_jpg"] = jpeg_bytes(ctx["comp"]); return ctx["print_jpg"]
+def _d_pdf(ctx):
+    with timed("pdf"): return b"".join(iter_pdf([card_page(ctx["print_jpg"])]))
+def _d_thumb(ctx):
+    return jpeg_bytes(ctx["comp"].resize((THUMB_W, round(THUMB_W*H/W)), Image.LANCZOS, reducing_gap=2.0), 85)
+def _d_remote(ctx):
+    im = ctx["img"]
+    if REMOTE_MAX_PX and max(im.size) > REMOTE_MAX_PX:
+        r = REMOTE_MAX_PX / max(im.size)
+        im = im.resize((round(im.width*r), round(im.height*r)), Image.LANCZOS, reducing_gap=2.0)
+    b = io.BytesIO(); im.save(b, "JPEG", quality=85, optimize=True)
+    return b.getvalue()
+def _d_eprint(ctx):
+    im = ctx["comp"].convert("L") if EPRINT_COLOR == "gray" else ctx["comp"]
+    budget = EPRINT_BUDGET_KB*1024 - 1024          # ~1 KiB de estructura PDF alrededor del JPEG
+    jpeg, _ = encode_budget(im, budget, f"{ctx['layout']}:{EPRINT_COLOR}:{EPRINT_BUDGET_KB}")
+    return b"".join(iter_pdf([card_page(jpeg)]))
+
+# nombre → (archivo en PDFS, generador); "print" va antes que "pdf" (reutiliza su JPEG)
+DERIVATIVES = {
+    "print":  ("{code}_print.jpg",  _d_print),
+    "pdf":    ("{code}.pdf",        _d_pdf),
+    "thumb":  ("{code}_thumb.jpg",  _d_thumb),
+    "remote": ("{code}_remote.jpg", _d_remote),
+    "eprint": ("{code}_eprint.pdf", _d_eprint),   # sólo en modo email con EPRINT_BUDGET_KB
+}
+
+def derivative_path(code:str, name:str) -> Path:
+    return PDFS / DERIVATIVES[name][0].format(code=code)
+
+def _fit_cover(img_path:Path, max_px:int):
+    """Cover (orientado) para encajar el original en max_px de lado mayor (None = original)."""
+    if not max_px: return None
+    with Image.open(img_path) as im:
+        w, h = im.size
+        if im.getexif().get(0x0112, 1) in (5,6,7,8): w, h = h, w
+    r = min(1.0, max_px / max(w, h))
+    return (math.ceil(w*r), math.ceil(h*r))
 
-def print_sumatra(pdf_path:Path) -> bool:
+def derivative_names(only=None) -> list:
+    """Derivados a generar (de `only`, o todos) según la configuración; pdf arrastra a print."""
+    names = [n for n in DERIVATIVES if (only is None or n in only)
+             and (n != "remote" or (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN))
+             and (n != "eprint" or (AUTO_PRINT_MODE == "email" and EPRINT_BUDGET_KB > 0))]
+    if "pdf" in names and "print" not in names: names.insert(0, "print")
+    return names
+
+def render_derivatives(code:str, img_path:Path, layout:str=None, only=None) -> dict:
+    """Etapa render (proceso worker): una decodificación → print, pdf, thumb, remote y eprint."""
+    layout = layout or PRINT_LAYOUT
+    names = derivative_names(only)
+    cover = print_cover(layout)
+    if "remote" in names:
+        rc = _fit_cover(img_path, REMOTE_MAX_PX)
+        cover = (max(cover[0], rc[0]), max(cover[1], rc[1])) if rc else None
+    files = {}
+    with stage_trace(deferred=True) as st:   # las observa _run_job (este puede ser otro proceso)
+        img = open_image(img_path, cover=cover)
+        ctx = {"img": img, "layout": layout}
+        if {"print", "thumb", "eprint"} & set(names): ctx["comp"] = compose(code, img, layout)
+        for name in names:
+            with timed(f"build_{name}"):
+                out = derivative_path(code, name)
+                write_atomic(out, DERIVATIVES[name][1](ctx))
+            files[name] = str(out)
+    timings = {k: round(v, 4) for k,v in st.items()}
+    return {"files": files, "timings": timings, "rss_peak_mb": peak_rss_mb()}
+
+# ---------- Caché de render ----------
+# Clave = (código, layout y su definición/calidad, formato, tamaño). Lo que depende de la
+# configuración del layout va en LAYOUT_VERSION, que da nombre al subdirectorio del
+# tier en disco: al cambiar la configuración se descartan los renders viejos.
+def layout_version() -> str:
+    cfg = {"layout": PRINT_LAYOUT, "canvas": [W, H], "spec": LAYOUTS[PRINT_LAYOUT], "quality": PRINT_QUALITY}
+    return hashlib.sha1(json.dumps(cfg, sort_keys=True).encode()).hexdigest()[:8]
+
+LAYOUT_VERSION = layout_version()
+CACHE_DIR = CACHE / LAYOUT_VERSION
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+for _d in CACHE.iterdir():
+    if _d.is_dir() and _d.name != LAYOUT_VERSION: shutil.rmtree(_d, ignore_errors=True)
+
+CACHE_STATS = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+_cache_mem: "OrderedDict[str, bytes]" = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_cache_inflight: dict = {}
+
+def cache_path(code:str, fmt:str, size=(W,H)) -> Path:
+    return CACHE_DIR / f"{code}_{size[0]}x{size[1]}.{fmt}"
+
+def _cache_mem_put(key:str, data:bytes):
+    global _cache_bytes
+    limit = RENDER_CACHE_MB * 1024 * 1024
+    if len(data) > limit: return
+    with _cache_lock:
+        old = _cache_mem.pop(key, None)
+        if old is not None: _cache_bytes -= len(old)
+        _cache_mem[key] = data; _cache_bytes += len(data)
+        while _cache_bytes > limit:
+            _, ev = _cache_mem.popitem(last=False)
+            _cache_bytes -= len(ev); CACHE_STATS["evictions"] += 1
+
+def cache_adopt(src:Path, dst:Path):
+    """Registra en el tier de disco un archivo ya generado (p.ej. por un trabajo)."""
     try:
-        if not Path(SUMATRA_PATH).exists(): 
-            print("❌ SUMATRA_PATH no existe:", SUMATRA_PATH); return False
-        import subprocess
-        subprocess.run([SUMATRA_PATH,"-print-to-default","-print-settings","noscale","-silent",str(pdf_path)], check=True)
-        print("✅ Impreso con Sumatra:", pdf_path.name); return True
+        tmp = dst.with_name(f".{uuid.uuid4().hex}.tmp")
+        try: os.link(src, tmp)
+        except OSError: shutil.copyfile(src, tmp)
+        os.replace(tmp, dst); storage.note(dst)
     except Exception as e:
-        print("❌ Sumatra error:", e); return False
+        log_event("cache_adopt_error", logging.WARNING, src=src, error=str(e))
+
+def _render_bytes(code:str, img_path:Path, fmt:str, size=(W,H)) -> bytes:
+    if fmt == "jpg": return jpeg_bytes(compose(code, img_path, scale=size[0]/W))
+    if fmt == "pdf":
+        jpeg = cache_get(code, img_path, "jpg")
+        with timed("pdf"): return b"".join(iter_pdf([card_page(jpeg)]))
+    raise ValueError(f"formato no soportado: {fmt}")
+
+def cache_get(code:str, img_path:Path, fmt:str, size=(W,H)) -> bytes:
+    """Bytes del render (memoria → disco → componer), a tamaño de impresión o reducido (jpg)."""
+    path = cache_path(code, fmt, size); key = str(path)
+    with _cache_lock:
+        data = _cache_mem.get(key)
+        if data is not None:
+            _cache_mem.move_to_end(key); CACHE_STATS["mem_hits"] += 1
+            return data
+        lock = _cache_inflight.setdefault(key, threading.Lock())
+    with lock:  # un solo render por clave aunque lleguen varias peticiones a la vez
+        try:
+            data = path.read_bytes(); storage.touch(path)
+            with _cache_lock: CACHE_STATS["disk_hits"] += 1
+        except FileNotFoundError:
+            with _cache_lock: CACHE_STATS["misses"] += 1
+            data = _render_bytes(code, img_path, fmt, size)
+            write_atomic(path, data); storage.note(path)
+        _cache_mem_put(key, data)
+    with _cache_lock: _cache_inflight.pop(key, None)
+    return data
+
+def cache_file(code:str, img_path:Path, fmt:str) -> Path:
+    """Ruta en disco del render (para send_file / impresión)."""
+    path = cache_path(code, fmt)
+    if path.exists():
+        with _cache_lock: CACHE_STATS["disk_hits"] += 1
+        storage.touch(path); return path
+    data = cache_get(code, img_path, fmt)
+    if not path.exists(): write_atomic(path, data); storage.note(path)   # acierto en memoria con el disco desalojado
+    return path
+
+def print_jpeg(code:str):
+    """_print.jpg del código; si falta (p. ej. lo desalojó la cuota, ver Almacenamiento) se
+    recompone desde el original a través de la caché. None si tampoco hay original."""
+    p = derivative_path(code, "print")
+    if p.exists(): storage.touch(p); return p
+    orig = UPL / f"{code}.jpg"
+    if not orig.exists(): return None
+    cache_adopt(cache_file(code, orig, "jpg"), p)
+    return p if p.exists() else None
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        hits = CACHE_STATS["mem_hits"] + CACHE_STATS["disk_hits"]
+        total = hits + CACHE_STATS["misses"]
+        return dict(CACHE_STATS, layout_version=LAYOUT_VERSION, mem_items=len(_cache_mem),
+                    mem_bytes=_cache_bytes, mem_limit=RENDER_CACHE_MB*1024*1024,
+                    hit_ratio=round(hits/total, 4) if total else None)
+
+# ---------- Variantes para la web ----------
+_variant_locks: dict = {}
+
+def variant_file(src:Path, key:str, w:int, webp:bool) -> Path:
+    """Versión de `src` a `w` px de ancho (JPEG o WebP), generada una sola vez."""
+    out = VARIANTS / f"{key}_{w}.{'webp' if webp else 'jpg'}"
+    if out.exists():
+        storage.touch(out); return out
+    with _cache_lock: lock = _variant_locks.setdefault(str(out), threading.Lock())
+    with lock:
+        if not out.exists():
+            im = open_image(src, cover=(w, 1))
+            if im.width > w: im = im.resize((w, max(1, round(im.height*w/im.width))), Image.LANCZOS, reducing_gap=2.0)
+            b = io.BytesIO()
+            if webp: im.save(b, "WEBP", quality=80, method=4)
+            else: im.save(b, "JPEG", quality=82, optimize=True, progressive=True)
+            write_atomic(out, b.getvalue()); storage.note(out)
+    with _cache_lock: _variant_locks.pop(str(out), None)
+    return out
+
+def send_image(src:Path, key:str, immutable:bool):
+    """send_file con ETag fuerte, 304/Range y, con ?w=, la variante reducida (WebP si el cliente la acepta)."""
+    w = request.args.get("w", type=int)
+    webp = bool(w) and "image/webp" in request.headers.get("Accept","")
+    path, mime = src, "image/jpeg"
+    if w:
+        w = min(VARIANT_WIDTHS, key=lambda x: abs(x-w))   # sólo anchos conocidos
+        path, mime = variant_file(src, key, w, webp), ("image/webp" if webp else "image/jpeg")
+    etag = f"{key}-{w or 'full'}-{'webp' if webp else 'jpg'}"
+    resp = send_file(path, mimetype=mime, etag=etag, conditional=True, max_age=31536000 if immutable else 0)
+    if immutable: resp.cache_control.immutable = True
+    else: resp.cache_control.no_cache = True
+    if w: resp.vary.add("Accept")
+    return resp
+
+def comp_version(p:Path) -> str:
+    """Versión del composite (cambia si se re-renderiza): va en la URL y en el ETag."""
+    return format(p.stat().st_mtime_ns, "x")
+
+# ---------- Impresión ----------
+# Cada destino es una función (pdf_path, code) que lanza excepción si falla; las llama
+# el spooler (ver Cola de impresión), nunca el hilo de la petición.
+_sendgrid = None
+
+def sendgrid_client():
+    """Cliente de SendGrid persistente (sólo lo usa el hilo del destino "email")."""
+    global _sendgrid
+    if _sendgrid is None:
+        from sendgrid import SendGridAPIClient
+        _sendgrid = SendGridAPIClient(api_key=SENDGRID_API_KEY, host=SENDGRID_HOST)
+    return _sendgrid
+
+def send_eprint(pdf_path:Path, code:str):
+    if not EMAIL_ENABLED: raise RuntimeError("ePrint no configurado")
+    from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
+    small = derivative_path(code, "eprint")          # versión con presupuesto de bytes, si existe
+    if EPRINT_BUDGET_KB and small.exists(): pdf_path = small
+    subject = f"Print {code} {datetime.utcnow().strftime('%H:%M:%S')}"
+    enc = base64.b64encode(pdf_path.read_bytes()).decode()
+    msg = Mail(from_email=SENDER_EMAIL, to_emails=PRINTER_EMAIL, subject=subject, plain_text_content=subject)
+    msg.attachment = Attachment(FileContent(enc), FileName(f"postal_{code}.pdf"), FileType("application/pdf"), Disposition("attachment"))
+    with timed("sendgrid"): resp = sendgrid_client().send(msg)   # 4xx/5xx lanzan HTTPError
+    if resp.status_code not in (200,202): raise RuntimeError(f"ePrint status={resp.status_code}")
+
+def print_sumatra(pdf_path:Path, code:str=None):
+    if not Path(SUMATRA_PATH).exists(): raise FileNotFoundError(f"SUMATRA_PATH no existe: {SUMATRA_PATH}")
+    import subprocess
+    with timed("sumatra"):
+        subprocess.run([SUMATRA_PATH,"-print-to-default","-print-settings","noscale","-silent",str(pdf_path)],
+                       check=True, timeout=PRINT_TIMEOUT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+PRINTERS = {"email": send_eprint, "sumatra": print_sumatra}
 
 def auto_print(pdf_path:Path, code:str):
-    mode = (AUTO_PRINT_MODE or "off").lower()
-    if mode == "email":  send_eprint(pdf_path, code)
-    elif mode == "sumatra": print_sumatra(pdf_path)
-    else: print("ℹ️ AUTO_PRINT_MODE=off")
+    """Encola la impresión: True si queda en cola (o ya estaba), None si la impresión está desactivada."""
+    return print_enqueue(code, pdf_path)
+
+# ---------- Cola de impresión ----------
+# Spooler durable: un trabajo por código (un doble toque o una reimpresión mientras está en
+# cola no duplica), un hilo por destino (Sumatra nunca corre dos veces a la vez contra la
+# misma impresora, los emails salen en orden) y backoff exponencial con jitter.
+PRINT_DB = DATA / "printq.sqlite3"
+SHEETS = PDFS / "sheets"                   # PDFs de imposición (IMPOSE_UP > 1)
+_print_lock = threading.Lock()
+_print_wake: dict = {}                      # destino → Event
+_print_threads: dict = {}                   # destino → Thread
+
+def _print_db() -> sqlite3.Connection:
+    con = sqlite3.connect(PRINT_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    return con
+
+with _print_db() as _con:
+    _con.execute("PRAGMA journal_mode=WAL")
+    _con.execute("""CREATE TABLE IF NOT EXISTS printq(
+        code TEXT PRIMARY KEY, pdf_path TEXT NOT NULL, dest TEXT NOT NULL, state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, last_error TEXT,
+        created REAL NOT NULL, started REAL, finished REAL, updated REAL NOT NULL, sheet TEXT)""")
+    if "sheet" not in {r[1] for r in _con.execute("PRAGMA table_info(printq)")}:
+        _con.execute("ALTER TABLE printq ADD COLUMN sheet TEXT")   # colas creadas antes de la imposición
+    _con.execute("CREATE INDEX IF NOT EXISTS printq_due ON printq(dest, state, next_at)")
+    _con.execute("UPDATE printq SET state='pending' WHERE state='printing'")   # cortado por un reinicio
+_con.close()
+
+def print_enqueue(code:str, pdf_path:Path, dest:str=None):
+    dest = dest or AUTO_PRINT_MODE
+    if dest not in PRINTERS: log_event("print_off", code=code, mode=AUTO_PRINT_MODE); return None
+    now = time.time()
+    with _print_lock, _print_db() as con:
+        con.execute("""INSERT INTO printq(code,pdf_path,dest,state,attempts,next_at,created,updated)
+                       VALUES(?,?,?,'pending',0,?,?,?)
+                       ON CONFLICT(code) DO UPDATE SET state='pending', attempts=0, next_at=excluded.next_at,
+                       pdf_path=excluded.pdf_path, dest=excluded.dest, last_error=NULL, created=excluded.created,
+                       started=NULL, finished=NULL, updated=excluded.updated
+                       WHERE printq.state IN ('done','failed')""",
+                    (code, str(pdf_path), dest, now, now, now))
+    index_mark(code, print_status="queued")
+    print_start(dest); _print_wake[dest].set()
+    return True
+
+def _print_claim(dest:str, n:int=1):
+    """Hasta n trabajos vencidos, en orden de llegada. Con imposición (n > 1) una hoja
+    incompleta se retiene hasta IMPOSE_WINDOW s después del trabajo más antiguo."""
+    now, hold = time.time(), None
+    with _print_lock, _print_db() as con:
+        rows = con.execute("""SELECT * FROM printq WHERE dest=? AND state='pending' AND next_at<=?
+                              ORDER BY created LIMIT ?""", (dest, now, n)).fetchall()
+        if 0 < len(rows) < n and now - rows[0]["created"] < IMPOSE_WINDOW:
+            hold, rows = rows[0]["created"] + IMPOSE_WINDOW, []   # aún puede llenarse la hoja
+        con.executemany("UPDATE printq SET state='printing', started=?, updated=? WHERE code=?",
+                        [(now, now, r["code"]) for r in rows])
+        nxt = con.execute("SELECT MIN(next_at) FROM printq WHERE dest=? AND state='pending'", (dest,)).fetchone()[0]
+    return [dict(r) for r in rows], (hold or nxt)
+
+def _print_done(row:dict, error:str=None, sheet:str=None):
+    now, attempts = time.time(), row["attempts"] + 1
+    if error is None: state, nxt = "done", now
+    elif attempts < PRINT_MAX_ATTEMPTS:
+        state, nxt = "pending", now + min(300.0, PRINT_BACKOFF * 2**(attempts-1)) * random.uniform(0.5, 1.5)
+    else: state, nxt = "failed", now
+    with _print_lock, _print_db() as con:
+        con.execute("""UPDATE printq SET state=?, attempts=?, next_at=?, last_error=?, finished=?, updated=?, sheet=?
+                       WHERE code=?""", (state, attempts, nxt, error, now if state != "pending" else None, now,
+                                         sheet, row["code"]))
+    if state == "done": index_mark(row["code"], printed=now, print_status="ok")
+    elif state == "failed": index_mark(row["code"], print_status="error")
+
+def print_sheet(rows):
+    """PDF de imposición con las postales de rows: reutiliza los JPEG de impresión ya
+    codificados (el print.jpg del derivado o el .jpg junto al PDF en caché), sin re-rasterizar.
+    Si falta alguno (desalojado por la cuota) se recompone desde el original; las filas que
+    ni así tienen JPEG se devuelven aparte con su error y la hoja sale con las demás.
+    -> (pdf, filas impuestas, [(fila, error)])."""
+    jpegs, placed, lost = [], [], []
+    for r in rows:
+        p = next((p for p in (derivative_path(r["code"], "print"), Path(r["pdf_path"]).with_suffix(".jpg"))
+                  if p.exists()), None)
+        try: p = p or print_jpeg(r["code"])
+        except Exception as e: lost.append((r, f"{r['code']}: {e}"[:200])); continue
+        if p is None: lost.append((r, f"sin JPEG de impresión para {r['code']}")); continue
+        jpegs.append(p.read_bytes()); placed.append(r)
+    if not placed: raise FileNotFoundError("; ".join(e for _, e in lost))
+    SHEETS.mkdir(exist_ok=True)
+    out = SHEETS / f"{datetime.now():%Y%m%d-%H%M%S}_{'-'.join(r['code'] for r in placed)}.pdf"
+    with timed("pdf"): write_pdf([sheet_page(jpegs, IMPOSE_UP)], out)
+    storage.note(out)
+    return out, placed, lost
+
+def _print_worker(dest:str):
+    wake = _print_wake[dest]
+    while True:
+        try:
+            rows, nxt = _print_claim(dest, max(1, IMPOSE_UP))
+            if not rows:
+                wake.wait(min(30.0, max(0.05, nxt - time.time())) if nxt else 30.0)
+                wake.clear(); continue
+            label, sheet, t0 = "+".join(r["code"] for r in rows), None, time.perf_counter()
+            try:
+                if IMPOSE_UP > 1:
+                    sheet, rows, lost = print_sheet(rows)
+                    for r, err in lost:   # sólo falla esa fila; el resto de la hoja se imprime
+                        _print_done(r, err)
+                        inc("postal_print_total", dest=dest, result="error")
+                        log_event("print", logging.WARNING, dest=dest, codes=r["code"], result="error", error=err)
+                    label = "+".join(r["code"] for r in rows)
+                    PRINTERS[dest](sheet, label)
+                else: PRINTERS[dest](Path(rows[0]["pdf_path"]), label)
+                for r in rows: _print_done(r, sheet=sheet and sheet.name)
+                inc("postal_print_total", len(rows), dest=dest, result="ok")
+                log_event("print", dest=dest, codes=label, result="ok", secs=round(time.perf_counter()-t0, 3),
+                          sheet=sheet and sheet.name)
+            except Exception as e:
+                for r in rows: _print_done(r, str(e)[:200])
+                inc("postal_print_total", len(rows), dest=dest, result="error")
+                log_event("print", logging.WARNING, dest=dest, codes=label, result="error",
+                          secs=round(time.perf_counter()-t0, 3), error=str(e)[:200])
+        except Exception as e:
+            log_event("print_worker_error", logging.ERROR, dest=dest, error=str(e)); time.sleep(1)
+
+def print_start(dest:str=None):
+    dest = dest or AUTO_PRINT_MODE
+    if dest not in PRINTERS or dest in _print_threads: return
+    with _print_lock:
+        if dest in _print_threads: return
+        _print_wake[dest] = threading.Event()
+        t = threading.Thread(target=_print_worker, args=(dest,), name=f"print-{dest}", daemon=True)
+        t.start(); _print_threads[dest] = t
+
+def _pct(xs, q):
+    return round(xs[min(len(xs)-1, int(q*len(xs)))], 3) if xs else None
+
+def print_queue_status(code:str=None, limit:int=100) -> dict:
+    """Profundidad por destino/estado y latencias (en cola, impresión, total) de los últimos trabajos."""
+    with _print_db() as con:
+        if code:
+            r = con.execute("SELECT * FROM printq WHERE code=?", (code,)).fetchone()
+            return dict(r) if r else None
+        counts: dict = {}
+        for r in con.execute("SELECT dest, state, COUNT(*) n FROM printq GROUP BY dest, state"):
+            counts.setdefault(r["dest"], {})[r["state"]] = r["n"]
+        oldest = con.execute("SELECT MIN(created) FROM printq WHERE state IN ('pending','printing')").fetchone()[0]
+        items = [dict(r) for r in con.execute("SELECT * FROM printq ORDER BY updated DESC LIMIT ?", (limit,))]
+    done = [i for i in items if i["state"] == "done" and i["started"] and i["finished"]]
+    for i in items:
+        i["wait_secs"] = round(i["started"] - i["created"], 3) if i["started"] else None
+        i["print_secs"] = round(i["finished"] - i["started"], 3) if i["started"] and i["finished"] else None
+    total = sorted(i["finished"] - i["created"] for i in done)
+    return {"depth": sum(n for d in counts.values() for st, n in d.items() if st in ("pending","printing")),
+            "counts": counts, "workers": sorted(_print_threads),
+            "impose": {"up": IMPOSE_UP, "paper": IMPOSE_PAPER, "window": IMPOSE_WINDOW,
+                       "sheets": len({i["sheet"] for i in items if i["sheet"]})},
+            "oldest_pending_secs": round(time.time() - oldest, 3) if oldest else None,
+            "latency": {"n": len(total), "p50": _pct(total, .5), "p95": _pct(total, .95),
+                        "wait_p50": _pct(sorted(i["wait_secs"] for i in done), .5),
+                        "print_p50": _pct(sorted(i["print_secs"] for i in done), .5)},
+            "items": items}
+
+def bench_impose(cards:int=24, send:bool=False, ups=(1, 2, 4)) -> list:
+    """Hojas/min y postales/min por modo de imposición con las postales ya renderizadas en PDFS
+    (o una sintética). send=True llama además al destino de AUTO_PRINT_MODE en serie, como su
+    hilo: apunta SUMATRA_PATH a un doble que simule la sobrecarga por trabajo de tu impresora."""
+    jpegs = [p.read_bytes() for p in sorted(PDFS.glob("*_print.jpg"))[:cards]]
+    if not jpegs: jpegs = [jpeg_bytes(compose("bench000", Image.new("RGB", (1600, 1200), (120, 140, 160))))]
+    jpegs = [jpegs[i % len(jpegs)] for i in range(cards)]
+    dest = PRINTERS.get(AUTO_PRINT_MODE) if send else None
+    tmp = SHEETS / "bench"; tmp.mkdir(parents=True, exist_ok=True)
+    out = []
+    try:
+        for up in ups:
+            t0, size = time.perf_counter(), 0
+            for i in range(0, cards, up):
+                path = tmp / f"{up}up_{i}.pdf"
+                write_pdf([card_page(jpegs[i]) if up == 1 else sheet_page(jpegs[i:i+up], up)], path)
+                size += path.stat().st_size
+                if dest: dest(path, f"bench{i}")
+            secs = time.perf_counter() - t0; sheets = math.ceil(cards/up)
+            out.append({"up": up, "cards": cards, "sheets": sheets, "secs": round(secs, 3),
+                        "sheets_per_min": round(sheets*60/secs, 1), "cards_per_min": round(cards*60/secs, 1),
+                        "pdf_bytes": size})
+    finally: shutil.rmtree(tmp, ignore_errors=True)
+    return out
 
 # ---------- Subida a web principal ----------
-def upload_remote(code:str, img_path:Path):
-    if not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN): return
+_http = threading.local()
+
+def http_session() -> requests.Session:
+    """Una sesión keep-alive por hilo (los workers reutilizan la conexión)."""
+    s = getattr(_http, "session", None)
+    if s is None:
+        s = _http.session = requests.Session()
+        s.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        s.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+    return s
+
+def remote_payload(code:str, img_path:Path) -> bytes:
+    # JPG 85 ya generado por render_derivatives; si falta, recomprime aquí
+    try:
+        rp = derivative_path(code, "remote")
+        if rp.exists(): return rp.read_bytes()
+        im = open_image(img_path, cover=_fit_cover(img_path, REMOTE_MAX_PX))
+        return _d_remote({"img": im})
+    except Exception:
+        return img_path.read_bytes()
+
+def post_remote(items) -> requests.Response:
+    """items: [(code, img_path), ...] en un solo POST (varios sólo con REMOTE_UPLOAD_BATCH>1)."""
+    headers = {"Authorization": f"Bearer {REMOTE_UPLOAD_TOKEN}"}
+    files = [("imagen", (f"{code}.jpg", remote_payload(code, Path(ip)), "image/jpeg")) for code, ip in items]
+    data  = [("codigo", code) for code, _ in items] + [("source", "browser")]
+    t0 = time.perf_counter()
     try:
-        # recomprime a JPG 85 para robustez
+        with timed("remote_upload"):
+            r = http_session().post(REMOTE_UPLOAD_URL, headers=headers, files=files, data=data, timeout=(10, 60))
+    except Exception as e:
+        inc("postal_remote_upload_total", len(items), result="error")
+        log_event("remote_upload", logging.WARNING, codes=[c for c,_ in items], result="error",
+                  secs=round(time.perf_counter()-t0, 3), error=str(e)[:200])
+        raise
+    inc("postal_remote_upload_total", len(items), result=r.status_code)
+    log_event("remote_upload", logging.INFO if r.ok else logging.WARNING, codes=[c for c,_ in items],
+              status=r.status_code, secs=round(time.perf_counter()-t0, 3), body=None if r.ok else (r.text or "")[:200])
+    return r
+
+def upload_remote(code:str, img_path:Path):
+    """Subida directa (un intento). El flujo normal pasa por la outbox."""
+    if not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN): return None
+    try: return post_remote([(code, img_path)]).ok
+    except Exception: return False   # ya registrado por post_remote
+
+# ---------- Outbox de subidas ----------
+# Cada subida queda en SQLite hasta que tu web la confirma: sobrevive a reinicios,
+# la drenan OUTBOX_WORKERS hilos fijos y los reintentos usan backoff exponencial con jitter.
+OUTBOX_DB = DATA / "outbox.sqlite3"
+_outbox_lock = threading.Lock()
+_outbox_wake = threading.Event()
+_outbox_threads: List[threading.Thread] = []
+
+def _outbox_db() -> sqlite3.Connection:
+    con = sqlite3.connect(OUTBOX_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    return con
+
+with _outbox_db() as _con:
+    _con.execute("PRAGMA journal_mode=WAL")
+    _con.execute("""CREATE TABLE IF NOT EXISTS outbox(
+        code TEXT PRIMARY KEY, img_path TEXT NOT NULL, state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, last_status INTEGER,
+        last_error TEXT, created REAL NOT NULL, updated REAL NOT NULL)""")
+    _con.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox(state, next_at)")
+_con.close()
+
+def outbox_enqueue(code:str, img_path:Path):
+    if not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN): return None
+    now = time.time()
+    with _outbox_lock, _outbox_db() as con:
+        n = con.execute("""INSERT INTO outbox(code,img_path,state,attempts,next_at,created,updated)
+                           VALUES(?,?,'pending',0,?,?,?)
+                           ON CONFLICT(code) DO UPDATE SET state='pending', attempts=0, next_at=excluded.next_at,
+                           img_path=excluded.img_path, updated=excluded.updated WHERE outbox.state='failed'""",
+                        (code, str(img_path), now, now, now)).rowcount
+        # el índice pasa a 'pending' antes de que un worker pueda tomar la fila (commit + wake),
+        # así su 'sent' nunca queda pisado; si ya estaba en cola o enviada, no se toca
+        if n: index_mark(code, remote_status="pending")
+    outbox_start(); _outbox_wake.set()
+    return True
+
+def _outbox_claim():
+    now = time.time()
+    with _outbox_lock, _outbox_db() as con:
+        rows = con.execute("""SELECT code, img_path, attempts FROM outbox WHERE state='pending' AND next_at<=?
+                              ORDER BY next_at LIMIT ?""", (now, max(1, REMOTE_UPLOAD_BATCH))).fetchall()
+        con.executemany("UPDATE outbox SET state='sending', updated=? WHERE code=?", [(now, r["code"]) for r in rows])
+        nxt = con.execute("SELECT MIN(next_at) FROM outbox WHERE state='pending'").fetchone()[0]
+    return [dict(r) for r in rows], nxt
+
+def _outbox_done(rows, status, error=None):
+    now = time.time()
+    retryable = status is None or status in (408, 429) or status >= 500
+    states = {}
+    with _outbox_lock, _outbox_db() as con:
+        for r in rows:
+            attempts = r["attempts"] + 1
+            if error is None: state, nxt = "sent", now
+            elif retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+                state = "pending"
+                nxt = now + min(300.0, OUTBOX_BACKOFF * 2**(attempts-1)) * random.uniform(0.5, 1.5)
+            else: state, nxt = "failed", now
+            con.execute("""UPDATE outbox SET state=?, attempts=?, next_at=?, last_status=?, last_error=?, updated=?
+                           WHERE code=?""", (state, attempts, nxt, status, error, now, r["code"]))
+            states[r["code"]] = state
+    for code, state in states.items(): index_mark(code, remote_status=state)
+
+def _outbox_worker():
+    while True:
         try:
-            im = Image.open(img_path).convert("RGB")
-            buf = io.BytesIO(); im.save(buf, "JPEG", quality=85, optimize=True)
-            data_bytes = buf.getvalue()
-        except Exception:
-            data_bytes = img_path.read_bytes()
-        headers = {"Authorization": f"Bearer {REMOTE_UPLOAD_TOKEN}"}
-        for attempt in range(1,4):
+            rows, nxt = _outbox_claim()
+            if not rows:
+                _outbox_wake.wait(min(30.0, max(0.05, nxt - time.time())) if nxt else 30.0)
+                _outbox_wake.clear(); continue
+            try:
+                r = post_remote([(x["code"], x["img_path"]) for x in rows])
+                _outbox_done(rows, r.status_code, None if r.ok else (r.text or "")[:200])
+            except Exception as e:
+                _outbox_done(rows, None, str(e)[:200])
+        except Exception as e:
+            log_event("outbox_worker_error", logging.ERROR, error=str(e)); time.sleep(1)
+
+def outbox_start():
+    if _outbox_threads: return
+    with _outbox_lock:
+        if _outbox_threads or not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN): return
+        # sin hilos nadie está enviando: lo que quedó en 'sending' (proceso caído) vuelve a la cola
+        with _outbox_db() as con: con.execute("UPDATE outbox SET state='pending' WHERE state='sending'")
+        for i in range(max(1, OUTBOX_WORKERS)):
+            t = threading.Thread(target=_outbox_worker, name=f"outbox-{i}", daemon=True)
+            t.start(); _outbox_threads.append(t)
+
+def outbox_status(code:str=None, state:str=None, limit:int=100) -> dict:
+    with _outbox_db() as con:
+        if code:
+            r = con.execute("SELECT * FROM outbox WHERE code=?", (code,)).fetchone()
+            return dict(r) if r else None
+        counts = {r["state"]: r["n"] for r in con.execute("SELECT state, COUNT(*) n FROM outbox GROUP BY state")}
+        q, args = "SELECT * FROM outbox", ()
+        if state: q, args = q + " WHERE state=?", (state,)
+        items = [dict(r) for r in con.execute(q + " ORDER BY updated DESC LIMIT ?", args + (limit,))]
+    return {"counts": counts, "workers": len(_outbox_threads), "items": items}
+
+def outbox_retry(code:str) -> bool:
+    with _outbox_lock, _outbox_db() as con:
+        n = con.execute("UPDATE outbox SET state='pending', next_at=?, updated=? WHERE code=? AND state='failed'",
+                        (time.time(), time.time(), code)).rowcount
+        if n: index_mark(code, remote_status="pending")
+    if n: outbox_start(); _outbox_wake.set()
+    return bool(n)
+
+# ---------- Trabajos (render/impresión en segundo plano) ----------
+# /upload sólo guarda el original y encola; composición y PDF corren en un pool
+# de procesos (Pillow no compite por el GIL) y la impresión/subida en hilos.
+STAGES = ("render", "print", "remote")
+JOBS: dict = {}
+JOBS_COND = threading.Condition()
+_render_pool = None
+_job_pool = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix="job")
+
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None and RENDER_WORKERS > 0:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _render_pool
+
+def _job_update(job_id:str, stage:str=None, **fields):
+    with JOBS_COND:
+        job = JOBS.get(job_id)
+        if not job: return
+        if stage: job["stages"][stage].update(fields)
+        else: job.update(fields)
+        job["version"] += 1; job["updated"] = time.time()
+        JOBS_COND.notify_all()
+
+def job_snapshot(job_id:str):
+    with JOBS_COND:
+        job = JOBS.get(job_id)
+        return json.loads(json.dumps(job)) if job else None
+
+def _run_stage(job_id:str, stage:str, fn, *args, in_process=False):
+    _job_update(job_id, stage, state="running")
+    t0 = time.time()
+    try:
+        pool = _get_render_pool() if in_process else None
+        res = pool.submit(fn, *args).result() if pool else fn(*args)
+    except Exception as e:
+        _job_update(job_id, stage, state="error", error=str(e), secs=round(time.time()-t0,3))
+        raise
+    finally: observe("postal_job_stage_seconds", time.time()-t0, stage=stage)
+    state = "skipped" if res is None else ("error" if res is False else "done")
+    _job_update(job_id, stage, state=state, secs=round(time.time()-t0,3))
+    return res
+
+def adopt_render(code:str, layout:str):
+    """Tras renderizar print+pdf con el layout vigente: /preview, /render_pdf e /imprimir
+    los sirven sin recomponer y el índice apunta con qué LAYOUT_VERSION se hicieron."""
+    if layout != PRINT_LAYOUT: return
+    cache_adopt(derivative_path(code, "print"), cache_path(code, "jpg"))
+    cache_adopt(derivative_path(code, "pdf"), cache_path(code, "pdf"))
+    index_mark(code, rendered=LAYOUT_VERSION, layout=layout,
+               print_bytes=derivative_path(code, "print").stat().st_size,
+               pdf_bytes=derivative_path(code, "pdf").stat().st_size)
+
+def _run_job(job_id:str, code:str, img_path:Path, layout:str, stages):
+    _job_update(job_id, state="running")
+    for s in STAGES:
+        if s not in stages: _job_update(job_id, s, state="skipped")
+    try:
+        if "render" in stages:
+            out = _run_stage(job_id, "render", render_derivatives, code, img_path, layout, in_process=True)
+            _job_update(job_id, "render", timings=out["timings"])
+            for f in out["files"].values(): storage.note(f)   # escritos en el worker
+            for st, secs in out["timings"].items(): observe("postal_stage_seconds", secs, stage=st)
+            if out.get("rss_peak_mb") is not None:
+                ADMISSION["worker_peak_rss_mb"] = max(ADMISSION["worker_peak_rss_mb"] or 0, out["rss_peak_mb"])
+            adopt_render(code, layout)
+        if "print" in stages:
             try:
-                files = {"imagen": (f"{code}.jpg", data_bytes, "image/jpeg")}
-                data  = {"codigo": code, "source":"browser"}
-                r = requests.post(REMOTE_UPLOAD_URL, headers=headers, files=files, data=data, timeout=60)
-                print("🌐 Subida remota:", r.status_code, (r.text or "")[:200])
-                if r.ok: break
+                if _run_stage(job_id, "print", auto_print, derivative_path(code, "pdf"), code):
+                    _job_update(job_id, "print", state="queued", print_url=f"/print-queue/{code}")
+                else: index_mark(code, print_status="off")
             except Exception as e:
-                print(f"❌ Subida remota intento {attempt}:", e)
-            time.sleep(2*attempt)
+                log_event("print_enqueue_error", logging.ERROR, code=code, error=str(e)); index_mark(code, print_status="error")
+        if "remote" in stages and _run_stage(job_id, "remote", outbox_enqueue, code, img_path):
+            _job_update(job_id, "remote", state="queued", outbox_url=f"/outbox/{code}")
+            index_mark(code, remote=time.time())   # remote_status lo lleva la outbox
+        _job_update(job_id, state="done")
     except Exception as e:
-        print("❌ Error subida remota:", e)
+        log_event("job_error", logging.ERROR, job_id=job_id, code=code, error=str(e))
+        _job_update(job_id, state="error", error=str(e))
+
+def pending_stages(code:str, reprint:bool=False) -> list:
+    """Etapas que faltan para un contenido ya conocido (imprimir sólo si se pide)."""
+    row = index_get(code) or {}
+    stages = []
+    if row.get("rendered") != LAYOUT_VERSION or not derivative_path(code, "pdf").exists(): stages.append("render")
+    if reprint: stages.append("print")
+    if REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN and not row.get("remote"): stages.append("remote")
+    return stages
+
+def active_job(code:str):
+    with JOBS_COND:
+        for j in JOBS.values():
+            if j["code"] == code and j["state"] in ("queued","running"): return j["id"]
+    return None
+
+def submit_job(code:str, img_path:Path, layout:str=None, stages=STAGES) -> str:
+    now = time.time()
+    job_id = uuid.uuid4().hex[:12]
+    cost = image_cost(img_path, layout) if "render" in stages else 0   # cuenta en render_backlog hasta renderizar
+    with JOBS_COND:
+        for k in [k for k,j in JOBS.items() if j["state"] in ("done","error") and now-j["updated"] > JOB_TTL]:
+            JOBS.pop(k, None)
+        JOBS[job_id] = {"id": job_id, "code": code, "state": "queued", "version": 0,
+                        "created": now, "updated": now, "cost": cost,
+                        "stages": {s: {"state": "pending"} for s in STAGES}}
+    _job_pool.submit(_run_job, job_id, code, img_path, layout or PRINT_LAYOUT, tuple(stages))
+    return job_id
+
+def wait_job(job_id:str, since:int=-1, timeout:float=25.0):
+    """Long-poll: espera a que el trabajo cambie de versión (o termine)."""
+    deadline = time.time() + timeout
+    with JOBS_COND:
+        while True:
+            job = JOBS.get(job_id)
+            if not job or job["version"] > since or job["state"] in ("done","error"): break
+            left = deadline - time.time()
+            if left <= 0: break
+            JOBS_COND.wait(left)
+    return job_snapshot(job_id)
+
+# ---------- Re-render masivo ----------
+# `python app_online_movil.py rerender`: regenera derivados de los originales de UPL
+# (p. ej. tras cambiar de layout) en un pool de procesos del tamaño de la máquina.
+# Se salta lo que ya está al día (índice con el LAYOUT_VERSION vigente y archivos más
+# nuevos que el original) y cada postal terminada se apunta en RERENDER_CKPT con el
+# sha1 del original y la versión: si se corta, la siguiente ejecución sigue por ahí.
+RERENDER_CKPT = DATA / "rerender.ckpt"
+
+def _read_ckpt() -> dict:
+    done = {}
+    if RERENDER_CKPT.exists():
+        for line in RERENDER_CKPT.read_text("utf-8").splitlines():
+            try: e = json.loads(line)
+            except ValueError: continue   # última línea a medias si se cortó escribiendo
+            done[e["code"]] = e
+    return done
+
+def _render_current(code:str, src:Path, row:dict, names) -> bool:
+    if row.get("rendered") != LAYOUT_VERSION: return False
+    mtime = src.stat().st_mtime
+    for n in names:
+        out = derivative_path(code, n)
+        if not out.exists() or out.stat().st_mtime < mtime: return False
+    return True
+
+def rerender(only=("print", "pdf", "thumb"), codes=None, since:float=None, until:float=None,
+             force:bool=False, workers:int=None, restart:bool=False, progress=None) -> dict:
+    """Re-renderiza con el layout vigente; force=True ignora lo que parece al día (no el checkpoint)."""
+    index_backfill()
+    names = derivative_names(only)
+    with _index_db() as con:
+        rows = {r["code"]: dict(r) for r in con.execute("SELECT code, sha1, created, rendered FROM postcards")}
+    if restart: RERENDER_CKPT.unlink(missing_ok=True)
+    ckpt = _read_ckpt()
+    todo, stats = [], {"total": 0, "skipped": 0, "resumed": 0, "done": 0, "errors": 0}
+    for src in sorted(UPL.glob("*.jpg")):
+        code = src.stem; row = rows.get(code, {})
+        if codes and code not in codes: continue
+        created = row.get("created") or src.stat().st_mtime
+        if (since is not None and created < since) or (until is not None and created >= until): continue
+        stats["total"] += 1
+        e = ckpt.get(code)
+        if e and e["sha1"] == row.get("sha1") and e["version"] == LAYOUT_VERSION and set(names) <= set(e["names"]):
+            stats["resumed"] += 1; continue
+        if not force and _render_current(code, src, row, names):
+            stats["skipped"] += 1; continue
+        todo.append((code, src, row.get("sha1")))
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else ThreadPoolExecutor(max_workers=1)
+    stage_secs, pending, it = {}, {}, iter(todo)
+    t0 = last = time.perf_counter()
+    try:
+        with open(RERENDER_CKPT, "a", encoding="utf-8") as ck:
+            while True:
+                while len(pending) < max(1, workers)*2:   # acotado: no encola 20k futuros de golpe
+                    nxt = next(it, None)
+                    if nxt is None: break
+                    code, src, sha1 = nxt
+                    pending[pool.submit(render_derivatives, code, src, PRINT_LAYOUT, names)] = (code, sha1)
+                if not pending: break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    code, sha1 = pending.pop(fut)
+                    try:
+                        out = fut.result()
+                        for f in out["files"].values(): storage.note(f)
+                        if "pdf" in names: adopt_render(code, PRINT_LAYOUT)
+                    except Exception as e:
+                        stats["errors"] += 1
+                        log_event("rerender_error", logging.ERROR, code=code, error=str(e)); continue
+                    for st, secs in out["timings"].items(): stage_secs[st] = stage_secs.get(st, 0) + secs
+                    ck.write(json.dumps({"code": code, "sha1": sha1, "version": LAYOUT_VERSION, "names": names}) + "\n")
+                    ck.flush()
+                    stats["done"] += 1
+                now = time.perf_counter()
+                if progress and now - last >= 5:
+                    last, n = now, stats["done"] + stats["errors"]
+                    rate = n / (now - t0)
+                    progress({"done": n, "todo": len(todo), "per_min": round(rate*60, 1),
+                              "eta_secs": round((len(todo) - n) / rate) if rate else None})
+    except KeyboardInterrupt:
+        stats["interrupted"] = True   # lo terminado ya está en el checkpoint
+        pool.shutdown(wait=True, cancel_futures=True)
+    else: pool.shutdown()
+    secs = time.perf_counter() - t0
+    return dict(stats, names=names, layout=PRINT_LAYOUT, layout_version=LAYOUT_VERSION, workers=workers,
+                secs=round(secs, 2), per_min=round(stats["done"]*60/secs, 1) if secs and stats["done"] else 0,
+                stage_ms={k: round(v*1000/stats["done"], 1) for k,v in sorted(stage_secs.items())} if stats["done"] else {})
+
+# ---------- Exportación ----------
+# PDF (una postal por página o contactos N-up con las miniaturas) y ZIP (originales +
+# postales) de un rango de fechas, generados por trozos con memoria constante: las
+# postales se leen de una en una del índice y los JPEG ya renderizados (_print.jpg,
+# _thumb.jpg) entran tal cual en el PDF o el ZIP, sin recodificar. Sólo para el operador
+# (ADMIN_TOKEN): sin él, cualquiera bajaría las fotos de todos los invitados.
+EXPORT_KINDS = ("cards", "contact", "zip")
+EXPORT_CHUNK = 256*1024   # trozos de la respuesta (iter_pdf produce muchos pequeños)
+
+def parse_when(v):
+    """AAAA-MM-DD (medianoche local) o epoch → epoch; None/'' → None."""
+    if not v: return None
+    try: return float(v)
+    except ValueError: return datetime.strptime(v, "%Y-%m-%d").timestamp()
+
+def export_rows(since:float=None, until:float=None, batch:int=500):
+    """Postales del rango en orden de creación, por páginas (created, code) del índice."""
+    last = (-1.0, "")
+    while True:
+        where, args = ["(created>? OR (created=? AND code>?))"], [last[0], last[0], last[1]]
+        if since is not None: where.append("created>=?"); args.append(since)
+        if until is not None: where.append("created<?"); args.append(until)
+        with _index_db() as con:
+            rows = [dict(r) for r in con.execute("SELECT * FROM postcards WHERE " + " AND ".join(where)
+                                                 + " ORDER BY created, code LIMIT ?", (*args, batch))]
+        for r in rows:
+            if (UPL / f"{r['code']}.jpg").exists(): yield r
+        if len(rows) < batch: return
+        last = (rows[-1]["created"], rows[-1]["code"])
+
+def _export_print(row:dict) -> bytes:
+    """JPEG de impresión: el derivado si está al día; si no, el de la caché (que compone si falta)."""
+    p = derivative_path(row["code"], "print")
+    if row.get("rendered") == LAYOUT_VERSION and p.exists(): return p.read_bytes()
+    return cache_get(row["code"], UPL / f"{row['code']}.jpg", "jpg")
+
+def _export_thumb(row:dict) -> bytes:
+    p = derivative_path(row["code"], "thumb")
+    if row.get("rendered") == LAYOUT_VERSION and p.exists(): return p.read_bytes()
+    return cache_get(row["code"], UPL / f"{row['code']}.jpg", "jpg", preview_size(THUMB_W))
+
+def _export_pages(rows, kind:str, n:int, stats:dict):
+    if kind == "cards":
+        for r in rows:
+            stats["cards"] += 1
+            yield card_page(_export_print(r))
+        return
+    sheet = []
+    for r in rows:
+        stats["cards"] += 1; sheet.append(_export_thumb(r))
+        if len(sheet) == n: yield sheet_page(sheet, n, IMPOSE_PAPER); sheet = []
+    if sheet: yield sheet_page(sheet, n, IMPOSE_PAPER)
+
+class _ZipSink:
+    """Destino sin seek para zipfile: acumula lo escrito y export_zip lo va entregando."""
+    def __init__(self): self.parts, self.size = [], 0
+    def write(self, b):
+        self.parts.append(bytes(b)); self.size += len(b); return len(b)
+    def flush(self): pass
+    def take(self) -> bytes:
+        out = b"".join(self.parts); self.parts, self.size = [], 0
+        return out
+
+def _iter_zip(rows, stats:dict):
+    import zipfile
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:   # JPEG: comprimir no gana nada
+        csv = ["code,created,width,height,orig_bytes"]
+        for r in rows:
+            code = r["code"]; stats["cards"] += 1
+            with open(UPL / f"{code}.jpg", "rb") as f, zf.open(f"originales/{code}.jpg", "w", force_zip64=True) as out:
+                for chunk in iter(lambda: f.read(EXPORT_CHUNK), b""):
+                    out.write(chunk)
+                    if sink.size >= EXPORT_CHUNK: yield sink.take()
+            zf.writestr(f"postales/{code}.jpg", _export_print(r))
+            csv.append(f"{code},{datetime.fromtimestamp(r['created']).isoformat(timespec='seconds')},"
+                       f"{r.get('width') or ''},{r.get('height') or ''},{r.get('orig_bytes') or ''}")
+            if sink.size >= EXPORT_CHUNK: yield sink.take()
+        zf.writestr("postales.csv", "\n".join(csv) + "\n")
+    yield sink.take()
+
+def iter_export(kind:str, since:float=None, until:float=None, n:int=20, stats:dict=None):
+    """Trozos (≈EXPORT_CHUNK) del PDF o ZIP de las postales del rango; stats["cards"] cuenta las incluidas."""
+    stats = stats if stats is not None else {}
+    stats.setdefault("cards", 0)
+    rows = export_rows(since, until)
+    chunks = _iter_zip(rows, stats) if kind == "zip" else iter_pdf(_export_pages(rows, kind, n, stats))
+    buf, size = [], 0
+    for c in chunks:
+        buf.append(c); size += len(c)
+        if size >= EXPORT_CHUNK: yield b"".join(buf); buf, size = [], 0
+    if buf: yield b"".join(buf)
+    inc("postal_exports_total", kind=kind)
 
 # ---------- UI ----------
+# Plantillas de las páginas: se compilan y renderizan una sola vez al arrancar (ver Recursos
+# estáticos); el CSS/JS va aparte como recurso cacheable con ?v=<etag>.
 INDEX_HTML = """<!doctype html>
 <meta name="viewport" content="width=device-width,initial-scale=1,maximum-scale=1">
 <title>Postales – Captura y AutoPrint</title>
-<style>
-:root{--card:#15171e;--muted:#9aa0a6;--text:#e6e9ee;--border:rgba(255,255,255,.08)}
-*{box-sizing:border-box}body{margin:0;background:#000;color:var(--text);font-family:system-ui,Segoe UI,Roboto,Arial}
-.wrap{max-width:980px;margin:0 auto;padding:18px}
-.card{background:var(--card);border:1px solid var(--border);border-radius:14px;padding:14px;box-shadow:0 8px 24px rgba(0,0,0,.35);margin:10px 0}
-.row{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
-.btn{padding:12px 14px;border-radius:10px;border:1px solid #fff;background:#000;color:#fff;font-weight:700;cursor:pointer}
-.input{padding:10px;border-radius:10px;border:1px solid var(--border);background:#0f1117;color:#e6e9ee;min-width:260px}
-.preview{width:100%;border-radius:14px;border:1px solid var(--border);background:#0f1117}
-a{color:#7acaff}
-</style>
+<link rel="stylesheet" href="{{ asset('index.css') }}">
 <div class="wrap">
   <h2>Postales – Captura y AutoPrint</h2>
   <div class="card">
@@ -188,7 +1545,7 @@ a{color:#7acaff}
       <input type="file" name="foto" accept="image/*" class="input" required>
       <button class="btn" type="submit">Subir</button>
     </form>
-    <small class="muted">Tras subir: genera código, crea PDF 7×5.5", <b>imprime</b> (modo: """+os.getenv("AUTO_PRINT_MODE","off")+""") y sube a tu web si está configurado.</small>
+    <small class="muted">Tras subir: genera código, crea PDF 7×5.5", <b>imprime</b> (modo: {{ print_mode }}) y sube a tu web si está configurado.</small>
   </div>
 
   <div class="card">
@@ -203,32 +1560,82 @@ a{color:#7acaff}
 
   <img id="prev" class="preview" alt="Previsualización">
 </div>
-<script>
-async function refresh(){
+<script src="{{ asset('index.js') }}"></script>
+"""
+
+INDEX_CSS = """:root{--card:#15171e;--muted:#9aa0a6;--text:#e6e9ee;--border:rgba(255,255,255,.08)}
+*{box-sizing:border-box}body{margin:0;background:#000;color:var(--text);font-family:system-ui,Segoe UI,Roboto,Arial}
+.wrap{max-width:980px;margin:0 auto;padding:18px}
+.card{background:var(--card);border:1px solid var(--border);border-radius:14px;padding:14px;box-shadow:0 8px 24px rgba(0,0,0,.35);margin:10px 0}
+.row{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
+.btn{padding:12px 14px;border-radius:10px;border:1px solid #fff;background:#000;color:#fff;font-weight:700;cursor:pointer}
+.input{padding:10px;border-radius:10px;border:1px solid var(--border);background:#0f1117;color:#e6e9ee;min-width:260px}
+.preview{width:100%;border-radius:14px;border:1px solid var(--border);background:#0f1117}
+a{color:#7acaff}
+"""
+
+INDEX_JS = """async function refresh(){
   const j = await (await fetch('/last')).json();
   document.getElementById('code').value = j.code||'';
   if(j.view_url){ const a=document.getElementById('viewlink'); a.href=j.view_url; a.style.display='inline-block'; }
-  const r = await fetch('/preview'); if(r.ok){ document.getElementById('prev').src = URL.createObjectURL(await r.blob()); }
+  const img = document.getElementById('prev');
+  const w = Math.round((img.clientWidth || innerWidth) * (devicePixelRatio || 1));
+  const r = await fetch('/preview?w=' + w); if(r.ok){ document.getElementById('prev').src = URL.createObjectURL(await r.blob()); }
 }
 document.getElementById('bPDF').onclick  = ()=> location='/render_pdf';
 document.getElementById('bPrint').onclick = async()=>{ const r=await fetch('/imprimir'); const j=await r.json(); alert(j.ok?'Imprimiendo…':'Error: '+(j.error||'')); };
 refresh();
-</script>
 """
 
+# capture.js y outbox.js salen de postal_common; aquí sólo la subida de la cola de capturas:
+# protocolo reanudable por trozos de /uploads, con un ticket por petición.
+OUTBOX_JS = outbox_js("""// ---- Protocolo de subida reanudable (/uploads, ver app_online_movil.py)
+async function api(url, opts){
+  const t = await (await fetch('/upload_ticket', {method: 'POST'})).json();
+  if (!t.ticket) throw new Error('no ticket');
+  return fetch(url + (url.includes('?') ? '&' : '?') + 'tk=' + encodeURIComponent(t.ticket), opts);
+}
+async function sha1hex(blob){
+  if (!(self.crypto && crypto.subtle)) return null;   // sólo en https/localhost
+  const d = await crypto.subtle.digest('SHA-1', await blob.arrayBuffer());
+  return [...new Uint8Array(d)].map(b => b.toString(16).padStart(2, '0')).join('');
+}
+async function upload(it){
+  const blob = it.blob;
+  if (it.upload_id){                                   // reanudar: ¿cuánto tiene ya el servidor?
+    const r = await api(`/uploads/${it.upload_id}`);
+    if (r.status === 404) it.upload_id = null; else it.sent = (await r.json()).offset;
+  }
+  if (!it.upload_id){
+    const r = await api('/uploads', {method: 'POST', headers: {'Content-Type': 'application/json'},
+                                     body: JSON.stringify({size: blob.size, sha1: await sha1hex(blob).catch(() => null)})});
+    const s = await r.json();
+    if (!s.upload_id) throw (r.status === 413 ? new Fatal(s.error) : new Error(s.error || r.status));
+    await outboxPut(Object.assign(it, {upload_id: s.upload_id, chunk: s.chunk_size, sent: 0}));
+  }
+  while (it.sent < blob.size){
+    const r = await api(`/uploads/${it.upload_id}?offset=${it.sent}`, {method: 'PUT', body: blob.slice(it.sent, it.sent + it.chunk)});
+    const j = await r.json();
+    if (r.status === 404){ it.upload_id = null; throw new Error('session_not_found'); }
+    if (r.status === 413) throw new Fatal(j.error);
+    if (!('offset' in j)) throw new Error(j.error || r.status);
+    it.sent = j.offset; await outboxPut(it);          // 409: el servidor indica el offset correcto
+  }
+  const r = await api(`/uploads/${it.upload_id}/commit`, {method: 'POST'});
+  const j = await r.json();
+  if (j.status === 'ok') return {code: j.codigo, view_url: j.view_url};
+  if (r.status === 404 || r.status === 422) it.upload_id = null;   // sesión perdida o hash distinto: de cero
+  if (r.status === 400 || r.status === 413) throw new Fatal(j.error);
+  if (r.status === 429) throw new Later(j.error, +r.headers.get('Retry-After'));
+  throw new Error(j.error || r.status);
+}
+
+""")
+
 CAPTURAR_HTML = """<!doctype html>
 <meta name="viewport" content="width=device-width,initial-scale=1,maximum-scale=1">
 <title>Capturar y subir</title>
-<style>
-body{margin:0;background:#000;color:#e6e9ee;font-family:system-ui,Segoe UI,Roboto,Arial}
-.wrap{max-width:520px;margin:0 auto;padding:16px}
-.card{background:#15171e;border:1px solid rgba(255,255,255,.08);border-radius:14px;padding:12px;margin:10px 0}
-.row{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
-button{padding:12px 14px;border-radius:10px;border:1px solid #fff;background:#000;color:#fff;font-weight:700}
-input{padding:10px;border-radius:10px;border:1px solid rgba(255,255,255,.14);background:#0f1117;color:#e6e9ee;width:100%}
-video,canvas{width:100%;max-height:360px;background:#000;border-radius:12px;border:1px solid rgba(255,255,255,.08)}
-.muted{color:#9aa0a6}.ok{color:#22c55e}
-</style>
+<link rel="stylesheet" href="{{ asset('capturar.css') }}">
 <div class=wrap>
   <h2>📷 Capturar y subir</h2>
   <div class=card>
@@ -239,7 +1646,6 @@ video,canvas{width:100%;max-height:360px;background:#000;border-radius:12px;bord
       <input type=file id=file accept="image/*">
     </div>
     <video id=v playsinline muted></video>
-    <canvas id=c style="display:none"></canvas>
     <p id=msg class=muted></p>
   </div>
 
@@ -250,52 +1656,259 @@ video,canvas{width:100%;max-height:360px;background:#000;border-radius:12px;bord
   </div>
 
   <div class=card>
-    <a id=lnk class=ok target=_blank style="display:none">➡️ Abrir en /view_image</a>
+    <label>Cola de subida</label>
+    <div id=list class=muted>Vacía</div>
   </div>
 </div>
-<script>
-const v=document.getElementById('v'), c=document.getElementById('c'), start=document.getElementById('start'),
+<script src="{{ asset('capture.js') }}"></script>
+<script src="{{ asset('outbox.js') }}"></script>
+<script src="{{ asset('capturar.js') }}"></script>
+"""
+
+CAPTURAR_CSS = """body{margin:0;background:#000;color:#e6e9ee;font-family:system-ui,Segoe UI,Roboto,Arial}
+.wrap{max-width:520px;margin:0 auto;padding:16px}
+.card{background:#15171e;border:1px solid rgba(255,255,255,.08);border-radius:14px;padding:12px;margin:10px 0}
+.row{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
+button{padding:12px 14px;border-radius:10px;border:1px solid #fff;background:#000;color:#fff;font-weight:700}
+input{padding:10px;border-radius:10px;border:1px solid rgba(255,255,255,.14);background:#0f1117;color:#e6e9ee;width:100%}
+video,canvas{width:100%;max-height:360px;background:#000;border-radius:12px;border:1px solid rgba(255,255,255,.08)}
+.muted{color:#9aa0a6}.ok{color:#22c55e}.err{color:#ff7b7b}
+.item{display:flex;gap:8px;align-items:center;justify-content:space-between;padding:6px 0;border-top:1px solid rgba(255,255,255,.06)}
+.item button{padding:4px 8px;font-weight:400}
+progress{width:120px}
+"""
+
+CAPTURAR_JS = """const v=document.getElementById('v'), start=document.getElementById('start'),
       shot=document.getElementById('shot'), file=document.getElementById('file'),
-      msg=document.getElementById('msg'), code=document.getElementById('code'), lnk=document.getElementById('lnk');
-
-async function ticket(){ const r=await fetch('/upload_ticket',{method:'POST'}); const j=await r.json(); if(!j.ticket) throw 'no ticket'; return j.ticket; }
-async function postBlob(blob){
-  const tk = await ticket();
-  const fd = new FormData();
-  if(code.value) fd.append('codigo', code.value.trim());
-  fd.append('foto', blob, 'cam.jpg');              // usamos /upload directo (más simple)
-  const r = await fetch('/upload?tk='+encodeURIComponent(tk), {method:'POST', body: fd});
-  const j = await r.json().catch(()=>null);
-  if(j && j.status==='ok' && j.view_url){ lnk.href=j.view_url; lnk.style.display='inline-block'; lnk.textContent='➡️ Ver '+j.codigo; }
-  msg.textContent = '✅ Subido '+(j && j.codigo ? j.codigo : '');
+      msg=document.getElementById('msg'), code=document.getElementById('code'), list=document.getElementById('list');
+
+// Cola en IndexedDB: la vacía el service worker (o esta página si no hay SW, p. ej. http sin TLS).
+// Capturar sólo encola; la subida va aparte y no bloquea la siguiente foto.
+const sw = navigator.serviceWorker;
+if(sw) sw.register('/outbox.js').catch(()=>{});
+async function flush(){
+  if(sw && sw.controller){
+    sw.controller.postMessage('flush');
+    const reg = await sw.ready; if(reg.sync) reg.sync.register('outbox').catch(()=>{});
+  }else pump();
+}
+const shown = new Map();
+function onOutbox(m){
+  if(m.item.deleted) shown.delete(m.item.id); else shown.set(m.item.id, m.item);
+  draw();
+}
+if(sw) sw.addEventListener('message', e=>{ if(e.data && e.data.type==='outbox') onOutbox(e.data); });
+// el código, el error y view_url vienen del servidor: texto con textContent y enlaces sólo http(s)
+function el(tag, cls, text){ const e = document.createElement(tag); if(cls) e.className = cls; if(text != null) e.textContent = text; return e; }
+function safeUrl(u){ try{ const x = new URL(u, location.href); return /^https?:$/.test(x.protocol) ? x.href : null; }catch(e){ return null; } }
+function draw(){
+  const its = [...shown.values()].sort((a,b)=>b.created-a.created).slice(0,20);
+  list.textContent = its.length ? '' : 'Vacía';
+  for(const it of its){
+    const d = el('div', 'item'), t = new Date(it.created).toLocaleTimeString();
+    d.append(el('span', null, t));
+    if(it.state==='done'){
+      d.append(el('span', 'ok', `✅ ${it.code}`));
+      const u = it.view_url && safeUrl(it.view_url);
+      if(u){ const a = el('a', 'ok', 'Ver'); a.href = u; a.target = '_blank'; a.rel = 'noopener'; d.append(a); }
+    }else if(it.state==='failed'){
+      const b = el('button', null, 'Reintentar'); b.onclick = ()=> outboxRetry(it.id).then(flush);
+      d.append(el('span', 'err', `❌ ${it.error||''}`), b);
+    }else if(it.state==='sending'){
+      const p = el('progress'); if(it.size) p.max = it.size; p.value = it.sent||0; d.append(p);
+    }else
+      d.append(el('span', 'muted', 'En cola' +
+               (it.next_at > Date.now() ? ` · reintento ${new Date(it.next_at).toLocaleTimeString()}` : '') +
+               (it.error ? ` (${it.error})` : '')));
+    list.appendChild(d);
+  }
+}
+async function enqueue(blob){
+  await outboxAdd(blob); flush();
+  msg.textContent = '📥 En cola';
+}
+outboxAll().then(all=>{ all.forEach(it=>shown.set(it.id, Object.assign(it,{blob:undefined}))); draw(); flush(); });
+addEventListener('online', flush);
+setInterval(flush, 30000);     // por si el SW se durmió esperando un backoff
+
+// Perfil del servidor + worker de recorte/escalado (respaldo: mismo código en este hilo)
+const profile = fetch('/capture_profile').then(r=>r.json());
+let worker = null, seq = 0; const waiting = {};
+try{
+  if(window.Worker && window.OffscreenCanvas){
+    worker = new Worker('/capture.js');
+    worker.onmessage = e=>{ const [ok,ko]=waiting[e.data.id]; delete waiting[e.data.id]; e.data.error ? ko(e.data.error) : ok(e.data); };
+  }
+}catch(_){ worker = null; }
+async function shrink(src){          // src: <video> o File
+  const p = await profile;
+  if(worker){
+    try{
+      const m = src instanceof Blob ? src : await createImageBitmap(src);
+      return await new Promise((ok,ko)=>{ const id=++seq; waiting[id]=[ok,ko];
+        worker.postMessage({id, src:m, profile:p}, m instanceof Blob ? [] : [m]); });
+    }catch(e){ worker = null; }
+  }
+  return encodeCapture(src, p);
 }
 
 start.onclick = async()=>{
   try{
-    const s = await navigator.mediaDevices.getUserMedia({video:{facingMode:'environment'}, audio:false});
+    const cam = (await profile).camera;
+    const s = await navigator.mediaDevices.getUserMedia({video:{facingMode:'environment',
+                width:{ideal:cam.width}, height:{ideal:cam.height}}, audio:false});
     v.srcObject=s; await v.play(); shot.disabled=false; msg.textContent='Cámara lista';
   }catch(e){ msg.textContent='No se pudo activar la cámara: '+e; }
 };
 
 shot.onclick = async()=>{
-  const w=v.videoWidth, h=v.videoHeight; if(!w||!h){ msg.textContent='Cámara no lista'; return; }
-  c.width=w; c.height=h; c.getContext('2d').drawImage(v,0,0,w,h);
-  c.toBlob(b=>postBlob(b).catch(e=>msg.textContent='❌ '+e),'image/jpeg',0.92);
+  if(!v.videoWidth){ msg.textContent='Cámara no lista'; return; }
+  try{ const r = await shrink(v); await enqueue(r.blob); }catch(e){ msg.textContent='❌ '+e; }
 };
 
 file.onchange = async(e)=>{
   const f=e.target.files[0]; if(!f) return;
-  postBlob(f).catch(e=>msg.textContent='❌ '+e);
+  let b = f;
+  try{ b = (await shrink(f)).blob; }catch(_){}     // formato que el navegador no decodifica: va tal cual
+  enqueue(b).catch(e=>msg.textContent='❌ '+e);
+  file.value = '';
 };
-</script>
 """
 
+VIEW_HTML = """<!doctype html><meta name=viewport content='width=device-width,initial-scale=1'>
+{% macro img(url) -%}
+<img src="{{ url }}&w={{ widths[widths|length // 2] }}" srcset="{% for w in widths %}{{ url }}&w={{ w }} {{ w }}w{{ ', ' if not loop.last }}{% endfor %}" sizes="(max-width:900px) 100vw, 900px" style="width:100%;border-radius:12px">
+{%- endmacro %}
+<div style='background:#000;color:#fff;font-family:Arial;padding:18px;max-width:900px;margin:auto'>
+  {% if not found %}<h3>❌ Código {{ code }} no encontrado</h3>{% else %}
+  <h2>📬 Código {{ code }}</h2>
+  {% if orig %}{{ img("/local_img/" ~ code ~ "?v=1") }}{% endif %}
+  {% if comp %}<h3>Postal compuesta</h3>{{ img("/local_comp/" ~ code ~ "?v=" ~ comp) }}{% endif %}
+  {% endif %}
+</div>
+"""
+
+# ---------- Recursos estáticos ----------
+# Páginas, CSS y JS se construyen una vez al arrancar: cuerpo + gzip (+ br si está brotli) + ETag.
+# Por petición sólo se elige la codificación o se responde 304.
+ASSETS = {}   # nombre → {"mimetype", "etag", "body": {codificación: bytes}}
+
+def add_asset(name:str, body, mimetype:str) -> dict:
+    raw = body.encode() if isinstance(body, str) else body
+    enc = {"identity": raw, "gzip": gzip.compress(raw, 9, mtime=0)}
+    if brotli: enc["br"] = brotli.compress(raw, quality=11)
+    ASSETS[name] = {"mimetype": mimetype, "etag": hashlib.sha1(raw).hexdigest()[:16], "body": enc}
+    return ASSETS[name]
+
+def asset_url(name:str) -> str:
+    return f"/assets/{name}?v={ASSETS[name]['etag']}"
+
+def send_asset(name:str, immutable:bool=False) -> Response:
+    a = ASSETS[name]
+    cc = "public, max-age=31536000, immutable" if immutable else "no-cache"
+    if request.if_none_match.contains_weak(a["etag"]):
+        r = Response(status=304)
+    else:
+        enc = next((e for e in ("br", "gzip") if e in a["body"] and request.accept_encodings[e]), "identity")
+        r = Response(a["body"][enc], mimetype=a["mimetype"])
+        if enc != "identity": r.headers["Content-Encoding"] = enc
+    r.set_etag(a["etag"], weak=True)   # débil: el mismo ETag vale para las tres codificaciones
+    r.headers["Cache-Control"] = cc; r.vary.add("Accept-Encoding")
+    return r
+
+def build_assets():
+    for name, body, mt in (("index.css", INDEX_CSS, "text/css"), ("index.js", INDEX_JS, "text/javascript"),
+                           ("capturar.css", CAPTURAR_CSS, "text/css"), ("capturar.js", CAPTURAR_JS, "text/javascript"),
+                           ("capture.js", CAPTURE_JS, "text/javascript"), ("outbox.js", OUTBOX_JS, "text/javascript")):
+        add_asset(name, body, mt)
+    env = app.jinja_env   # autoescape activo para from_string
+    add_asset("index.html", env.from_string(INDEX_HTML).render(asset=asset_url, print_mode=AUTO_PRINT_MODE), "text/html")
+    add_asset("capturar.html", env.from_string(CAPTURAR_HTML).render(asset=asset_url), "text/html")
+
+build_assets()
+VIEW_TMPL = app.jinja_env.from_string(VIEW_HTML)
+VIEW_REV = hashlib.sha1(VIEW_HTML.encode()).hexdigest()[:8]
+
+# ---------- Perfilado bajo demanda ----------
+# @profiled en las rutas calientes (postal_common.Profiler): si la petición trae X-Profile:
+# <PROFILE_TOKEN> o cae en PROFILE_SAMPLE, muestrea la pila del hilo de la petición y guarda
+# las pilas plegadas en DATA/profiles. Si no toca, el coste es una comparación.
+PROFILES = DATA / "profiles"
+profiler = Profiler(PROFILES, PROFILE_TOKEN, PROFILE_SAMPLE, PROFILE_INTERVAL_MS, PROFILE_KEEP)
+profiled = profiler.profiled
+
+def _profiles_denied():
+    if not profiler.allowed(): return jsonify(error="forbidden"), 403
+    return None
+
+# ---------- Almacenamiento ----------
+# postal_common.Storage: un hilo revisa el uso de DATA cada STORAGE_SWEEP_SECS. Si pasa de
+# STORAGE_QUOTA_MB (o al disco le quedan menos de STORAGE_MIN_FREE_MB) libera hasta el
+# STORAGE_LOW_PCT en dos tiers:
+#   1) lo regenerable (caché de render, variantes, derivados y hojas de PDFS, perfiles), el
+#      menos usado primero; nunca lo reciente (STORAGE_MIN_AGE) ni lo que espera impresión;
+#   2) originales con más de RETENTION_DAYS ya confirmados por la outbox (remote_status
+#      'sent'): se mueven a RETENTION_ARCHIVE o, sin archivo, se borran. Sin confirmar, nunca.
+# El uso sale del ledger DATA/storage.sqlite3, no de recorrer DATA: cada escritura de este
+# proceso llama a storage.note y cada lectura de caché/variante/derivado a storage.touch
+# (último uso explícito). Lo que escriben los workers de render se apunta en _run_job.
+def _tier_of(path:Path) -> str:
+    if path.name.startswith("."): return "other"   # temporales/parciales de una escritura en curso
+    parent = path.parent
+    if (parent == PDFS or parent == SHEETS or parent == PROFILES or parent == VARIANTS
+            or parent.parent == CACHE): return "derivative"
+    return "original" if parent == UPL and path.suffix == ".jpg" else "other"
+
+def _storage_protected() -> set:
+    """Códigos con impresión pendiente: su PDF, eprint y JPEG (imposición) siguen haciendo falta."""
+    with _print_db() as con:
+        return {r[0] for r in con.execute("SELECT code FROM printq WHERE state IN ('pending','printing')")}
+
+def _retirable_originals(now:float, limit:int) -> list:
+    with _index_db() as con:
+        rows = con.execute("""SELECT code, created FROM postcards WHERE remote_status='sent'
+                              AND archived IS NULL AND created<? ORDER BY created LIMIT ?""",
+                           (now - RETENTION_DAYS*86400, limit)).fetchall()
+    return [(r["code"], UPL / f"{r['code']}.jpg", r["created"]) for r in rows]
+
+def _storage_evicted(paths):
+    for code in {file_code(p) for p in paths if p.parent == PDFS}:
+        index_mark(code, rendered=None)   # pending_stages/rerender los ven por hacer
+
+storage = Storage(DATA, STORAGE_QUOTA_MB, STORAGE_MIN_FREE_MB, STORAGE_LOW_PCT, STORAGE_SWEEP_SECS, STORAGE_MIN_AGE,
+                  STORAGE_BATCH, STORAGE_IO_MB, RETENTION_DAYS, RETENTION_ARCHIVE, UPLOAD_CHUNK,
+                  tier_of=_tier_of, protected=_storage_protected, retirable=_retirable_originals,
+                  on_evict=_storage_evicted, on_retired=lambda code, dest, size: index_mark(code, archived=dest),
+                  before_sweep=lambda: gc_upload_sessions())
+STORAGE = storage.status
+storage_sweep, storage_start, storage_stats = storage.sweep, storage.start, storage.stats
+
 # ---------- Rutas ----------
+def _admin_denied():
+    got = request.headers.get("X-Admin-Token") or request.args.get("token") or ""
+    if not (ADMIN_TOKEN and hmac.compare_digest(got, ADMIN_TOKEN)): return jsonify(error="forbidden"), 403
+    return None
+
 @app.get("/")
-def index(): return render_template_string(INDEX_HTML)
+def index(): return send_asset("index.html")
 
 @app.get("/capturar")
-def capturar(): return render_template_string(CAPTURAR_HTML)
+def capturar(): return send_asset("capturar.html")
+
+@app.get("/assets/<name>")
+def asset(name):
+    if name not in ASSETS: return "404", 404
+    return send_asset(name, immutable=request.args.get("v") == ASSETS[name]["etag"])
+
+@app.get("/capture_profile")
+def capture_profile_view():
+    r = jsonify(capture_profile()); r.headers["Cache-Control"] = "no-cache"; return r
+
+@app.get("/capture.js")
+def capture_js(): return send_asset("capture.js")   # URL fija para new Worker()
+
+@app.get("/outbox.js")
+def outbox_js(): return send_asset("outbox.js")     # service worker: alcance "/" y URL fija
 
 @app.post("/upload_ticket")
 def upload_ticket():
@@ -308,111 +1921,467 @@ def last():
     return jsonify(code=session.get("last_code",""),
                    view_url=session.get("last_view_url",""))
 
+def _ticket_error(tk:str):
+    """None si el ticket de /upload_ticket es válido; si no, la respuesta 401."""
+    try: jwt.decode(tk, UPLOAD_JWT_SECRET, algorithms=["HS256"]); return None
+    except Exception as e: return jsonify(status="error", error=f"invalid_ticket:{e}"), 401
+
 @app.post("/upload")
+@profiled
 def upload():
     # opcional: valida ticket si llegó como query (desde /capturar)
     tk = request.args.get("tk","").strip()
-    if tk:
-        try: jwt.decode(tk, UPLOAD_JWT_SECRET, algorithms=["HS256"])
-        except Exception as e: return jsonify(status="error", error=f"invalid_ticket:{e}"), 401
+    if tk and (err := _ticket_error(tk)): return err
 
     f = request.files.get("foto")
     if not f: return redirect(url_for("index"))
-    raw = f.read()
-    if not raw: return redirect(url_for("index"))
+    try: code, img_path, _, dup = ingest_upload(f)
+    except ValueError as e:
+        if str(e) == "empty": return redirect(url_for("index"))
+        return _upload_error(e)
+
+    resp = _accept_upload(code, img_path, dup)
+    # Si la subida fue desde XHR de /capturar, devuelve JSON
+    return jsonify(resp) if tk else redirect(url_for("index"))
 
-    code = _sha8(raw)
+def _upload_error(e:ValueError):
+    """Respuesta a un ValueError de ingest/publish: 413 límites, 429 saturado, 400 el resto."""
+    inc("postal_uploads_total", result=str(e))
+    if str(e) == "busy":
+        ra = retry_after()
+        return jsonify(status="error", error="busy", retry_after=ra), 429, {"Retry-After": str(ra)}
+    return jsonify(status="error", error=str(e)), (413 if str(e).startswith("too_") else 400)
+
+def _accept_upload(code:str, img_path:Path, dup:bool) -> dict:
+    """Tras publicar el original: sesión, trabajo en segundo plano y respuesta JSON."""
     session["last_code"] = code
-    img_path = UPL / f"{code}.jpg"
-    img_path.write_bytes(raw)
     session["last_image"] = str(img_path)
+    inc("postal_uploads_total", result="duplicate" if dup else "new")
 
-    # Componer y PDF
-    comp = compose_square(code, img_path) if PRINT_LAYOUT=="square" else compose_fullbleed(code, img_path)
-    pdf_path = PDFS / f"{code}.pdf"
-    comp.save(PDFS / f"{code}_print.jpg", "JPEG", quality=92)
-    save_pdf(comp, pdf_path)
+    # Componer, PDF, auto-impresión y subida a tu web: en segundo plano.
+    # Contenido repetido: sólo lo que falte (reimprimir únicamente con reprint=1).
+    if dup:
+        reprint = request.values.get("reprint","") in ("1","true","yes")
+        job_id = active_job(code) if not reprint else None
+        if not job_id:
+            stages = pending_stages(code, reprint)
+            job_id = submit_job(code, img_path, stages=stages) if stages else None
+    else:
+        job_id = submit_job(code, img_path)
+    session["last_job"] = job_id
 
-    # Auto-impresión
-    try: auto_print(pdf_path, code)
-    except Exception as e: print("Impresión fallo:", e)
-
-    # Subida a tu web (si está configurado)
     view_url = ""
-    if REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN:
-        threading.Thread(target=upload_remote, args=(code, img_path), daemon=True).start()
-        if VIEW_BASE_URL:
-            view_url = f"{VIEW_BASE_URL.rstrip('/')}/{code}"
+    if REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN and VIEW_BASE_URL:
+        view_url = f"{VIEW_BASE_URL.rstrip('/')}/{code}"
     session["last_view_url"] = view_url
+    return dict(status="ok", codigo=code, view_url=view_url or "", duplicate=dup, job_id=job_id,
+                job_url=url_for("job_status", job_id=job_id) if job_id else "")
 
-    # Si la subida fue desde XHR de /capturar, devuelve JSON
-    if tk:
-        return jsonify(status="ok", codigo=code, view_url=view_url or "")
+# ---- Subida reanudable: POST /uploads → PUT /uploads/<id>?offset=N (trozos) → POST .../commit
+# Cada petición lleva ?tk= de /upload_ticket. Si se corta la conexión, GET /uploads/<id>
+# dice cuántos bytes ya tiene el servidor y el cliente sigue desde ahí.
+SESSIONS = UPL / ".sessions"
+SESSIONS.mkdir(exist_ok=True)
+_session_locks: dict = {}  # un lock por sesión: sus trozos se escriben en orden
+_session_hash: dict = {}   # id → (bytes hasheados, sha1 incremental); tras reiniciar se recalcula
 
-    return redirect(url_for("index"))
+def _session_lock(sid:str) -> threading.Lock:
+    with _cache_lock: return _session_locks.setdefault(sid, threading.Lock())
+
+def _upload_session(sid:str):
+    if not sid.isalnum(): return None
+    try: return json.loads((SESSIONS / f"{sid}.json").read_text())
+    except (FileNotFoundError, ValueError): return None
+
+def _upload_session_save(meta:dict):
+    meta["updated"] = time.time()
+    write_atomic(SESSIONS / f"{meta['id']}.json", json.dumps(meta).encode())
+
+def _upload_session_drop(sid:str):
+    _session_hash.pop(sid, None); _session_locks.pop(sid, None)
+    for ext in ("part", "json"):
+        try: (SESSIONS / f"{sid}.{ext}").unlink()
+        except FileNotFoundError: pass
+
+def gc_upload_sessions() -> int:
+    """Borra sesiones abandonadas (sin actividad en UPLOAD_SESSION_TTL)."""
+    n, now = 0, time.time()
+    for meta_path in SESSIONS.glob("*.json"):
+        try: stale = now - json.loads(meta_path.read_text())["updated"] > UPLOAD_SESSION_TTL
+        except Exception: stale = now - meta_path.stat().st_mtime > UPLOAD_SESSION_TTL
+        if stale: _upload_session_drop(meta_path.stem); n += 1
+    return n
+
+@app.post("/uploads")
+def upload_session_create():
+    if err := _ticket_error(request.args.get("tk","").strip()): return err
+    body = request.get_json(silent=True) or {}
+    size = int(body.get("size") or 0)
+    if size <= 0: return jsonify(status="error", error="empty"), 400
+    if size > MAX_UPLOAD_MB*1024*1024: return jsonify(status="error", error="too_large", max_mb=MAX_UPLOAD_MB), 413
+    gc_upload_sessions()
+    meta = {"id": uuid.uuid4().hex, "size": size, "offset": 0, "created": time.time(),
+            "sha1": (body.get("sha1") or "").lower() or None}
+    (SESSIONS / f"{meta['id']}.part").touch()
+    _upload_session_save(meta)
+    return jsonify(upload_id=meta["id"], offset=0, size=size, chunk_size=UPLOAD_SESSION_CHUNK), 201
+
+@app.get("/uploads/<sid>")
+def upload_session_status(sid):
+    if err := _ticket_error(request.args.get("tk","").strip()): return err
+    meta = _upload_session(sid)
+    if not meta: return jsonify(status="error", error="session_not_found"), 404
+    return jsonify(upload_id=sid, offset=meta["offset"], size=meta["size"])
+
+@app.put("/uploads/<sid>")
+def upload_session_chunk(sid):
+    if err := _ticket_error(request.args.get("tk","").strip()): return err
+    with _session_lock(sid):
+        meta = _upload_session(sid)
+        if not meta: return jsonify(status="error", error="session_not_found"), 404
+        offset = request.args.get("offset", type=int)
+        if offset != meta["offset"]:   # el cliente va desfasado: que siga desde aquí
+            return jsonify(status="error", error="offset_mismatch", offset=meta["offset"]), 409
+        part = SESSIONS / f"{sid}.part"
+        hashed, h = _session_hash.get(sid, (None, None))
+        if hashed != offset: h = hashlib.sha1() if offset == 0 else None
+        n = 0
+        with open(part, "r+b") as out:
+            out.seek(offset); out.truncate()
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK)
+                if not chunk: break
+                n += len(chunk)
+                if offset + n > meta["size"] or n > 2*UPLOAD_SESSION_CHUNK:
+                    out.truncate(offset)
+                    return jsonify(status="error", error="chunk_too_large", offset=offset), 413
+                out.write(chunk)
+                if h: h.update(chunk)
+        meta["offset"] = offset + n
+        if h: _session_hash[sid] = (meta["offset"], h)
+        _upload_session_save(meta)
+    return jsonify(upload_id=sid, offset=meta["offset"], size=meta["size"])
+
+@app.post("/uploads/<sid>/commit")
+@profiled
+def upload_session_commit(sid):
+    if err := _ticket_error(request.args.get("tk","").strip()): return err
+    with _session_lock(sid):
+        meta = _upload_session(sid)
+        if not meta: return jsonify(status="error", error="session_not_found"), 404
+        if meta.get("result"): return jsonify(meta["result"])   # commit repetido (se perdió la respuesta)
+        if meta["offset"] != meta["size"]:
+            return jsonify(status="error", error="incomplete", offset=meta["offset"], size=meta["size"]), 409
+        part = SESSIONS / f"{sid}.part"
+        hashed, h = _session_hash.get(sid, (None, None))
+        digest = h.hexdigest() if hashed == meta["size"] else _file_sha1(part)
+        expected = (request.get_json(silent=True) or {}).get("sha1") or meta.get("sha1")
+        if expected and expected.lower() != digest:
+            _upload_session_drop(sid)
+            return jsonify(status="error", error="hash_mismatch"), 422
+        try: code, img_path, _, dup = publish_upload(part, meta["size"], digest)
+        except ValueError as e:
+            if str(e) != "busy": _upload_session_drop(sid)   # 429: el cliente repite sólo el commit
+            return _upload_error(e)
+        meta["result"] = _accept_upload(code, img_path, dup)
+        _upload_session_save(meta)   # queda hasta el GC por si el cliente repite el commit
+        _session_hash.pop(sid, None)
+        try: part.unlink()
+        except FileNotFoundError: pass
+    return jsonify(meta["result"])
+
+def preview_size(w) -> tuple:
+    """?w= (px de pantalla) → tamaño del composite: múltiplo de PREVIEW_STEP, sin pasar de W×H."""
+    try: w = int(w)
+    except (TypeError, ValueError): return (W, H)
+    w = min(W, max(PREVIEW_STEP, -(-w // PREVIEW_STEP) * PREVIEW_STEP))
+    return _canvas(w / W)
+
+@functools.lru_cache(maxsize=16)
+def _blank_jpeg(size:tuple) -> bytes:
+    b = io.BytesIO(); Image.new("RGB", size, (30,34,42)).save(b, "JPEG", quality=85)
+    return b.getvalue()
 
 @app.get("/preview")
+@profiled
 def preview():
+    # ?w=N: se compone directamente a ~N px de ancho (p. ej. clientWidth × devicePixelRatio)
+    size = preview_size(request.args.get("w"))
     ip = session.get("last_image"); code = session.get("last_code","")
     if not ip or not Path(ip).exists():
-        blank = Image.new("RGB",(W,H),(30,34,42))
-        b = io.BytesIO(); blank.save(b,"JPEG",quality=85); b.seek(0)
-        return send_file(b, mimetype="image/jpeg")
-    comp = compose_square(code, Path(ip)) if PRINT_LAYOUT=="square" else compose_fullbleed(code, Path(ip))
-    b = io.BytesIO(); comp.save(b,"JPEG",quality=85); b.seek(0)
-    return send_file(b, mimetype="image/jpeg")
+        return send_file(io.BytesIO(_blank_jpeg(size)), mimetype="image/jpeg")
+    return send_file(io.BytesIO(cache_get(code, Path(ip), "jpg", size)), mimetype="image/jpeg")
 
 @app.get("/render_pdf")
+@profiled
 def render_pdf():
     ip = session.get("last_image"); code = session.get("last_code","PDF")
     if not ip or not Path(ip).exists(): return "Sin imagen", 400
-    comp = compose_square(code, Path(ip)) if PRINT_LAYOUT=="square" else compose_fullbleed(code, Path(ip))
-    out = PDFS / f"{code}.pdf"; save_pdf(comp, out)
-    return send_file(out, mimetype="application/pdf", as_attachment=True, download_name=out.name)
+    out = cache_file(code, Path(ip), "pdf")
+    return send_file(out, mimetype="application/pdf", as_attachment=True, download_name=f"{code}.pdf")
 
 @app.get("/imprimir")
+@profiled
 def imprimir():
     try:
         code = session.get("last_code","PRINT")
         ip   = session.get("last_image")
         if not ip or not Path(ip).exists(): return jsonify(ok=False, error="Sin imagen")
-        comp = compose_square(code, Path(ip)) if PRINT_LAYOUT=="square" else compose_fullbleed(code, Path(ip))
-        out = PDFS / f"{code}.pdf"; save_pdf(comp, out)
-        auto_print(out, code)
-        return jsonify(ok=True)
+        queued = auto_print(cache_file(code, Path(ip), "pdf"), code)
+        if not queued: return jsonify(ok=False, error="AUTO_PRINT_MODE=off")
+        return jsonify(ok=True, queued=True, status_url=f"/print-queue/{code}")
     except Exception as e:
         return jsonify(ok=False, error=str(e))
 
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify(status="error", error="too_large", max_mb=MAX_UPLOAD_MB), 413
+
+@app.before_request
+def _start_background():
+    outbox_start()  # drena lo pendiente de antes de un reinicio
+    print_start()
+    storage_start()
+
+# ---- Métricas por petición: duración por ruta, en vuelo y una línea de log con sus etapas
+metrics_registry.instrument(app)
+
+def metric_gauges():
+    """(nombre, tipo, ayuda, etiquetas, valor) que se leen en el momento del scrape."""
+    with JOBS_COND: jobs = [j["state"] for j in JOBS.values()]
+    used, n = render_backlog()
+    out = [("postal_render_backlog_bytes", "gauge", "Coste de los renders admitidos sin terminar", {}, used),
+           ("postal_decode_inflight_bytes", "gauge", "Bytes de decodificación en curso en este proceso", {}, _decode_inflight),
+           ("postal_admission_rejected_total", "counter", "Subidas rechazadas con 429", {}, ADMISSION["rejected"]),
+           ("postal_decode_waits_total", "counter", "Decodificaciones que esperaron presupuesto", {}, ADMISSION["decode_waits"]),
+           ("postal_render_cache_bytes", "gauge", "Bytes en la caché de render en memoria", {}, _cache_bytes)]
+    out += [("postal_jobs", "gauge", "Trabajos por estado", {"state": st}, jobs.count(st))
+            for st in ("queued", "running", "done", "error")]
+    for proc, mb in (("server", peak_rss_mb()), ("worker", ADMISSION["worker_peak_rss_mb"])):
+        out.append(("postal_peak_rss_bytes", "gauge", "Pico de memoria residente", {"process": proc},
+                    int(mb*2**20) if mb is not None else None))
+    with _print_db() as con:
+        out += [("postal_print_queue", "gauge", "Trabajos en la cola de impresión", {"dest": r["dest"], "state": r["state"]}, r["n"])
+                for r in con.execute("SELECT dest, state, COUNT(*) n FROM printq GROUP BY dest, state")]
+    with _outbox_db() as con:
+        out += [("postal_outbox", "gauge", "Subidas a la web principal en la outbox", {"state": r["state"]}, r["n"])
+                for r in con.execute("SELECT state, COUNT(*) n FROM outbox GROUP BY state")]
+    out += [("postal_storage_bytes", "gauge", "Bytes en DATA por subdirectorio (última pasada)", {"dir": d}, n)
+            for d, n in sorted(STORAGE["dirs"].items())]
+    out += [("postal_storage_tier_bytes", "gauge", "Bytes en DATA por tier (última pasada)", {"tier": t}, n)
+            for t, n in sorted(STORAGE["tiers"].items())]
+    out += [("postal_storage_free_bytes", "gauge", "Libre en el disco de DATA (última pasada)", {}, STORAGE["free_bytes"]),
+            ("postal_storage_evicted_bytes_total", "counter", "Bytes liberados por cuota/retención", {}, STORAGE["evicted_bytes"])]
+    out += [("postal_storage_evicted_total", "counter", "Archivos liberados por tier", {"tier": t}, n)
+            for t, n in STORAGE["evicted"].items()]
+    return out
+
+@app.get("/metrics")
+def metrics():
+    return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/profiles")
+def profiles_list():
+    if err := _profiles_denied(): return err
+    items = [dict(it, url=url_for("profile_get", name=it["name"])) for it in profiler.items()]
+    return jsonify(enabled=profiler.enabled, sample=PROFILE_SAMPLE,
+                   interval_ms=PROFILE_INTERVAL_MS, items=items)
+
+@app.get("/profiles/<name>")
+def profile_get(name):
+    if err := _profiles_denied(): return err
+    p = profiler.path(name)
+    if p is None: return jsonify(error="not_found"), 404
+    return send_file(p, mimetype="text/plain", as_attachment=request.args.get("download") == "1", download_name=name)
+
+@app.get("/print-queue")
+def print_queue_view():
+    return jsonify(print_queue_status(limit=min(int(request.args.get("limit", 100)), 1000)))
+
+@app.get("/print-queue/<code>")
+def print_queue_item(code):
+    item = print_queue_status(code=code)
+    if not item: return jsonify(error="not_found"), 404
+    return jsonify(item)
+
+@app.get("/outbox")
+def outbox_view():
+    return jsonify(outbox_status(state=request.args.get("state") or None,
+                                 limit=min(int(request.args.get("limit", 100)), 1000)))
+
+@app.get("/outbox/<code>")
+def outbox_item(code):
+    item = outbox_status(code=code)
+    if not item: return jsonify(error="not_found"), 404
+    return jsonify(item)
+
+@app.post("/outbox/<code>/retry")
+def outbox_item_retry(code):
+    return jsonify(ok=outbox_retry(code))
+
+@app.get("/api/postcards")
+def api_postcards():
+    if err := _admin_denied(): return err   # enumeraría todos los códigos (y con ellos las fotos)
+    a = request.args
+    try:
+        page = index_list(limit=max(1, min(int(a.get("limit", 50)), 500)), after=a.get("after",""),
+                          since=float(a["since"]) if a.get("since") else None,
+                          until=float(a["until"]) if a.get("until") else None,
+                          **{k: a.get(k) for k in POSTCARD_FILTERS})
+    except ValueError as e: return jsonify(error=f"bad_request:{e}"), 400
+    if page["next"]: page["next_url"] = url_for("api_postcards", **dict(a, after=page["next"]))
+    return jsonify(page)
+
+# /export/cards|contact|zip?since=&until=[&n=20]&token=: se descarga mientras se genera (chunked)
+@app.get("/export/<kind>")
+def export(kind):
+    if err := _admin_denied(): return err
+    a = request.args
+    if kind not in EXPORT_KINDS: return jsonify(error="not_found"), 404
+    try: since, until, n = parse_when(a.get("since")), parse_when(a.get("until")), int(a.get("n", 20))
+    except ValueError as e: return jsonify(error=f"bad_request:{e}"), 400
+    if next(export_rows(since, until, batch=1), None) is None: return jsonify(error="empty"), 404
+    tag = "_".join(datetime.fromtimestamp(t).strftime("%Y%m%d") for t in (since, until) if t is not None) or "todo"
+    ext = "zip" if kind == "zip" else "pdf"
+    return Response(iter_export(kind, since, until, max(1, min(n, 48))),
+                    mimetype="application/zip" if kind == "zip" else "application/pdf",
+                    headers={"Content-Disposition": f'attachment; filename="postales_{kind}_{tag}.{ext}"',
+                             "Cache-Control": "no-store"})
+
+@app.get("/api/postcards/stats")
+def api_postcards_stats(): return _admin_denied() or jsonify(index_stats())
+
+@app.get("/api/postcards/<code>")
+def api_postcard(code):
+    if err := _admin_denied(): return err
+    row = index_get(code.strip().lower())
+    if not row: return jsonify(error="not_found"), 404
+    return jsonify(row)
+
+@app.get("/cache/stats")
+def cache_stats_view(): return jsonify(cache_stats())
+
+@app.get("/storage/stats")
+def storage_stats_view(): return jsonify(storage_stats())
+
+@app.get("/admission/stats")
+def admission_stats_view(): return jsonify(admission_stats())
+
+@app.get("/layouts")
+def layouts_view(): return jsonify({"active": PRINT_LAYOUT, "layout_version": LAYOUT_VERSION, "layouts": LAYOUTS})
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    # ?wait=N&since=V → long-poll hasta que cambie la versión o pasen N segundos
+    wait = min(float(request.args.get("wait", 0) or 0), 60.0)
+    since = int(request.args.get("since", -1))
+    job = wait_job(job_id, since, wait) if wait > 0 else job_snapshot(job_id)
+    if not job: return jsonify(error="job_not_found"), 404
+    return jsonify(job)
+
+@app.get("/jobs/<job_id>/events")
+def job_events(job_id):
+    if not job_snapshot(job_id): return jsonify(error="job_not_found"), 404
+    def stream():
+        since, deadline = -1, time.time() + 120
+        while time.time() < deadline:
+            job = wait_job(job_id, since, 15.0)
+            if not job: break
+            if job["version"] == since:
+                yield ": keepalive\n\n"; continue
+            since = job["version"]
+            yield f"data: {json.dumps(job)}\n\n"
+            if job["state"] in ("done","error"): break
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control":"no-cache", "X-Accel-Buffering":"no"})
+
 # (opcional) vista local para pruebas
 @app.get("/view_image/<code>")
 def view_local(code):
     code = (code or "").strip().lower()
     orig = UPL / f"{code}.jpg"
-    comp = PDFS / f"{code}_print.jpg"
-    if not orig.exists() and not comp.exists():
-        return f"<h3 style='color:#fff;background:#000;padding:24px'>❌ Código {code} no encontrado</h3>", 404
-    html = f"""<!doctype html><meta name=viewport content='width=device-width,initial-scale=1'>
-    <div style='background:#000;color:#fff;font-family:Arial;padding:18px;max-width:900px;margin:auto'>
-      <h2>📬 Código {code}</h2>
-      {'<img src=\"/local_img/'+code+'?t=1\" style=\"width:100%;border-radius:12px\">' if orig.exists() else ''}
-      {'<h3>Postal compuesta</h3><img src=\"/local_comp/'+code+'?t=1\" style=\"width:100%;border-radius:12px\">' if comp.exists() else ''}
-    </div>"""
-    return render_template_string(html)
+    # el índice primero (búsqueda por clave); el disco sólo para un código que existe o que
+    # no tiene fila por ser anterior al índice (ver reindex)
+    found = index_get(code) is not None or orig.exists()
+    comp = print_jpeg(code) if found else None
+    ctx = dict(code=code, found=found, widths=VARIANT_WIDTHS, orig=found and orig.exists(),
+               comp=comp_version(comp) if comp else "")
+    # La página sólo depende de qué archivos hay y de la versión del composite
+    etag = hashlib.sha1(json.dumps([VIEW_REV, ctx]).encode()).hexdigest()[:16]
+    if found and request.if_none_match.contains_weak(etag):
+        r = Response(status=304)
+    else:
+        r = Response(VIEW_TMPL.render(**ctx), status=200 if found else 404, mimetype="text/html")
+    if found: r.set_etag(etag, weak=True); r.headers["Cache-Control"] = "no-cache"
+    return r
 
+# Los originales son direccionables por contenido (el código sale del SHA-1): inmutables.
 @app.get("/local_img/<code>")
 def local_img(code):
+    code = code.strip().lower()
     p = UPL / f"{code}.jpg"
     if not p.exists(): return "404", 404
-    return send_file(p, mimetype="image/jpeg")
+    return send_image(p, code, immutable=True)
 
+# El composite cambia si se re-renderiza con otro layout: inmutable sólo con ?v= vigente.
 @app.get("/local_comp/<code>")
 def local_comp(code):
-    p = PDFS / f"{code}_print.jpg"
-    if not p.exists(): return "404", 404
-    return send_file(p, mimetype="image/jpeg")
+    code = code.strip().lower()
+    p = print_jpeg(code)
+    if p is None: return "404", 404
+    ver = comp_version(p)
+    return send_image(p, f"{code}_comp_{ver}", immutable=request.args.get("v") == ver)
 
 # ---------- Arranque ----------
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["reindex"]:   # python app_online_movil.py reindex
+        print("🗂️ Postales añadidas al índice:", index_backfill()); sys.exit(0)
+    if sys.argv[1:2] == ["bench-impose"]:   # python app_online_movil.py bench-impose [postales] [--send]
+        args = [a for a in sys.argv[2:] if a != "--send"]
+        for r in bench_impose(int(args[0]) if args else 24, send="--send" in sys.argv):
+            print(f"{r['up']}-up: {r['sheets']} hojas en {r['secs']} s · {r['sheets_per_min']} hojas/min · "
+                  f"{r['cards_per_min']} postales/min · {r['pdf_bytes']//1024} KiB")
+        sys.exit(0)
+    if sys.argv[1:2] == ["rerender"]:   # python app_online_movil.py rerender [--only print,pdf] [--since 2025-06-01] …
+        import argparse
+        ap = argparse.ArgumentParser(prog="app_online_movil.py rerender",
+                                     description="Re-renderiza los derivados de los originales de UPL con el layout vigente.")
+        ap.add_argument("--only", default="print,pdf,thumb", help="derivados: " + ",".join(DERIVATIVES))
+        ap.add_argument("--codes", help="códigos separados por comas")
+        ap.add_argument("--since", type=parse_when, help="AAAA-MM-DD o epoch (creadas desde)")
+        ap.add_argument("--until", type=parse_when, help="AAAA-MM-DD o epoch (creadas antes de)")
+        ap.add_argument("--workers", type=int, help="procesos (por defecto, núcleos; 0 = en serie)")
+        ap.add_argument("--force", action="store_true", help="re-renderiza aunque parezca al día")
+        ap.add_argument("--restart", action="store_true", help="descarta el checkpoint y empieza de cero")
+        a = ap.parse_args(sys.argv[2:])
+        if set(a.only.split(",")) - set(DERIVATIVES): ap.error(f"--only: derivados válidos {','.join(DERIVATIVES)}")
+        r = rerender(tuple(a.only.split(",")), set(a.codes.split(",")) if a.codes else None, a.since, a.until,
+                     a.force, a.workers, a.restart,
+                     progress=lambda p: print(f"… {p['done']}/{p['todo']} · {p['per_min']} postales/min · ETA {p['eta_secs']} s"))
+        print(f"🖨️ {r['done']} re-renderizadas ({','.join(r['names'])}, layout {r['layout']} {r['layout_version']}) "
+              f"en {r['secs']} s con {r['workers']} procesos · {r['per_min']} postales/min · "
+              f"{r['skipped']} al día · {r['resumed']} ya en el checkpoint · {r['errors']} errores"
+              + (" · interrumpido" if r.get("interrupted") else ""))
+        if r["stage_ms"]: print("   ms/postal:", " ".join(f"{k}={v}" for k,v in r["stage_ms"].items()))
+        sys.exit(1 if r["errors"] or r.get("interrupted") else 0)
+    if sys.argv[1:2] == ["export"]:   # python app_online_movil.py export cards|contact|zip salida [--since …]
+        import argparse
+        ap = argparse.ArgumentParser(prog="app_online_movil.py export",
+                                     description="PDF (una por página o contactos N-up) o ZIP de las postales de un rango.")
+        ap.add_argument("kind", choices=EXPORT_KINDS)
+        ap.add_argument("out", type=Path)
+        ap.add_argument("--since", type=parse_when, help="AAAA-MM-DD o epoch (creadas desde)")
+        ap.add_argument("--until", type=parse_when, help="AAAA-MM-DD o epoch (creadas antes de)")
+        ap.add_argument("--n", type=int, default=20, help="miniaturas por hoja de contactos")
+        a = ap.parse_args(sys.argv[2:])
+        st, t0 = {}, time.perf_counter()
+        part = a.out.with_name(f".{a.out.name}.{uuid.uuid4().hex[:8]}.part")
+        with open(part, "wb") as f:
+            for chunk in iter_export(a.kind, a.since, a.until, max(1, a.n), st): f.write(chunk)
+        os.replace(part, a.out)
+        print(f"📦 {st['cards']} postales → {a.out} ({a.out.stat().st_size//1024} KiB) en {time.perf_counter()-t0:.1f} s")
+        sys.exit(0)
     from waitress import serve
-    print(f"🚀 Sirviendo app_online_movil en http://{HOST}:{PORT}  DATA={DATA}")
+    log_event("start", url=f"http://{HOST}:{PORT}", data=str(DATA), render_workers=RENDER_WORKERS,
+              print_mode=AUTO_PRINT_MODE)
     serve(app, host=HOST, port=PORT)
@@ -9,16 +9,21 @@
 # - Respuesta con view_url = VIEW_BASE_URL/<codigo>
 # -------------------------------------------------------------
 
-import os, io, json, base64, hashlib, subprocess, threading, time
+import os, io, sys, json, base64, hashlib, logging, math, random, sqlite3, subprocess, threading, time, uuid
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
-from flask import Flask, request, jsonify, render_template_string, send_file, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template_string, send_file, redirect, url_for
 from waitress import serve
 from PIL import Image, ImageOps
-from fpdf import FPDF
 import requests
 
+sys.path.insert(0, str(Path(__file__).resolve().parent))  # postal_common.py va junto a este archivo
+from postal_common import (CAPTURE_JS, BudgetEncoder, Metrics, Profiler, Storage, card_page, iter_pdf, log_event,
+                           outbox_js, setup_logging, write_pdf)
+
 # ----------- ENV -----------
 PORT                = int(os.getenv("PORT", "5000"))
 HOST                = os.getenv("HOST", "0.0.0.0")
@@ -27,6 +32,9 @@ HOST                = os.getenv("HOST", "0.0.0.0")
 AUTO_PRINT_MODE     = os.getenv("AUTO_PRINT_MODE", "off").lower()  # sumatra|email|off
 PRINT_LAYOUT        = os.getenv("PRINT_LAYOUT", "square").lower()  # square|fullbleed
 SUMATRA_PATH        = os.getenv("SUMATRA_PATH", r"C:\Program Files\SumatraPDF\SumatraPDF.exe")
+PRINT_MAX_ATTEMPTS  = int(os.getenv("PRINT_MAX_ATTEMPTS", "5"))
+PRINT_BACKOFF       = float(os.getenv("PRINT_BACKOFF", "5"))   # s; se duplica por intento (tope 300 s)
+PRINT_TIMEOUT       = int(os.getenv("PRINT_TIMEOUT", "120"))   # s máx. de SumatraPDF por trabajo
 
 # subida
 REMOTE_UPLOAD_URL   = os.getenv("REMOTE_UPLOAD_URL", "").strip()
@@ -38,9 +46,20 @@ UPLOAD_JWT_SECRET   = os.getenv("UPLOAD_JWT_SECRET", "change_this_secret").strip
 PRINTER_EMAIL       = os.getenv("PRINTER_EMAIL", "").strip()
 SENDER_EMAIL        = os.getenv("SENDER_EMAIL", "").strip()
 SENDGRID_API_KEY    = os.getenv("SENDGRID_API_KEY", "").strip()
+SENDGRID_HOST       = os.getenv("SENDGRID_HOST", "https://api.sendgrid.com")  # p. ej. doble HTTP local en pruebas
 
 EMAIL_ENABLED       = bool(PRINTER_EMAIL and SENDER_EMAIL and SENDGRID_API_KEY)
 
+# adjunto ePrint con presupuesto de bytes (0 = preset fijo: ~1000 px, calidad 60)
+EPRINT_BUDGET_KB    = int(os.getenv("EPRINT_BUDGET_KB", "0"))
+EPRINT_MIN_QUALITY  = int(os.getenv("EPRINT_MIN_QUALITY", "50"))   # suelo de calidad JPEG
+EPRINT_MIN_PX       = int(os.getenv("EPRINT_MIN_PX", "1000"))      # suelo de resolución (lado mayor)
+EPRINT_COLOR        = os.getenv("EPRINT_COLOR", "gray").lower()    # gray | color (perfil de la impresora)
+
+# trabajos en segundo plano (procesos de render; 0 = en hilo, sin procesos)
+RENDER_WORKERS      = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+JOB_TTL             = int(os.getenv("JOB_TTL", "3600"))  # s que se guarda un trabajo terminado
+
 # ---- paths ----
 BASE_DIR = Path(__file__).resolve().parent.parent  # /app/.. (raíz del repo)
 DATA_DIR = BASE_DIR / "data"
@@ -49,160 +68,620 @@ OUT_DIR  = DATA_DIR / "out"
 for p in (DATA_DIR, UPLOADS, OUT_DIR):
     p.mkdir(parents=True, exist_ok=True)
 
+# límites de subida (se aplican mientras se recibe, en trozos)
+MAX_UPLOAD_MB       = int(os.getenv("MAX_UPLOAD_MB", "40"))
+MAX_UPLOAD_PIXELS   = int(os.getenv("MAX_UPLOAD_PIXELS", "60000000"))  # 60 MP
+UPLOAD_CHUNK        = 256 * 1024
+UPLOAD_FORMATS      = {"JPEG", "MPO", "PNG", "WEBP"}  # según la cabecera, no la extensión
+Image.MAX_IMAGE_PIXELS = MAX_UPLOAD_PIXELS           # Pillow rechaza bombas (>2×) al abrir; hasta 2× sólo avisa
+                                                     # y lo para la comprobación de píxeles de ingest_upload
+
+# admisión por memoria (coste = bytes RGB decodificados, estimado con la cabecera)
+RENDER_BACKLOG_MB   = int(os.getenv("RENDER_BACKLOG_MB", "2048"))  # renders admitidos sin terminar; si no cabe → 429
+DECODE_BUDGET_MB    = int(os.getenv("DECODE_BUDGET_MB", "512"))    # decodificaciones a la vez por proceso; el resto espera
+
+# decodificación rápida (DCT-scaling de libjpeg + reduce entero); FAST_DECODE=0 para comparar
+FAST_DECODE = os.getenv("FAST_DECODE", "1") != "0"
+
+# perfil de captura (/capture_profile): /capturar recorta y escala a esto en el navegador
+CAPTURE_BPP         = float(os.getenv("CAPTURE_BPP", "3"))          # presupuesto del JPG (bits/píxel)
+CAPTURE_QUALITY     = float(os.getenv("CAPTURE_QUALITY", "0.92"))   # calidad inicial; baja hasta caber
+CAPTURE_MIN_QUALITY = float(os.getenv("CAPTURE_MIN_QUALITY", "0.7"))
+
+# almacenamiento: cuota de DATA_DIR y retención de originales (ver "Almacenamiento")
+# desactivado por defecto: se activa con STORAGE_QUOTA_MB y/o STORAGE_MIN_FREE_MB
+STORAGE_QUOTA_MB    = int(os.getenv("STORAGE_QUOTA_MB", "0"))          # 0 = sin cuota
+STORAGE_MIN_FREE_MB = int(os.getenv("STORAGE_MIN_FREE_MB", "0"))       # libre mínimo en el disco; 0 = no mirar
+STORAGE_LOW_PCT     = float(os.getenv("STORAGE_LOW_PCT", "90"))        # al pasarse, se libera hasta este %
+STORAGE_SWEEP_SECS  = float(os.getenv("STORAGE_SWEEP_SECS", "60"))
+STORAGE_MIN_AGE     = float(os.getenv("STORAGE_MIN_AGE", "600"))       # s: lo usado hace menos no se desaloja
+STORAGE_BATCH       = int(os.getenv("STORAGE_BATCH", "200"))           # archivos máx. por pasada
+STORAGE_IO_MB       = float(os.getenv("STORAGE_IO_MB", "20"))          # MB/s máx. al archivar originales
+RETENTION_DAYS      = float(os.getenv("RETENTION_DAYS", "0"))          # originales ya subidos; 0 = para siempre
+RETENTION_ARCHIVE   = os.getenv("RETENTION_ARCHIVE", "").strip()       # dir de archivo; vacío = borrar
+
 # tamaño postal (en píxeles si 300 DPI, 7x5.5 in → 2100x1650)
 PX_W, PX_H = 2100, 1650  # landscape
 
+# logs estructurados (una línea JSON por evento) y /metrics en formato Prometheus
+LOG_LEVEL           = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# perfilado bajo demanda de /subir (DATA_DIR/profiles, ver /profiles)
+PROFILE_TOKEN       = os.getenv("PROFILE_TOKEN", "").strip()        # cabecera X-Profile: <token> → se perfila
+PROFILE_SAMPLE      = float(os.getenv("PROFILE_SAMPLE", "0"))       # fracción de peticiones al azar (0 = ninguna)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # periodo de muestreo de la pila
+PROFILE_KEEP        = int(os.getenv("PROFILE_KEEP", "50"))          # perfiles que se conservan
+
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024 + 64 * 1024  # + cabeceras multipart
 
 # =============================================================
 # Utilidades
 # =============================================================
 
+# -------- Métricas y logs --------
+# Registro y logger compartidos con app/ (postal_common): histogramas por etapa (timed)
+# y por ruta, contadores de resultados y gauges que se calculan al leer (ver
+# metric_gauges). Cada evento sale como una línea JSON en el logger "postal".
+
+log = setup_logging(LOG_LEVEL)
+metrics_registry = Metrics(gauges=lambda: metric_gauges())
+observe, inc, timed, stage_trace = (metrics_registry.observe, metrics_registry.inc,
+                                    metrics_registry.timed, metrics_registry.stage_trace)
+metrics_text = metrics_registry.text
+
 def sha1_8(b: bytes) -> str:
     return hashlib.sha1(b).hexdigest()[:8]
 
-def open_exif(path: Path) -> Image.Image:
+def ingest_upload(f):
+    """
+    Copia el archivo subido por trozos a UPLOADS calculando el SHA-1 al vuelo y
+    aplicando MAX_UPLOAD_MB / MAX_UPLOAD_PIXELS; lo publica como <code>.jpg con un
+    rename atómico. Devuelve (code, ruta, sha1) o lanza ValueError con el motivo
+    ("Busy" si el render no cabe ahora en RENDER_BACKLOG_MB).
+    """
+    h = hashlib.sha1()
+    size = 0
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    tmp = UPLOADS / f".{uuid.uuid4().hex}.part"
+    try:
+        with open(tmp, "wb") as out:
+            while True:
+                chunk = f.stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError("Too large")
+                h.update(chunk)
+                out.write(chunk)
+        if not size:
+            raise ValueError("Empty")
+        try:
+            with Image.open(tmp) as im:  # sólo cabecera, sin decodificar
+                w, hh = im.size
+                fmt = im.format
+        except Image.DecompressionBombError:
+            raise ValueError("Too many pixels")
+        except Exception:
+            raise ValueError("Invalid image")
+        if fmt not in UPLOAD_FORMATS or not (w and hh):
+            raise ValueError("Invalid image")
+        if w * hh > MAX_UPLOAD_PIXELS:
+            raise ValueError("Too many pixels")
+        digest = h.hexdigest()
+        # Sin índice de postales: el mismo contenido da el mismo código y se vuelve a
+        # componer e imprimir; la deduplicación (y el código largo si otro contenido
+        # ya ocupa el prefijo) sólo existe en app/app_online_movil.py.
+        code = digest[:8]
+        if not render_admit(code, decode_cost(w, hh, fmt, print_cover(PRINT_LAYOUT))):
+            raise ValueError("Busy")
+        jpg_path = UPLOADS / f"{code}.jpg"
+        os.replace(tmp, jpg_path)
+        storage.note(jpg_path)
+        return code, jpg_path, digest
+    finally:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM, 5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+def open_exif(path: Path, cover=None) -> Image.Image:
+    """
+    cover=(tw, th): tamaño (ya orientado) que la imagen debe seguir cubriendo.
+    Con FAST_DECODE pide a libjpeg la menor escala DCT que lo cubre, aplica un
+    reduce() entero dejando 2× de margen para el LANCZOS final y orienta al final.
+    La decodificación ocupa su coste en decode_slot (espera si el proceso va justo).
+    """
     im = Image.open(path)
-    return ImageOps.exif_transpose(im).convert("RGB")
+    with decode_slot(decode_cost(im.width, im.height, im.format, cover)), timed("decode"):
+        return _decode(im, cover)
+
+def _decode(im: Image.Image, cover) -> Image.Image:
+    if not (FAST_DECODE and cover):
+        with timed("exif"):
+            im = ImageOps.exif_transpose(im)
+        return im.convert("RGB")
+    orient = im.getexif().get(0x0112, 1)
+    tw, th = cover
+    if orient in (5, 6, 7, 8):  # coordenadas del archivo (sin rotar)
+        tw, th = th, tw
+    r = min(im.width / tw, im.height / th)
+    if r > 1 and im.format == "JPEG":
+        im.draft("RGB", (math.ceil(im.width / r), math.ceil(im.height / r)))
+    im = im.convert("RGB")
+    k = int(min(im.width / tw, im.height / th) // 2)
+    if k >= 2:
+        im = im.reduce(k)
+    if orient in EXIF_TRANSPOSE:
+        with timed("exif"):
+            im = im.transpose(EXIF_TRANSPOSE[orient])
+    return im
 
 def resize_cover(img: Image.Image, tw: int, th: int) -> Image.Image:
     w, h = img.size
     scale = max(tw / w, th / h)
     nw, nh = int(w * scale), int(h * scale)
-    im = img.resize((nw, nh), Image.LANCZOS)
+    with timed("resize"):
+        im = img.resize((nw, nh), Image.LANCZOS)
     left = (nw - tw) // 2
     top  = (nh - th) // 2
     return im.crop((left, top, left + tw, top + th))
 
+def print_cover(layout: str) -> tuple:
+    """Tamaño (w, h) que la foto debe cubrir en la postal: el cuadrado del square o el lienzo entero."""
+    if layout == "fullbleed":
+        return (PX_W, PX_H)
+    margin_x, margin_y = 180, 120   # área destino del square (márgenes amplios)
+    side = min(PX_W - 2 * margin_x, PX_H - 2 * margin_y)
+    return (side, side)
+
+def capture_profile(layout: str = None) -> dict:
+    """Lo que el navegador debe subir: píxeles justos para 300 DPI, ya recortados al aspecto del layout."""
+    layout = layout or PRINT_LAYOUT
+    tw, th = print_cover(layout)
+    return {"layout": layout, "width": tw, "height": th, "dpi": 300, "anchor": "center",
+            "mime": "image/jpeg", "max_bytes": int(tw * th * CAPTURE_BPP / 8),
+            "quality": CAPTURE_QUALITY, "min_quality": CAPTURE_MIN_QUALITY,
+            "camera": {"width": max(tw, math.ceil(th * 16 / 9)), "height": th}}  # 16:9 que cubra el recorte
+
 def compose_image(img_path: Path, layout: str) -> Image.Image:
     """
     Devuelve imagen compuesta 2100x1650:
     - square: recorte cuadrado centrado, encajado y con márgenes
     - fullbleed: a sangre (cover) ocupando todo
     """
+    with timed("compose"):  # incluye decode y resize
+        return _compose(img_path, layout)
+
+def _compose(img_path: Path, layout: str) -> Image.Image:
     base = Image.new("RGB", (PX_W, PX_H), (255, 255, 255))
-    im = open_exif(img_path)
 
     if layout == "fullbleed":
+        im = open_exif(img_path, cover=(PX_W, PX_H))
         comp = resize_cover(im, PX_W, PX_H)
         base.paste(comp, (0, 0))
         return base
 
     # square
+    side, _ = print_cover(layout)
+    im = open_exif(img_path, cover=(side, side))
     sq = min(im.width, im.height)
     cx = (im.width - sq) // 2
     cy = (im.height - sq) // 2
     im_sq = im.crop((cx, cy, cx + sq, cy + sq))
-    # área destino (márgenes amplios)
-    margin_x, margin_y = 180, 120
-    side = min(PX_W - 2 * margin_x, PX_H - 2 * margin_y)
-    im_sq = im_sq.resize((side, side), Image.LANCZOS)
+    with timed("resize"):
+        im_sq = im_sq.resize((side, side), Image.LANCZOS)
     x = (PX_W - side) // 2
     y = (PX_H - side) // 2
     base.paste(im_sq, (x, y))
     return base
 
-def save_pdf(img: Image.Image, pdf_path: Path):
-    """7x5.5 in landscape, sin márgenes"""
-    pdf = FPDF(orientation='L', unit='in', format=(7.0, 5.5))
-    pdf.add_page()
-    tmp_jpg = pdf_path.with_suffix(".tmp.jpg")
-    img.save(tmp_jpg, "JPEG", quality=92)
-    pdf.image(str(tmp_jpg), x=0, y=0, w=7.0, h=5.5)
-    pdf.output(str(pdf_path))
+# -------- Admisión por memoria --------
+# El coste de una foto sale de su cabecera: bytes RGB a la escala DCT que usará
+# open_exif más el lienzo de la postal. RENDER_BACKLOG_MB acota la suma de renders
+# admitidos y sin terminar (una subida que no cabe recibe 429 + Retry-After y el
+# outbox del navegador reintenta); DECODE_BUDGET_MB acota las decodificaciones a la
+# vez en cada proceso (las demás esperan turno en vez de agotar la memoria).
+
+ADMISSION = {"rejected": 0, "decode_waits": 0, "decode_peak": 0, "worker_peak_rss_mb": None}
+_decode_cond = threading.Condition()
+_decode_inflight = 0
+
+def decode_cost(w: int, h: int, fmt: str = "JPEG", cover=None) -> int:
+    """Bytes que ocupa decodificar una imagen w×h para cubrir `cover` (más el lienzo)."""
+    s = 1
+    if FAST_DECODE and cover and fmt == "JPEG":
+        tw, th = cover
+        r = min(w / tw, h / th, w / th, h / tw)  # sin mirar la orientación EXIF: la peor
+        s = next((k for k in (8, 4, 2) if k <= r), 1)
+    return math.ceil(w / s) * math.ceil(h / s) * 3 + PX_W * PX_H * 3
+
+def image_cost(path: Path, layout: str) -> int:
     try:
-        tmp_jpg.unlink()
-    except:
-        pass
+        with Image.open(path) as im:
+            return decode_cost(im.width, im.height, im.format, print_cover(layout))
+    except Exception:
+        return 0
 
-def print_sumatra(pdf_path: Path) -> bool:
+@contextmanager
+def decode_slot(cost: int):
+    """
+    Reserva `cost` bytes del presupuesto de decodificación; espera si no caben
+    (una imagen mayor que todo el presupuesto pasa cuando no hay otra en curso).
+    """
+    global _decode_inflight
+    budget = DECODE_BUDGET_MB * 1024 * 1024
+    with _decode_cond:
+        if _decode_inflight and _decode_inflight + cost > budget:
+            ADMISSION["decode_waits"] += 1
+        while _decode_inflight and _decode_inflight + cost > budget:
+            _decode_cond.wait()
+        _decode_inflight += cost
+        ADMISSION["decode_peak"] = max(ADMISSION["decode_peak"], _decode_inflight)
     try:
-        if not Path(SUMATRA_PATH).exists():
-            print("❌ SumatraPDF no encontrado:", SUMATRA_PATH)
-            return False
-        # -silent para no mostrar UI, -print-to-default envía a impresora predeterminada
-        res = subprocess.run([SUMATRA_PATH, "-print-to-default", "-silent", str(pdf_path)],
-                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        ok = (res.returncode == 0)
-        print(("🖨️ Sumatra OK" if ok else "❌ Sumatra error"), "returncode=", res.returncode)
-        return ok
-    except Exception as e:
-        print("❌ Sumatra excepción:", e)
-        return False
+        yield
+    finally:
+        with _decode_cond:
+            _decode_inflight -= cost
+            _decode_cond.notify_all()
 
-def print_email(path: Path, code: str, mime: str) -> bool:
-    """HP ePrint por email mediante SendGrid"""
-    if not EMAIL_ENABLED:
-        print("❌ ePrint no configurado (PRINTER_EMAIL/SENDER_EMAIL/SENDGRID_API_KEY faltan)")
-        return False
+def render_backlog() -> tuple:
+    """(bytes, trabajos) de los renders admitidos que aún no han terminado."""
+    with JOBS_COND:
+        live = [j["cost"] for j in JOBS.values()
+                if j.get("cost") and j["stages"]["render"]["state"] in ("pending", "running")]
+    return sum(live), len(live)
+
+def render_admit(code: str, cost: int) -> bool:
+    """¿Cabe un render más? Una foto repetida que ya tiene su PDF no cuesta nada."""
+    if derivative_path(code, "pdf").exists():
+        return True
+    used, n = render_backlog()
+    if not n or used + cost <= RENDER_BACKLOG_MB * 1024 * 1024:
+        return True
+    ADMISSION["rejected"] += 1
+    return False
+
+def retry_after() -> int:
+    """Segundos que sugerimos esperar: renders en cola × mediana reciente / workers."""
+    with JOBS_COND:
+        secs = sorted(j["stages"]["render"]["secs"] for j in JOBS.values()
+                      if j["stages"]["render"].get("secs"))
+    _, n = render_backlog()
+    per = secs[len(secs) // 2] if secs else 2.0
+    return max(1, min(60, math.ceil(per * n / max(1, RENDER_WORKERS))))
+
+def peak_rss_mb():
+    """Pico de memoria residente de este proceso (MB); None si no se puede medir."""
     try:
+        import resource
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB en Linux, bytes en macOS
+        return round(r / (2 ** 20 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:  # Windows: PeakWorkingSetSize de GetProcessMemoryInfo
+        import ctypes
+
+        class PMC(ctypes.Structure):
+            _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong)] + [
+                (n, ctypes.c_size_t) for n in (
+                    "PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                    "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                    "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+        c = PMC()
+        c.cb = ctypes.sizeof(c)
+        ok = ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(c), c.cb)
+        return round(c.PeakWorkingSetSize / 2 ** 20, 1) if ok else None
+    except Exception:
+        return None
+
+def admission_stats() -> dict:
+    used, n = render_backlog()
+    return {
+        "render_backlog_mb": round(used / 2 ** 20, 1),
+        "render_backlog_jobs": n,
+        "render_budget_mb": RENDER_BACKLOG_MB,
+        "decode_inflight_mb": round(_decode_inflight / 2 ** 20, 1),
+        "decode_peak_mb": round(ADMISSION["decode_peak"] / 2 ** 20, 1),
+        "decode_budget_mb": DECODE_BUDGET_MB,
+        "decode_waits": ADMISSION["decode_waits"],
+        "rejected": ADMISSION["rejected"],
+        "retry_after": retry_after(),
+        "max_image_pixels": Image.MAX_IMAGE_PIXELS,
+        "peak_rss_mb": peak_rss_mb(),
+        "worker_peak_rss_mb": ADMISSION["worker_peak_rss_mb"],
+    }
+
+# -------- PDF --------
+# Escritor de postal_common: los JPEG se incrustan tal cual (DCTDecode), sin recodificar
+# ni archivos temporales, y el PDF se genera por trozos (a disco o a la respuesta).
+
+def jpeg_bytes(img: Image.Image, quality: int = 92) -> bytes:
+    buf = io.BytesIO()
+    with timed("jpeg"):
+        img.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+def save_pdf(img: Image.Image, pdf_path: Path):
+    """7x5.5 in landscape, sin márgenes; el JPEG se codifica una sola vez."""
+    pages = [card_page(jpeg_bytes(img))]
+    with timed("pdf"):
+        write_pdf(pages, pdf_path)
+
+def print_sumatra(pdf_path: Path, code: str = None):
+    """Imprime con SumatraPDF; lanza excepción si falla (la reintenta la cola de impresión)."""
+    if not Path(SUMATRA_PATH).exists():
+        raise FileNotFoundError(f"SumatraPDF no encontrado: {SUMATRA_PATH}")
+    # -silent para no mostrar UI, -print-to-default envía a impresora predeterminada
+    with timed("sumatra"):
+        subprocess.run([SUMATRA_PATH, "-print-to-default", "-silent", str(pdf_path)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, timeout=PRINT_TIMEOUT)
+
+_sendgrid = None
+
+def sendgrid_client():
+    """Cliente de SendGrid persistente (sólo lo usa el hilo del destino "email")."""
+    global _sendgrid
+    if _sendgrid is None:
         from sendgrid import SendGridAPIClient
-        from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
-        ts = datetime.now().strftime("%H:%M:%S")
-        subject = f"Print {code} {ts}"
-        attach_name = f"postal_{code}.{'pdf' if mime=='application/pdf' else 'jpg'}"
-        enc = base64.b64encode(path.read_bytes()).decode()
-        msg = Mail(from_email=SENDER_EMAIL, to_emails=PRINTER_EMAIL, subject=subject, plain_text_content=subject)
-        msg.attachment = Attachment(FileContent(enc), FileName(attach_name), FileType(mime), Disposition("attachment"))
-        sg = SendGridAPIClient(api_key=SENDGRID_API_KEY)
-        resp = sg.send(msg)
-        ok = resp.status_code in (200, 202)
-        print(("✅ ePrint OK" if ok else "❌ ePrint ERROR"), "status=", resp.status_code)
-        return ok
-    except Exception as e:
-        print("❌ ePrint excepción:", e)
-        return False
+        _sendgrid = SendGridAPIClient(api_key=SENDGRID_API_KEY, host=SENDGRID_HOST)
+    return _sendgrid
 
-def auto_print(comp_img, code: str) -> None:
-    """Imprime/manda a ePrint en escala de grises y calidad baja para máxima velocidad."""
-    mode = AUTO_PRINT_MODE
+def print_email(path: Path, code: str):
+    """HP ePrint por email mediante SendGrid; lanza excepción si falla."""
+    if not EMAIL_ENABLED:
+        raise RuntimeError("ePrint no configurado (PRINTER_EMAIL/SENDER_EMAIL/SENDGRID_API_KEY faltan)")
+    from sendgrid.helpers.mail import Mail, Attachment, FileContent, FileName, FileType, Disposition
+    mime = "application/pdf" if path.suffix == ".pdf" else "image/jpeg"
+    ts = datetime.now().strftime("%H:%M:%S")
+    subject = f"Print {code} {ts}"
+    attach_name = f"postal_{code}{path.suffix}"
+    enc = base64.b64encode(path.read_bytes()).decode()
+    msg = Mail(from_email=SENDER_EMAIL, to_emails=PRINTER_EMAIL, subject=subject, plain_text_content=subject)
+    msg.attachment = Attachment(FileContent(enc), FileName(attach_name), FileType(mime), Disposition("attachment"))
+    with timed("sendgrid"):
+        resp = sendgrid_client().send(msg)  # 4xx/5xx lanzan HTTPError
+    if resp.status_code not in (200, 202):
+        raise RuntimeError(f"ePrint status={resp.status_code}")
 
-    # --- Escala de grises (reduce tamaño y acelera procesamiento) ---
-    gray = comp_img.convert("L").convert("RGB")
+# -------- Codificador con presupuesto --------
+# postal_common.BudgetEncoder: la mayor resolución (hasta EPRINT_MIN_PX) y, en ella, la
+# mejor calidad y submuestreo que caben en N bytes. Lo elegido se recuerda por clave
+# (layout, color, presupuesto) en DATA_DIR/eprint_params.json.
+budget_encoder = BudgetEncoder(DATA_DIR / "eprint_params.json", EPRINT_MIN_QUALITY, EPRINT_MIN_PX)
+
+def encode_budget(img: Image.Image, budget: int, key: str, min_q: int = None, min_px: int = None) -> tuple:
+    """JPEG de img en ≤ budget bytes → (bytes, params); ver BudgetEncoder.encode."""
+    with timed("eprint_encode"):
+        return budget_encoder.encode(img, budget, key, min_q, min_px)
+
+# -------- Derivados de impresión --------
+# El composite se pasa a grises UNA vez y de ese buffer salen todos los archivos
+# declarados (el original se sube tal cual, sin decodificar).
 
+def _d_pdf(ctx) -> bytes:
     # --- Siempre generamos el PDF (grises) por si lo necesitas / Sumatra ---
-    pdf_path = OUT_DIR / f"{code}.pdf"
-    save_pdf(gray, pdf_path)
-
-    if mode == "sumatra":
-        # Si alguna vez imprimes local, el PDF ya viene en grises
-        print_sumatra(pdf_path)
-
-    elif mode == "email":
-        # ⚡ Preset "rápido": ~1000px lado mayor, JPEG baseline, calidad baja
-        jpg_path = OUT_DIR / f"{code}.jpg"
-
-        w, h = gray.size
-        MAX = 1000  # lado mayor ~1000 px (muy ligero)
-        if max(w, h) > MAX:
-            r = MAX / max(w, h)
-            gray = gray.resize((int(w * r), int(h * r)), Image.LANCZOS)
-
-        gray.save(
-            jpg_path,
-            "JPEG",
-            quality=60,          # calidad baja (rápido y pequeño)
-            optimize=True,
-            progressive=False,   # baseline (muchas colas ePrint lo prefieren)
-            subsampling="4:2:0"  # archivo más pequeño, sin pérdida relevante
-        )
-
-        print_email(jpg_path, code, "image/jpeg")  # adjunta JPG en grises
+    jpeg = jpeg_bytes(ctx["gray"])
+    with timed("pdf"):
+        return b"".join(iter_pdf([card_page(jpeg)]))
 
+def _d_email(ctx) -> bytes:
+    if EPRINT_BUDGET_KB > 0:
+        # adjunto con presupuesto: gris o color según la impresora, parámetros recordados por layout
+        im = ctx["gray"] if EPRINT_COLOR == "gray" else ctx["comp"]
+        jpeg, _ = encode_budget(im, EPRINT_BUDGET_KB * 1024, f"{ctx['layout']}:{EPRINT_COLOR}:{EPRINT_BUDGET_KB}")
+        return jpeg
+    # ⚡ Preset "rápido": ~1000px lado mayor, JPEG baseline, calidad baja
+    gray = ctx["gray"]
+    w, h = gray.size
+    MAX = 1000  # lado mayor ~1000 px (muy ligero)
+    if max(w, h) > MAX:
+        r = MAX / max(w, h)
+        gray = gray.resize((int(w * r), int(h * r)), Image.LANCZOS, reducing_gap=2.0)
+    buf = io.BytesIO()
+    gray.save(
+        buf,
+        "JPEG",
+        quality=60,          # calidad baja (rápido y pequeño)
+        optimize=True,
+        progressive=False,   # baseline (muchas colas ePrint lo prefieren)
+    )
+    return buf.getvalue()
+
+# nombre → (archivo en OUT_DIR, generador, ¿se necesita?)
+DERIVATIVES = {
+    "pdf":   ("{code}.pdf", _d_pdf,   lambda: True),
+    "email": ("{code}.jpg", _d_email, lambda: AUTO_PRINT_MODE == "email"),
+}
+
+def derivative_path(code: str, name: str) -> Path:
+    return OUT_DIR / DERIVATIVES[name][0].format(code=code)
+
+def prepare_print(comp_img, code: str, only=None, layout: str = None) -> dict:
+    """Genera los archivos de impresión (PDF en grises y, en modo email, el JPG ligero)."""
+    # --- Escala de grises (reduce tamaño y acelera procesamiento) ---
+    ctx = {"gray": comp_img.convert("L"), "comp": comp_img, "layout": layout or PRINT_LAYOUT}
+    files = {}
+    for name, (_, build, needed) in DERIVATIVES.items():
+        if (only is None and needed()) or (only is not None and name in only):
+            out = derivative_path(code, name)
+            part = out.with_name(f".{out.name}.{uuid.uuid4().hex[:8]}.part")
+            with timed(f"build_{name}"):
+                part.write_bytes(build(ctx))
+            os.replace(part, out)
+            files[name] = str(out)
+    return files
+
+# destino → (función que imprime, derivado que se le manda)
+PRINTERS = {
+    "sumatra": (print_sumatra, "pdf"),    # si alguna vez imprimes local, el PDF ya viene en grises
+    "email":   (print_email,   "email"),  # adjunta JPG en grises
+}
+
+def send_print(code: str):
+    """Encola lo preparado por prepare_print. True si queda en cola, None si la impresión está desactivada."""
+    if AUTO_PRINT_MODE not in PRINTERS:
+        log_event("print_off", code=code, mode=AUTO_PRINT_MODE)
+        return None
+    return print_enqueue(code, derivative_path(code, PRINTERS[AUTO_PRINT_MODE][1]), AUTO_PRINT_MODE)
+
+def auto_print(comp_img, code: str):
+    """Imprime/manda a ePrint en escala de grises y calidad baja para máxima velocidad."""
+    prepare_print(comp_img, code)
+    return send_print(code)
+
+# -------- Cola de impresión --------
+# Spooler durable (SQLite en DATA_DIR): un trabajo por código (repetirlo mientras está en
+# cola no duplica), un hilo por destino (Sumatra nunca corre dos veces a la vez contra la
+# misma impresora; los emails salen en orden) y reintentos con backoff exponencial + jitter.
+PRINT_DB = DATA_DIR / "printq.sqlite3"
+_print_lock = threading.Lock()
+_print_wake = {}     # destino → Event
+_print_threads = {}  # destino → Thread
+
+def _print_db() -> sqlite3.Connection:
+    con = sqlite3.connect(PRINT_DB, timeout=30)
+    con.row_factory = sqlite3.Row
+    return con
+
+with _print_db() as _con:
+    _con.execute("PRAGMA journal_mode=WAL")
+    _con.execute("""CREATE TABLE IF NOT EXISTS printq(
+        code TEXT PRIMARY KEY, path TEXT NOT NULL, dest TEXT NOT NULL, state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL, last_error TEXT,
+        created REAL NOT NULL, started REAL, finished REAL, updated REAL NOT NULL)""")
+    _con.execute("CREATE INDEX IF NOT EXISTS printq_due ON printq(dest, state, next_at)")
+    # lo que se estaba imprimiendo al caerse el proceso vuelve a la cola
+    _con.execute("UPDATE printq SET state='pending' WHERE state='printing'")
+_con.close()
+
+def print_enqueue(code: str, path: Path, dest: str) -> bool:
+    now = time.time()
+    with _print_lock, _print_db() as con:
+        con.execute("""INSERT INTO printq(code, path, dest, state, attempts, next_at, created, updated)
+                       VALUES(?, ?, ?, 'pending', 0, ?, ?, ?)
+                       ON CONFLICT(code) DO UPDATE SET state='pending', attempts=0, next_at=excluded.next_at,
+                       path=excluded.path, dest=excluded.dest, last_error=NULL, created=excluded.created,
+                       started=NULL, finished=NULL, updated=excluded.updated
+                       WHERE printq.state IN ('done', 'failed')""",
+                    (code, str(path), dest, now, now, now))
+    print_start(dest)
+    _print_wake[dest].set()
+    return True
+
+def _print_claim(dest: str):
+    now = time.time()
+    with _print_lock, _print_db() as con:
+        r = con.execute("""SELECT * FROM printq WHERE dest=? AND state='pending' AND next_at<=?
+                           ORDER BY created LIMIT 1""", (dest, now)).fetchone()
+        if r:
+            con.execute("UPDATE printq SET state='printing', started=?, updated=? WHERE code=?", (now, now, r["code"]))
+        nxt = con.execute("SELECT MIN(next_at) FROM printq WHERE dest=? AND state='pending'", (dest,)).fetchone()[0]
+    return (dict(r) if r else None), nxt
+
+def _print_done(row: dict, error: str = None):
+    now, attempts = time.time(), row["attempts"] + 1
+    if error is None:
+        state, nxt = "done", now
+    elif attempts < PRINT_MAX_ATTEMPTS:
+        state, nxt = "pending", now + min(300.0, PRINT_BACKOFF * 2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
     else:
-        print("ℹ️ AUTO_PRINT_MODE=off (sin impresión)")
+        state, nxt = "failed", now
+    with _print_lock, _print_db() as con:
+        con.execute("""UPDATE printq SET state=?, attempts=?, next_at=?, last_error=?, finished=?, updated=?
+                       WHERE code=?""",
+                    (state, attempts, nxt, error, None if state == "pending" else now, now, row["code"]))
+
+def _print_worker(dest: str):
+    wake = _print_wake[dest]
+    while True:
+        try:
+            row, nxt = _print_claim(dest)
+            if not row:
+                wake.wait(min(30.0, max(0.05, nxt - time.time())) if nxt else 30.0)
+                wake.clear()
+                continue
+            t0 = time.perf_counter()
+            try:
+                storage.touch(row["path"])
+                PRINTERS[dest][0](Path(row["path"]), row["code"])
+                _print_done(row)
+                inc("postal_print_total", dest=dest, result="ok")
+                log_event("print", dest=dest, code=row["code"], result="ok",
+                          secs=round(time.perf_counter() - t0, 3))
+            except Exception as e:
+                _print_done(row, str(e)[:200])
+                inc("postal_print_total", dest=dest, result="error")
+                log_event("print", logging.WARNING, dest=dest, code=row["code"], result="error",
+                          secs=round(time.perf_counter() - t0, 3), error=str(e)[:200])
+        except Exception as e:
+            log_event("print_worker_error", logging.ERROR, dest=dest, error=str(e))
+            time.sleep(1)
+
+def print_start(dest: str = None):
+    dest = dest or AUTO_PRINT_MODE
+    if dest not in PRINTERS or dest in _print_threads:
+        return
+    with _print_lock:
+        if dest in _print_threads:
+            return
+        _print_wake[dest] = threading.Event()
+        t = threading.Thread(target=_print_worker, args=(dest,), name=f"print-{dest}", daemon=True)
+        t.start()
+        _print_threads[dest] = t
+
+def _pct(xs, q):
+    return round(xs[min(len(xs) - 1, int(q * len(xs)))], 3) if xs else None
+
+def print_queue_status(code: str = None, limit: int = 100) -> dict:
+    """Profundidad por destino/estado y latencias (en cola, impresión, total) de los últimos trabajos."""
+    with _print_db() as con:
+        if code:
+            r = con.execute("SELECT * FROM printq WHERE code=?", (code,)).fetchone()
+            return dict(r) if r else None
+        counts = {}
+        for r in con.execute("SELECT dest, state, COUNT(*) n FROM printq GROUP BY dest, state"):
+            counts.setdefault(r["dest"], {})[r["state"]] = r["n"]
+        oldest = con.execute("SELECT MIN(created) FROM printq WHERE state IN ('pending', 'printing')").fetchone()[0]
+        items = [dict(r) for r in con.execute("SELECT * FROM printq ORDER BY updated DESC LIMIT ?", (limit,))]
+    for i in items:
+        i["wait_secs"] = round(i["started"] - i["created"], 3) if i["started"] else None
+        i["print_secs"] = round(i["finished"] - i["started"], 3) if i["started"] and i["finished"] else None
+    done = [i for i in items if i["state"] == "done" and i["print_secs"] is not None]
+    total = sorted(i["finished"] - i["created"] for i in done)
+    return {"depth": sum(n for d in counts.values() for st, n in d.items() if st in ("pending", "printing")),
+            "counts": counts, "workers": sorted(_print_threads),
+            "oldest_pending_secs": round(time.time() - oldest, 3) if oldest else None,
+            "latency": {"n": len(total), "p50": _pct(total, .5), "p95": _pct(total, .95),
+                        "wait_p50": _pct(sorted(i["wait_secs"] for i in done), .5),
+                        "print_p50": _pct(sorted(i["print_secs"] for i in done), .5)},
+            "items": items}
 
 def upload_remote(code: str, img_path: Path):
     """Sube el JPG original a tu web principal (/subir_postal) y devuelve la URL de vista si la respuesta la trae."""
     if not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN and VIEW_BASE_URL):
-        print("ℹ️ Subida remota desactivada (faltan REMOTE_UPLOAD_URL / TOKEN / VIEW_BASE_URL).")
+        log_event("remote_off", logging.DEBUG, code=code)
         return None
+    t0 = time.perf_counter()
     try:
         headers = {"Authorization": f"Bearer {REMOTE_UPLOAD_TOKEN}"}
         files = {"imagen": (f"{code}.jpg", img_path.read_bytes(), "image/jpeg")}
         data  = {"codigo": code}
-        r = requests.post(REMOTE_UPLOAD_URL, headers=headers, files=files, data=data, timeout=30)
-        print("🌐 Subida remota:", r.status_code, (r.text or "")[:200])
+        with timed("remote_upload"):
+            r = requests.post(REMOTE_UPLOAD_URL, headers=headers, files=files, data=data, timeout=30)
+        inc("postal_remote_upload_total", result=r.status_code)
+        log_event("remote_upload", logging.INFO if r.ok else logging.WARNING, code=code, status=r.status_code,
+                  secs=round(time.perf_counter() - t0, 3), body=None if r.ok else (r.text or "")[:200])
 
         # Intenta devolver la URL absoluta si la respuesta trae "url" o "view_url"
         try:
@@ -222,11 +701,203 @@ def upload_remote(code: str, img_path: Path):
 
         # Adjunta la URL calculada al objeto response para que /subir pueda leerla
         r._view_url = view_url
+        if r.ok:
+            mark_sent(code)  # la retención sólo retira originales confirmados
         return r
     except Exception as e:
-        print("❌ Error subida remota:", e)
+        inc("postal_remote_upload_total", result="error")
+        log_event("remote_upload", logging.WARNING, code=code, result="error",
+                  secs=round(time.perf_counter() - t0, 3), error=str(e)[:200])
         return None
 
+# =============================================================
+# Trabajos en segundo plano
+# =============================================================
+# /subir sólo guarda el original y devuelve un job_id; la composición corre en
+# un pool de procesos y la impresión/subida remota en hilos acotados.
+
+STAGES = ("render", "print", "remote")
+JOBS = {}
+JOBS_COND = threading.Condition()
+_render_pool = None
+_job_pool = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix="job")
+
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None and RENDER_WORKERS > 0:
+        _render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _render_pool
+
+def render_print_files(code: str, jpg_path: Path, layout: str) -> dict:
+    """Etapa render (proceso worker): compone y deja listos los archivos de impresión."""
+    with stage_trace(deferred=True) as st:  # las observa _run_job (puede ser otro proceso)
+        files = prepare_print(compose_image(jpg_path, layout), code, layout=layout)
+    return {"files": files, "timings": {k: round(v, 4) for k, v in st.items()},
+            "rss_peak_mb": peak_rss_mb()}  # pico de memoria del worker
+
+def remote_view_url(code: str, jpg_path: Path):
+    """Etapa remote: view_url devuelta por tu web, False si falló, None si está desactivada."""
+    if not (REMOTE_UPLOAD_URL and REMOTE_UPLOAD_TOKEN and VIEW_BASE_URL):
+        return None
+    r = upload_remote(code, jpg_path)
+    if r is None or not r.ok:
+        return False
+    return getattr(r, "_view_url", None) or f"{VIEW_BASE_URL.rstrip('/')}/view_image/{code}"
+
+def _job_update(job_id: str, stage: str = None, **fields):
+    with JOBS_COND:
+        job = JOBS.get(job_id)
+        if not job:
+            return
+        if stage:
+            job["stages"][stage].update(fields)
+        else:
+            job.update(fields)
+        job["version"] += 1
+        job["updated"] = time.time()
+        JOBS_COND.notify_all()
+
+def job_snapshot(job_id: str):
+    with JOBS_COND:
+        job = JOBS.get(job_id)
+        return json.loads(json.dumps(job)) if job else None
+
+def _run_stage(job_id: str, stage: str, fn, *args, in_process=False):
+    _job_update(job_id, stage, state="running")
+    t0 = time.time()
+    try:
+        pool = _get_render_pool() if in_process else None
+        res = pool.submit(fn, *args).result() if pool else fn(*args)
+    except Exception as e:
+        _job_update(job_id, stage, state="error", error=str(e), secs=round(time.time() - t0, 3))
+        raise
+    finally:
+        observe("postal_job_stage_seconds", time.time() - t0, stage=stage)
+    state = "skipped" if res is None else ("error" if res is False else "done")
+    _job_update(job_id, stage, state=state, secs=round(time.time() - t0, 3))
+    return res
+
+def _run_job(job_id: str, code: str, jpg_path: Path, layout: str):
+    _job_update(job_id, state="running")
+    try:
+        out = _run_stage(job_id, "render", render_print_files, code, jpg_path, layout, in_process=True)
+        _job_update(job_id, "render", timings=out["timings"])
+        for f in out["files"].values():
+            storage.note(f)  # escritos en el worker
+        for st, secs in out["timings"].items():
+            observe("postal_stage_seconds", secs, stage=st)
+        if out.get("rss_peak_mb") is not None:
+            ADMISSION["worker_peak_rss_mb"] = max(ADMISSION["worker_peak_rss_mb"] or 0, out["rss_peak_mb"])
+        try:
+            if _run_stage(job_id, "print", send_print, code):
+                _job_update(job_id, "print", state="queued", print_url=f"/print-queue/{code}")
+        except Exception as e:
+            log_event("print_enqueue_error", logging.ERROR, code=code, error=str(e))
+        view_url = _run_stage(job_id, "remote", remote_view_url, code, jpg_path)
+        if view_url:
+            _job_update(job_id, view_url=view_url)
+        _job_update(job_id, state="done")
+    except Exception as e:
+        log_event("job_error", logging.ERROR, job_id=job_id, code=code, error=str(e))
+        _job_update(job_id, state="error", error=str(e))
+
+def submit_job(code: str, jpg_path: Path, layout: str = None) -> str:
+    now = time.time()
+    job_id = uuid.uuid4().hex[:12]
+    layout = layout or PRINT_LAYOUT
+    cost = image_cost(jpg_path, layout)  # cuenta en render_backlog hasta renderizar
+    with JOBS_COND:
+        for k in [k for k, j in JOBS.items() if j["state"] in ("done", "error") and now - j["updated"] > JOB_TTL]:
+            JOBS.pop(k, None)
+        JOBS[job_id] = {"id": job_id, "code": code, "state": "queued", "version": 0,
+                        "created": now, "updated": now, "view_url": "", "cost": cost,
+                        "stages": {s: {"state": "pending"} for s in STAGES}}
+    _job_pool.submit(_run_job, job_id, code, jpg_path, layout)
+    return job_id
+
+def wait_job(job_id: str, since: int = -1, timeout: float = 25.0):
+    """Long-poll: espera a que el trabajo cambie de versión (o termine)."""
+    deadline = time.time() + timeout
+    with JOBS_COND:
+        while True:
+            job = JOBS.get(job_id)
+            if not job or job["version"] > since or job["state"] in ("done", "error"):
+                break
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            JOBS_COND.wait(left)
+    return job_snapshot(job_id)
+
+# =============================================================
+# Perfilado bajo demanda
+# =============================================================
+# @profiled en /subir (postal_common.Profiler): si la petición trae X-Profile:
+# <PROFILE_TOKEN> o cae en PROFILE_SAMPLE, muestrea la pila del hilo de la petición y
+# guarda las pilas plegadas en DATA_DIR/profiles. La composición corre en el pool de
+# render: sus tiempos están en /metrics y en las timings del trabajo.
+
+PROFILES = DATA_DIR / "profiles"
+profiler = Profiler(PROFILES, PROFILE_TOKEN, PROFILE_SAMPLE, PROFILE_INTERVAL_MS, PROFILE_KEEP)
+profiled = profiler.profiled
+
+def _profiles_denied():
+    if not profiler.allowed():
+        return jsonify(ok=False, error="forbidden"), 403
+    return None
+
+# =============================================================
+# Almacenamiento
+# =============================================================
+# postal_common.Storage: un hilo revisa el uso de DATA_DIR cada STORAGE_SWEEP_SECS. Si pasa
+# de STORAGE_QUOTA_MB (o al disco le quedan menos de STORAGE_MIN_FREE_MB) libera hasta el
+# STORAGE_LOW_PCT:
+#   1) lo regenerable (PDF/JPG de OUT_DIR y perfiles), el menos usado primero; nunca lo
+#      reciente (STORAGE_MIN_AGE) ni lo de un código con impresión pendiente;
+#   2) originales con más de RETENTION_DAYS cuya subida a tu web se confirmó (marca en
+#      uploads/.sent): a RETENTION_ARCHIVE o, sin archivo, se borran. Sin confirmar, nunca.
+# El uso sale del ledger DATA_DIR/storage.sqlite3 (storage.note al escribir, storage.touch
+# al imprimir), no de recorrer DATA_DIR. Lo que escribe el worker de render lo apunta _run_job.
+
+SENT_DIR = UPLOADS / ".sent"  # un archivo vacío por código subido a tu web
+SENT_DIR.mkdir(exist_ok=True)
+
+def mark_sent(code: str):
+    (SENT_DIR / code).touch()
+
+def _tier_of(path: Path) -> str:
+    if path.name.startswith("."):  # temporales/parciales de una escritura en curso
+        return "other"
+    if path.parent in (OUT_DIR, PROFILES):
+        return "derivative"
+    return "original" if path.parent == UPLOADS and path.suffix == ".jpg" else "other"
+
+def _storage_protected() -> set:
+    """Códigos con impresión pendiente: sus archivos de OUT_DIR siguen haciendo falta."""
+    with _print_db() as con:
+        return {r[0] for r in con.execute("SELECT code FROM printq WHERE state IN ('pending', 'printing')")}
+
+def _retirable_originals(now: float, limit: int) -> list:
+    """Originales subidos (con marca) y más viejos que RETENTION_DAYS, los más antiguos primero."""
+    out = []
+    for mark in SENT_DIR.iterdir():
+        src = UPLOADS / f"{mark.name}.jpg"
+        try:
+            mtime = src.stat().st_mtime
+        except FileNotFoundError:
+            mark.unlink(missing_ok=True)  # original ya retirado a mano
+            continue
+        if now - mtime > RETENTION_DAYS * 86400:
+            out.append((mtime, mark.name, src))
+    return [(code, src, mtime) for mtime, code, src in sorted(out)[:limit]]
+
+storage = Storage(DATA_DIR, STORAGE_QUOTA_MB, STORAGE_MIN_FREE_MB, STORAGE_LOW_PCT, STORAGE_SWEEP_SECS,
+                  STORAGE_MIN_AGE, STORAGE_BATCH, STORAGE_IO_MB, RETENTION_DAYS, RETENTION_ARCHIVE, UPLOAD_CHUNK,
+                  tier_of=_tier_of, protected=_storage_protected, retirable=_retirable_originals,
+                  on_retired=lambda code, dest, size: (SENT_DIR / code).unlink(missing_ok=True))
+STORAGE = storage.status
+storage_sweep, storage_start, storage_stats = storage.sweep, storage.start, storage.stats
+
 # =============================================================
 # Rutas
 # =============================================================
@@ -254,6 +925,48 @@ def home():
     </div>"""
     return HTML
 
+# -------- Scripts de captura --------
+# capture.js (recorte/escalado en un Worker) y outbox.js (cola en IndexedDB + service
+# worker) salen de postal_common; aquí sólo la subida de la cola: POST /subir.
+OUTBOX_JS = outbox_js("""// ---- Subida: POST /subir (multipart, campo "foto")
+async function upload(it){
+  const fd = new FormData();
+  fd.append('foto', it.blob, 'foto.jpg');
+  const r = await fetch('/subir', {method: 'POST', body: fd});
+  const j = await r.json().catch(() => ({}));
+  if (j.ok){
+    if (j.job_url) after(followJob(it.id, j.job_url));
+    return {code: j.code, view_url: j.view_url};
+  }
+  if (r.status === 400 || r.status === 413) throw new Fatal(j.error || r.status);
+  if (r.status === 429) throw new Later(j.error, +r.headers.get('Retry-After'));
+  throw new Error(j.error || r.status);
+}
+// /subir responde antes de subir a tu web: su view_url es la prevista ({VIEW_BASE_URL}/view_image/<code>).
+// La que devuelve tu web llega con la etapa remote del trabajo: se sigue job_url (long-poll) y se
+// guarda en el elemento; si el trabajo caduca o falla, se queda la prevista.
+async function followJob(id, url){
+  let since = -1, job = null;
+  for (const end = Date.now() + 10 * 60e3; Date.now() < end;){
+    const r = await fetch(`${url}?wait=25&since=${since}`);
+    if (!r.ok) return;
+    job = await r.json(); since = job.version;
+    if (job.state === 'done' || job.state === 'error') break;
+  }
+  if (!job || !job.view_url) return;
+  for (let i = 0; i < 50; i++){   // send() puede no haber guardado aún el 'done'
+    const it = await req((await items('readonly')).get(id));
+    if (!it) return;
+    if (it.state === 'done'){
+      if (it.view_url !== job.view_url) await outboxPut(Object.assign(it, {view_url: job.view_url}));
+      return;
+    }
+    await sleep(100);
+  }
+}
+
+""")
+
 # -------- HTML de captura --------
 CAPTURAR_HTML = """
 <!doctype html><meta charset="utf-8">
@@ -267,6 +980,10 @@ CAPTURAR_HTML = """
   .btn{appearance:none;border:2px solid #fff;background:#000;color:#fff;font-weight:700;border-radius:10px;padding:10px 14px;cursor:pointer}
   .btn.sec{border-color:#3498db;color:#bfe6ff}
   .muted{color:#9aa0a6}
+  .ok{color:#22c55e} .err{color:#ff7b7b}
+  .item{display:flex;gap:8px;align-items:center;justify-content:space-between;padding:6px 0;border-top:1px solid #222}
+  .item .btn{padding:4px 8px}
+  progress{width:120px}
 </style>
 <div class="wrap">
   <h3>📷 Cámara</h3>
@@ -277,62 +994,129 @@ CAPTURAR_HTML = """
       <input type="file" id="file" accept="image/*" style="display:none">
     </label>
   </div>
-  <p class="muted">Consejos: si usas datos móviles, la app comprime la imagen y la escala (máx 1600px).</p>
-  <div id="res"></div>
+  <p class="muted">La foto se recorta y escala en el móvil a lo justo para imprimir a 300 DPI antes de subirla.</p>
+  <p id="res" class="muted"></p>
+  <h3>Cola de subida</h3>
+  <div id="list" class="muted">Vacía</div>
 </div>
+<script src="/capture.js"></script>
+<script src="/outbox.js"></script>
 <script>
 const v = document.getElementById('v');
 const res = document.getElementById('res');
 const bShoot = document.getElementById('bShoot');
 const input = document.getElementById('file');
+const list = document.getElementById('list');
+
+// perfil del servidor + worker de recorte/escalado (respaldo: mismo código en este hilo)
+const profile = fetch('/capture_profile').then(r => r.json());
+let worker = null, seq = 0; const waiting = {};
+try{
+  if(window.Worker && window.OffscreenCanvas){
+    worker = new Worker('/capture.js');
+    worker.onmessage = e => { const [ok, ko] = waiting[e.data.id]; delete waiting[e.data.id];
+                              e.data.error ? ko(e.data.error) : ok(e.data); };
+  }
+}catch(_){ worker = null; }
 
 async function initCam(){
   try{
+    const cam = (await profile).camera;
     const st = await navigator.mediaDevices.getUserMedia({
-      video:{ facingMode:'environment', width:{ideal:1280}, height:{ideal:720} }, audio:false
+      video:{ facingMode:'environment', width:{ideal:cam.width}, height:{ideal:cam.height} }, audio:false
     });
     v.srcObject = st;
   }catch(e){ alert('No se pudo abrir la cámara: '+e); }
 }
 
-function scaleAndJpeg(videoOrImage){
-  // escala al lado mayor 1600px y exporta JPG calidad 0.82
-  let w = videoOrImage.videoWidth || videoOrImage.naturalWidth;
-  let h = videoOrImage.videoHeight|| videoOrImage.naturalHeight;
-  const max = 1600;
-  if (Math.max(w,h) > max){ const r = max/Math.max(w,h); w=Math.round(w*r); h=Math.round(h*r); }
-  const c = document.createElement('canvas');
-  c.width = w; c.height = h;
-  c.getContext('2d').drawImage(videoOrImage,0,0,w,h);
-  return new Promise(resolve=>{
-    c.toBlob(b=>resolve(b),'image/jpeg',0.82);
-  });
+async function shrink(src){          // src: <video> o File
+  const p = await profile;
+  if(worker){
+    try{
+      const m = src instanceof Blob ? src : await createImageBitmap(src);
+      return await new Promise((ok, ko) => { const id = ++seq; waiting[id] = [ok, ko];
+        worker.postMessage({id, src: m, profile: p}, m instanceof Blob ? [] : [m]); });
+    }catch(e){ worker = null; }
+  }
+  return encodeCapture(src, p);
 }
 
-async function postBlob(blob){
-  const fd = new FormData();
-  fd.append('foto', blob, 'foto.jpg');
-  res.innerHTML = '<p class="muted">Subiendo…</p>';
-  const r = await fetch('/subir',{ method:'POST', body:fd });
-  const j = await r.json();
-  if(j.ok){
-    res.innerHTML = `<p><b>✅ OK</b> · código: <code>${j.code}</code></p>
-                     <p><a class="btn" href="${j.view_url}" target="_blank">Ver en la web</a></p>`;
-  }else{
-    res.innerHTML = `<p style="color:#ff7b7b">❌ Error: ${j.error||'desconocido'}</p>`;
+// cola en IndexedDB: la vacía el service worker (o esta página si no hay SW, p. ej. http sin TLS);
+// capturar sólo encola, la subida va aparte y no bloquea la siguiente foto
+const sw = navigator.serviceWorker;
+if(sw) sw.register('/outbox.js').catch(()=>{});
+async function flush(){
+  if(sw && sw.controller){
+    sw.controller.postMessage('flush');
+    const reg = await sw.ready; if(reg.sync) reg.sync.register('outbox').catch(()=>{});
+  }else pump();
+}
+const shown = new Map();
+function onOutbox(m){
+  if(m.item.deleted) shown.delete(m.item.id); else shown.set(m.item.id, m.item);
+  draw();
+}
+if(sw) sw.addEventListener('message', e => { if(e.data && e.data.type === 'outbox') onOutbox(e.data); });
+// código, error y view_url llegan del servidor: se insertan como texto y el enlace sólo si es http(s)
+function el(tag, cls, text){
+  const e = document.createElement(tag);
+  if(cls) e.className = cls;
+  if(text != null) e.textContent = text;
+  return e;
+}
+function safeUrl(u){
+  try{ const x = new URL(u, location.href); return /^https?:$/.test(x.protocol) ? x.href : null; }
+  catch(e){ return null; }
+}
+function draw(){
+  const its = [...shown.values()].sort((a, b) => b.created - a.created).slice(0, 20);
+  list.textContent = its.length ? '' : 'Vacía';
+  for(const it of its){
+    const d = el('div', 'item');
+    d.append(el('span', null, new Date(it.created).toLocaleTimeString()));
+    if(it.state === 'done'){
+      const ok = el('span', 'ok', '✅ ');
+      ok.append(el('code', null, it.code));
+      d.append(ok);
+      const u = it.view_url && safeUrl(it.view_url);
+      if(u){
+        const a = el('a', 'btn', 'Ver en la web');
+        a.href = u; a.target = '_blank'; a.rel = 'noopener';
+        d.append(a);
+      }
+    }else if(it.state === 'failed'){
+      const b = el('button', 'btn sec', 'Reintentar');
+      b.onclick = () => outboxRetry(it.id).then(flush);
+      d.append(el('span', 'err', '❌ ' + (it.error || 'desconocido')), b);
+    }else if(it.state === 'sending')
+      d.append(el('span', 'muted', 'Subiendo…'));
+    else
+      d.append(el('span', 'muted', 'En cola' +
+               (it.next_at > Date.now() ? ` · reintento ${new Date(it.next_at).toLocaleTimeString()}` : '') +
+               (it.error ? ` (${it.error})` : '')));
+    list.appendChild(d);
   }
 }
+async function postBlob(blob){
+  await outboxAdd(blob); flush();
+  res.textContent = '📥 En cola';
+}
+outboxAll().then(all => { all.forEach(it => shown.set(it.id, Object.assign(it, {blob: undefined}))); draw(); flush(); });
+addEventListener('online', flush);
+setInterval(flush, 30000);     // por si el SW se durmió esperando un backoff
 
 bShoot.onclick = async ()=>{
   if(!v.videoWidth){ alert('Cámara aún no inicia'); return; }
-  const b = await scaleAndJpeg(v);
-  postBlob(b);
+  const r = await shrink(v);
+  postBlob(r.blob);
 };
 input.onchange = async ()=>{
   if(!input.files || !input.files[0]) return;
-  const img = new Image();
-  img.onload = async ()=>{ const b = await scaleAndJpeg(img); postBlob(b); URL.revokeObjectURL(img.src); };
-  img.src = URL.createObjectURL(input.files[0]);
+  const f = input.files[0];
+  let b = f;
+  try{ b = (await shrink(f)).blob; }catch(_){}     // formato que el navegador no decodifica: va tal cual
+  postBlob(b);
+  input.value = '';
 };
 
 initCam();
@@ -342,43 +1126,154 @@ initCam();
 def capturar():
     return CAPTURAR_HTML
 
+@app.get("/capture_profile")
+def capture_profile_view():
+    r = jsonify(capture_profile())
+    r.headers["Cache-Control"] = "no-cache"
+    return r
+
+@app.get("/capture.js")
+def capture_js():
+    return Response(CAPTURE_JS, mimetype="text/javascript", headers={"Cache-Control": "no-cache"})
+
+@app.get("/outbox.js")
+def outbox_js():
+    # service worker con alcance "/" (por eso se sirve desde la raíz)
+    return Response(OUTBOX_JS, mimetype="text/javascript", headers={"Cache-Control": "no-cache"})
+
 @app.post("/subir")
+@profiled
 def subir():
     f = request.files.get("foto")
     if not f: return jsonify(ok=False, error="No file"), 400
-    raw = f.read()
-    if not raw: return jsonify(ok=False, error="Empty"), 400
+    try:
+        code, jpg_path, _ = ingest_upload(f)
+    except ValueError as e:
+        inc("postal_uploads_total", result=str(e))
+        if str(e) == "Busy":  # memoria de render agotada: que el cliente reintente
+            ra = retry_after()
+            return jsonify(ok=False, error="Busy", retry_after=ra), 429, {"Retry-After": str(ra)}
+        return jsonify(ok=False, error=str(e)), (413 if str(e).startswith("Too") else 400)
 
-    code = sha1_8(raw)
-    jpg_path = UPLOADS / f"{code}.jpg"
-    with open(jpg_path, "wb") as out:
-        out.write(raw)
+    # Composición, impresión y subida a web principal: en segundo plano
+    inc("postal_uploads_total", result="ok")
+    job_id = submit_job(code, jpg_path)
+    # view_url prevista; la que devuelva tu web la pone la etapa remote en job_url (outbox.js la sigue)
+    view_url = f"{VIEW_BASE_URL.rstrip('/')}/view_image/{code}"
 
-    comp = compose_image(jpg_path, PRINT_LAYOUT)
+    return jsonify(ok=True, code=code, view_url=view_url,
+                   job_id=job_id, job_url=url_for("job_status", job_id=job_id))
 
-    # Imprimir (según modo)
-    try:
-        auto_print(comp, code)
-    except Exception as e:
-        print("❌ auto_print:", e)
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    # ?wait=N&since=V → long-poll hasta que cambie la versión o pasen N segundos
+    wait = min(float(request.args.get("wait", 0) or 0), 60.0)
+    since = int(request.args.get("since", -1))
+    job = wait_job(job_id, since, wait) if wait > 0 else job_snapshot(job_id)
+    if not job:
+        return jsonify(ok=False, error="job_not_found"), 404
+    return jsonify(job)
 
-    # Subida a web principal
-    r = upload_remote(code, jpg_path)
-    if r is not None and r.ok:
-        # Prioriza la URL que adjuntamos en upload_remote
-        view_url = getattr(r, "_view_url", None)
-        if not view_url:
-            # Fallback si no adjuntamos
-            try:
-                j = r.json()
-                u = j.get("view_url") or j.get("url") or ""
-                view_url = u if u.startswith("http") else f"{VIEW_BASE_URL.rstrip('/')}{u}" if u.startswith("/") else f"{VIEW_BASE_URL.rstrip('/')}/view_image/{code}"
-            except Exception:
-                view_url = f"{VIEW_BASE_URL.rstrip('/')}/view_image/{code}"
-    else:
-        view_url = f"{VIEW_BASE_URL.rstrip('/')}/view_image/{code}"
+@app.get("/jobs/<job_id>/events")
+def job_events(job_id):
+    if not job_snapshot(job_id):
+        return jsonify(ok=False, error="job_not_found"), 404
+    def stream():
+        since, deadline = -1, time.time() + 120
+        while time.time() < deadline:
+            job = wait_job(job_id, since, 15.0)
+            if not job:
+                break
+            if job["version"] == since:
+                yield ": keepalive\n\n"
+                continue
+            since = job["version"]
+            yield f"data: {json.dumps(job)}\n\n"
+            if job["state"] in ("done", "error"):
+                break
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/print-queue")
+def print_queue_view():
+    return jsonify(print_queue_status(limit=min(int(request.args.get("limit", 100)), 1000)))
+
+@app.get("/print-queue/<code>")
+def print_queue_item(code):
+    item = print_queue_status(code=code)
+    if not item:
+        return jsonify(ok=False, error="not_found"), 404
+    return jsonify(item)
+
+@app.get("/admission/stats")
+def admission_stats_view():
+    return jsonify(admission_stats())
+
+@app.get("/storage/stats")
+def storage_stats_view():
+    return jsonify(storage_stats())
+
+# -------- Métricas por petición: duración por ruta, en vuelo y una línea de log con sus etapas --------
+metrics_registry.instrument(app)
+
+def metric_gauges():
+    """(nombre, tipo, ayuda, etiquetas, valor) que se leen en el momento del scrape."""
+    with JOBS_COND:
+        jobs = [j["state"] for j in JOBS.values()]
+    used, _ = render_backlog()
+    out = [
+        ("postal_render_backlog_bytes", "gauge", "Coste de los renders admitidos sin terminar", {}, used),
+        ("postal_decode_inflight_bytes", "gauge", "Bytes de decodificación en curso en este proceso", {}, _decode_inflight),
+        ("postal_admission_rejected_total", "counter", "Subidas rechazadas con 429", {}, ADMISSION["rejected"]),
+        ("postal_decode_waits_total", "counter", "Decodificaciones que esperaron presupuesto", {}, ADMISSION["decode_waits"]),
+    ]
+    out += [("postal_jobs", "gauge", "Trabajos por estado", {"state": st}, jobs.count(st))
+            for st in ("queued", "running", "done", "error")]
+    for proc, mb in (("server", peak_rss_mb()), ("worker", ADMISSION["worker_peak_rss_mb"])):
+        out.append(("postal_peak_rss_bytes", "gauge", "Pico de memoria residente", {"process": proc},
+                    int(mb * 2 ** 20) if mb is not None else None))
+    with _print_db() as con:
+        out += [("postal_print_queue", "gauge", "Trabajos en la cola de impresión",
+                 {"dest": r["dest"], "state": r["state"]}, r["n"])
+                for r in con.execute("SELECT dest, state, COUNT(*) n FROM printq GROUP BY dest, state")]
+    out += [("postal_storage_bytes", "gauge", "Bytes en DATA_DIR por subdirectorio (última pasada)", {"dir": d}, n)
+            for d, n in sorted(STORAGE["dirs"].items())]
+    out += [("postal_storage_tier_bytes", "gauge", "Bytes en DATA_DIR por tier (última pasada)", {"tier": t}, n)
+            for t, n in sorted(STORAGE["tiers"].items())]
+    out += [
+        ("postal_storage_free_bytes", "gauge", "Libre en el disco de DATA_DIR (última pasada)", {}, STORAGE["free_bytes"]),
+        ("postal_storage_evicted_bytes_total", "counter", "Bytes liberados por cuota/retención", {}, STORAGE["evicted_bytes"]),
+    ]
+    out += [("postal_storage_evicted_total", "counter", "Archivos liberados por tier", {"tier": t}, n)
+            for t, n in STORAGE["evicted"].items()]
+    return out
+
+@app.get("/metrics")
+def metrics():
+    return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/profiles")
+def profiles_list():
+    if err := _profiles_denied():
+        return err
+    items = [dict(it, url=url_for("profile_get", name=it["name"])) for it in profiler.items()]
+    return jsonify(enabled=profiler.enabled, sample=PROFILE_SAMPLE,
+                   interval_ms=PROFILE_INTERVAL_MS, items=items)
+
+@app.get("/profiles/<name>")
+def profile_get(name):
+    if err := _profiles_denied():
+        return err
+    p = profiler.path(name)
+    if p is None:
+        return jsonify(ok=False, error="not_found"), 404
+    return send_file(p, mimetype="text/plain", as_attachment=request.args.get("download") == "1",
+                     download_name=name)
+
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify(ok=False, error="Too large", max_mb=MAX_UPLOAD_MB), 413
 
-    return jsonify(ok=True, code=code, view_url=view_url)
 # --- Silenciar peticiones de iconos (sin archivo) ---
 @app.route('/favicon.ico')
 @app.route('/apple-touch-icon.png')
@@ -392,5 +1287,8 @@ def no_favicon():
 # Arranque
 # =============================================================
 if __name__ == "__main__":
-    print(f"✅ App móvil lista en http://{HOST}:{PORT} · modo={AUTO_PRINT_MODE} · layout={PRINT_LAYOUT}")
+    log_event("start", url=f"http://{HOST}:{PORT}", print_mode=AUTO_PRINT_MODE, layout=PRINT_LAYOUT,
+              render_workers=RENDER_WORKERS)
+    print_start()  # vacía lo que quedó en cola antes de un reinicio
+    storage_start()
     serve(app, host=HOST, port=PORT)
@@ -0,0 +1,909 @@
+# postal_common.py
+# -------------------------------------------------------------
+# Piezas compartidas por las dos variantes de la app (app_online_movil.py en la raíz
+# y app/app_online_movil.py). Aquí no se lee el entorno: cada variante pasa su
+# configuración al construir o llamar lo que usa.
+# -------------------------------------------------------------
+
+import bisect, functools, hmac, io, json, logging, os, random, shutil, sqlite3, sys, threading, time, uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from PIL import Image
+
+# =============================================================
+# Métricas y logs
+# =============================================================
+# Registro propio en formato de texto de Prometheus (GET /metrics), sin dependencias:
+# histogramas de latencia por etapa (timed) y por ruta, contadores de resultados y gauges
+# que la variante calcula al leer (colas, trabajos, memoria…). Cada evento sale como una
+# línea JSON en el logger "postal".
+
+log = logging.getLogger("postal")
+
+def setup_logging(level: str) -> logging.Logger:
+    if not log.handlers:
+        h = logging.StreamHandler()
+        h.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        log.addHandler(h)
+        log.setLevel(level)
+        log.propagate = False
+    return log
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, json.dumps({"event": event, **fields}, ensure_ascii=False, default=str))
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRIC_HELP = {
+    "postal_stage_seconds":        ("histogram", "Duración de cada etapa (decode, exif, resize, jpeg, pdf, sumatra, sendgrid, remote_upload…)"),
+    "postal_job_stage_seconds":    ("histogram", "Duración de las etapas de un trabajo (render, print, remote), incluida la espera del pool"),
+    "postal_http_request_seconds": ("histogram", "Duración de las peticiones HTTP por ruta"),
+    "postal_http_requests_total":  ("counter",   "Peticiones HTTP por ruta, método y estado"),
+    "postal_http_in_flight":       ("gauge",     "Peticiones HTTP en curso"),
+    "postal_uploads_total":        ("counter",   "Subidas por resultado (ok o el error)"),
+    "postal_print_total":          ("counter",   "Intentos de impresión por destino y resultado"),
+    "postal_remote_upload_total":  ("counter",   "POSTs a la web principal por resultado (código HTTP o error)"),
+}
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _metric_line(name: str, labels, value, extra=()) -> str:
+    items = [*labels, *extra]
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    lab = "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}" if items else ""
+    return f"{name}{lab} {value:.6g}" if isinstance(value, float) else f"{name}{lab} {value}"
+
+class Metrics:
+    """
+    Registro de una variante. help: métricas propias (nombre → (tipo, ayuda)) sobre
+    METRIC_HELP; gauges(): [(nombre, tipo, ayuda, etiquetas, valor)] leídos en cada scrape.
+    """
+
+    def __init__(self, help: dict = None, gauges=None):
+        self.help = {**METRIC_HELP, **(help or {})}
+        self.gauges = gauges or (lambda: ())
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._hists = {}     # (nombre, etiquetas) → [cuenta por cubeta..., +Inf, suma]
+        self._counters = {}  # (nombre, etiquetas) → valor
+        self._tl = threading.local()  # etapas de la petición o del render en curso (ver stage_trace)
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            h = self._hists.get(key) or self._hists.setdefault(key, [0] * (len(METRIC_BUCKETS) + 1) + [0.0])
+            h[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            h[-1] += value
+
+    def inc(self, name: str, n: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Mide una etapa: la observa en postal_stage_seconds y la suma a la traza del hilo."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            acc = getattr(self._tl, "stages", None)
+            if acc is not None:
+                acc[stage] = acc.get(stage, 0.0) + dt
+            if not getattr(self._tl, "deferred", False):
+                self.observe("postal_stage_seconds", dt, stage=stage)
+
+    @contextmanager
+    def stage_trace(self, deferred: bool = False):
+        """
+        Acumula en un dict los timed() de este hilo. deferred=True no los observa aquí:
+        el render corre en un proceso worker y el principal observa las timings devueltas.
+        """
+        tl = self._tl
+        prev = getattr(tl, "stages", None), getattr(tl, "deferred", False)
+        tl.stages, tl.deferred = {}, deferred
+        try:
+            yield tl.stages
+        finally:
+            tl.stages, tl.deferred = prev
+
+    def text(self) -> str:
+        with self._lock:
+            hists = {k: list(v) for k, v in self._hists.items()}
+            counters = dict(self._counters)
+        series = {}
+        for (name, labels), h in sorted(hists.items()):
+            acc, lines = 0, []
+            for b, n in zip((*METRIC_BUCKETS, "+Inf"), h[:-1]):
+                acc += n
+                lines.append(_metric_line(name + "_bucket", labels, acc, (("le", b),)))
+            lines += [_metric_line(name + "_sum", labels, float(h[-1])), _metric_line(name + "_count", labels, acc)]
+            series.setdefault(name, []).extend(lines)
+        for (name, labels), v in sorted(counters.items()):
+            series.setdefault(name, []).append(_metric_line(name, labels, v))
+        gauges = [("postal_http_in_flight", "gauge", "", {}, self.in_flight), *self.gauges()]
+        for name, kind, help_, labels, v in gauges:
+            self.help.setdefault(name, (kind, help_))
+            if v is not None:
+                series.setdefault(name, []).append(_metric_line(name, _labels(labels), v))
+        out = []
+        for name in sorted(series):
+            kind, help_ = self.help.get(name, ("untyped", ""))
+            out += [f"# HELP {name} {help_}", f"# TYPE {name} {kind}", *series[name]]
+        return "\n".join(out) + "\n"
+
+    def instrument(self, app):
+        """Por petición: duración por ruta, peticiones en vuelo y una línea de log con sus etapas."""
+        from flask import g, request
+
+        @app.before_request
+        def _req_begin():
+            with self._lock:
+                self.in_flight += 1
+            g.t0 = time.perf_counter()
+            self._tl.stages, self._tl.deferred = {}, False
+
+        @app.after_request
+        def _req_status(resp):
+            g.status = resp.status_code
+            return resp
+
+        @app.teardown_request
+        def _req_end(exc):
+            if "t0" not in g:
+                return
+            with self._lock:
+                self.in_flight -= 1
+            secs, stages = time.perf_counter() - g.t0, getattr(self._tl, "stages", None) or {}
+            self._tl.stages = None
+            route = request.url_rule.rule if request.url_rule else "(sin ruta)"  # la plantilla, no el código
+            status = g.get("status", 500)
+            self.observe("postal_http_request_seconds", secs, route=route)
+            self.inc("postal_http_requests_total", route=route, method=request.method, status=status)
+            log_event("request", logging.DEBUG if route == "/metrics" else logging.INFO, method=request.method,
+                      route=route, status=status, ms=round(secs * 1000, 1),
+                      stages={k: round(v * 1000, 1) for k, v in stages.items()} or None)
+
+# =============================================================
+# PDF
+# =============================================================
+# Escritor mínimo: cada JPEG se incrusta tal cual como stream DCTDecode (sin recodificar
+# ni archivos temporales) y el PDF sale por trozos, a disco o a la respuesta. Los tiempos
+# los mide quien llama (timed("pdf") de su registro).
+
+CARD_IN = (7.0, 5.5)
+
+def write_atomic(path: Path, data: bytes):
+    """Escribe a un nombre temporal único y lo publica con os.replace."""
+    tmp = path.with_name(f".{uuid.uuid4().hex}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+def _jpeg_info(jpeg: bytes):
+    with Image.open(io.BytesIO(jpeg)) as im:
+        cs = {"L": "/DeviceGray", "RGB": "/DeviceRGB"}.get(im.mode)
+        if im.format != "JPEG" or not cs:
+            raise ValueError(f"JPEG no soportado: {im.format} {im.mode}")
+        return im.width, im.height, cs
+
+def card_page(jpeg: bytes):
+    """Página 7×5.5" con la postal a sangre."""
+    return (CARD_IN[0], CARD_IN[1], [(jpeg, 0, 0, CARD_IN[0], CARD_IN[1])])
+
+def iter_pdf(pages):
+    """
+    pages: iterable de (ancho_in, alto_in, [(jpeg, x, y, w, h), ...][, [(x1, y1, x2, y2), ...]])
+    en pulgadas, origen arriba a la izquierda; las líneas opcionales son trazos finos (marcas
+    de corte). Genera el PDF por trozos, una página cada vez.
+    """
+    pos, offsets, kids, nxt = 0, {}, [], 3  # 1 = Catalog, 2 = Pages (se escriben al final)
+
+    def obj(num, head, stream=None):
+        nonlocal pos
+        parts = [f"{num} 0 obj\n{head}\n".encode()]
+        if stream is not None:
+            parts += [b"stream\n", stream, b"\nendstream\n"]
+        parts.append(b"endobj\n")
+        offsets[num] = pos
+        pos += sum(map(len, parts))
+        return parts
+
+    head = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    pos = len(head)
+    yield head
+    for pw, ph, images, *lines in pages:
+        xobjs, ops = [], []
+        for i, (jpeg, x, y, w, h) in enumerate(images):
+            iw, ih, cs = _jpeg_info(jpeg)
+            num, nxt = nxt, nxt + 1
+            yield from obj(num, f"<< /Type /XObject /Subtype /Image /Width {iw} /Height {ih} /ColorSpace {cs}"
+                                f" /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>", jpeg)
+            xobjs.append(f"/Im{i} {num} 0 R")
+            ops.append(f"q {w * 72:.2f} 0 0 {h * 72:.2f} {x * 72:.2f} {(ph - y - h) * 72:.2f} cm /Im{i} Do Q")
+        if lines and lines[0]:
+            ops.append("q 0 G 0.5 w " + " ".join(f"{x1 * 72:.2f} {(ph - y1) * 72:.2f} m {x2 * 72:.2f} {(ph - y2) * 72:.2f} l"
+                                                 for x1, y1, x2, y2 in lines[0]) + " S Q")
+        content = "\n".join(ops).encode()
+        cnum, pnum, nxt = nxt, nxt + 1, nxt + 2
+        yield from obj(cnum, f"<< /Length {len(content)} >>", content)
+        yield from obj(pnum, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw * 72:.2f} {ph * 72:.2f}]"
+                             f" /Resources << /XObject << {' '.join(xobjs)} >> >> /Contents {cnum} 0 R >>")
+        kids.append(f"{pnum} 0 R")
+    yield from obj(2, f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>")
+    yield from obj(1, "<< /Type /Catalog /Pages 2 0 R >>")
+    xref = "".join(f"{offsets[i]:010d} 00000 n \n" for i in range(1, nxt))
+    yield (f"xref\n0 {nxt}\n0000000000 65535 f \n{xref}"
+           f"trailer\n<< /Size {nxt} /Root 1 0 R >>\nstartxref\n{pos}\n%%EOF\n").encode()
+
+def write_pdf(pages, pdf_path: Path):
+    """Escribe el PDF por trozos a un nombre parcial único y lo publica con os.replace."""
+    part = pdf_path.with_name(f".{pdf_path.name}.{uuid.uuid4().hex[:8]}.part")
+    with open(part, "wb") as f:
+        for chunk in iter_pdf(pages):
+            f.write(chunk)
+    os.replace(part, pdf_path)
+
+# =============================================================
+# Codificador con presupuesto
+# =============================================================
+# Busca la mayor resolución (hasta el suelo de píxeles) y, en ella, la mejor calidad y
+# submuestreo que caben en N bytes. Lo elegido se recuerda por clave (layout, color,
+# presupuesto) en un JSON: las postales siguientes aciertan a la primera.
+
+class BudgetEncoder:
+    def __init__(self, params_path: Path, min_q: int = 50, min_px: int = 1000):
+        self.path, self.min_q, self.min_px = Path(params_path), min_q, min_px
+        self._params = {}
+
+    def _load(self, key: str):
+        if key not in self._params:
+            try:
+                self._params.update(json.loads(self.path.read_text()))
+            except (FileNotFoundError, ValueError):
+                pass
+        return self._params.get(key)
+
+    def _save(self, key: str, params: dict):
+        self._params[key] = params
+        try:
+            cur = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            cur = {}
+        cur[key] = params
+        write_atomic(self.path, json.dumps(cur, indent=1).encode())
+
+    @staticmethod
+    def _scaled(img: Image.Image, scale: float) -> Image.Image:
+        if scale >= 1:
+            return img
+        return img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS, reducing_gap=2.0)
+
+    @staticmethod
+    def _jpeg(img: Image.Image, quality: int, subsampling) -> bytes:
+        buf = io.BytesIO()
+        extra = {} if subsampling is None else {"subsampling": subsampling}
+        img.save(buf, "JPEG", quality=quality, optimize=True, **extra)
+        return buf.getvalue()
+
+    def encode(self, img: Image.Image, budget: int, key: str, min_q: int = None, min_px: int = None) -> tuple:
+        """
+        JPEG de img en ≤ budget bytes → (bytes, params). Prueba antes los parámetros recordados
+        para key; sólo busca otra vez si ya no caben o desperdician más de un 25 % del presupuesto.
+        """
+        min_q = min_q or self.min_q
+        floor = min(1.0, (min_px or self.min_px) / max(img.size))
+        p = self._load(key)
+        if p:
+            data = self._jpeg(self._scaled(img, p["scale"]), p["quality"], p["subsampling"])
+            if len(data) <= budget and (len(data) >= 0.75 * budget or (p["quality"] >= 95 and p["scale"] >= 1)):
+                return data, p
+        subs = (None,) if img.mode == "L" else (0, 2)  # color: 4:4:4 y 4:2:0
+        best, scale = None, 1.0
+        while True:
+            im = self._scaled(img, scale)
+            for ss in subs:  # búsqueda binaria de la calidad
+                lo, hi = min_q, 95
+                while lo <= hi:
+                    q = (lo + hi) // 2
+                    data = self._jpeg(im, q, ss)
+                    if len(data) <= budget:
+                        if not best or q > best[0]["quality"]:
+                            best = ({"scale": scale, "quality": q, "subsampling": ss}, data)
+                        lo = q + 1
+                    else:
+                        hi = q - 1
+            if best or scale <= floor:
+                break
+            scale = max(floor, round(scale * 0.85, 3))
+        if not best:  # ni en el suelo cabe: lo más pequeño permitido
+            ss = subs[-1]
+            best = ({"scale": floor, "quality": min_q, "subsampling": ss}, self._jpeg(self._scaled(img, floor), min_q, ss))
+        self._save(key, best[0])
+        return best[1], best[0]
+
+# =============================================================
+# Scripts del navegador (/capturar)
+# =============================================================
+# Recorte/escalado/JPEG según /capture_profile. El mismo script se carga como Worker
+# (OffscreenCanvas, fuera del hilo principal) y como <script> de respaldo.
+CAPTURE_JS = """// capture.js
+function fitCrop(w, h, p){
+  const a = p.width / p.height;
+  let sw = w, sh = h;
+  if (w / h > a) sw = Math.round(h * a); else sh = Math.round(w / a);
+  const sx = p.anchor === 'left' ? 0 : p.anchor === 'right' ? w - sw : Math.round((w - sw) / 2);
+  const sy = p.anchor === 'top' ? 0 : p.anchor === 'bottom' ? h - sh : Math.round((h - sh) / 2);
+  const k = Math.min(1, p.width / sw);            // nunca amplía: si falta resolución, lo hace el servidor
+  return [sx, sy, sw, sh, Math.round(sw * k), Math.round(sh * k)];
+}
+async function encodeCapture(src, p){
+  const bmp = (typeof ImageBitmap !== 'undefined' && src instanceof ImageBitmap) ? src
+            : await createImageBitmap(src, src instanceof Blob ? {imageOrientation: 'from-image'} : {});
+  const [sx, sy, sw, sh, w, h] = fitCrop(bmp.width, bmp.height, p);
+  const c = typeof OffscreenCanvas !== 'undefined' ? new OffscreenCanvas(w, h)
+          : Object.assign(document.createElement('canvas'), {width: w, height: h});
+  const g = c.getContext('2d');
+  g.imageSmoothingEnabled = true; g.imageSmoothingQuality = 'high';
+  g.drawImage(bmp, sx, sy, sw, sh, 0, 0, w, h);
+  if (bmp.close) bmp.close();
+  const enc = q => c.convertToBlob ? c.convertToBlob({type: p.mime, quality: q})
+                                   : new Promise(r => c.toBlob(r, p.mime, q));
+  let q = p.quality, blob = await enc(q);
+  while (blob.size > p.max_bytes && q > p.min_quality){   // baja calidad hasta caber en el presupuesto
+    q = Math.max(p.min_quality, q - 0.06); blob = await enc(q);
+  }
+  return {blob, width: w, height: h, quality: q};
+}
+if (typeof document === 'undefined'){
+  self.onmessage = async e => {
+    const {id, src, profile} = e.data;
+    try { self.postMessage(Object.assign({id}, await encodeCapture(src, profile))); }
+    catch (err){ self.postMessage({id, error: String(err)}); }
+  };
+}
+"""
+
+# Cola de capturas en IndexedDB. El mismo script es el service worker (/outbox.js, vacía
+# la cola aunque la pestaña esté ocupada o sin red) y el respaldo en la página si no hay SW.
+# Cada variante aporta upload(it) → {code, view_url} con su protocolo (ver outbox_js); lo
+# que siga tras un envío (p. ej. esperar el trabajo del servidor) lo entrega a after(p) y
+# el bombeo no termina, ni suelta el service worker, hasta que acaba.
+# Página, SW y otras pestañas comparten la cola: vacía uno solo a la vez (Web Lock
+# 'outbox'), cada envío se reclama en una transacción (queued → sending con su dueño) y el
+# dueño refresca updated mientras sube; sólo un envío sin latido en STALE_MS (su contexto
+# murió) vuelve a reclamarse. Sin esto la variante de la raíz imprimiría la postal dos veces.
+_OUTBOX_CORE = """// outbox.js
+const OUTBOX_DB = 'capturas', PARALLEL = 2, MAX_TRIES = 12, STALE_MS = 120e3;
+const IN_SW = typeof ServiceWorkerGlobalScope !== 'undefined' && self instanceof ServiceWorkerGlobalScope;
+const OWNER = Date.now().toString(36) + Math.random().toString(36).slice(2, 8);   // este contexto
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+class Fatal extends Error {}   // no se reintenta (imagen inválida, demasiado grande…)
+class Later extends Error {    // 429: servidor saturado; se reintenta tras Retry-After sin gastar intento
+  constructor(msg, secs){ super(msg); this.after = 1000 * (secs || 5); }
+}
+
+function idb(){
+  return idb.p || (idb.p = new Promise((ok, ko) => {
+    const r = indexedDB.open(OUTBOX_DB, 1);
+    r.onupgradeneeded = () => r.result.createObjectStore('items', {keyPath: 'id'});
+    r.onsuccess = () => ok(r.result); r.onerror = () => ko(r.error);
+  }));
+}
+function req(r){ return new Promise((ok, ko) => { r.onsuccess = () => ok(r.result); r.onerror = () => ko(r.error); }); }
+async function items(mode){ return (await idb()).transaction('items', mode).objectStore('items'); }
+async function outboxAll(){ return req((await items('readonly')).getAll()); }
+async function outboxPut(it){ it.updated = Date.now(); await req((await items('readwrite')).put(it)); notify(it); return it; }
+async function outboxDel(id){ await req((await items('readwrite')).delete(id)); notify({id, deleted: true}); }
+async function outboxAdd(blob){
+  const id = Date.now().toString(36) + Math.random().toString(36).slice(2, 6);
+  return outboxPut({id, blob, size: blob.size, created: Date.now(), state: 'queued', tries: 0, next_at: 0, sent: 0});
+}
+async function outboxRetry(id){
+  const it = (await outboxAll()).find(x => x.id === id);
+  if (it && it.state === 'failed') await outboxPut(Object.assign(it, {state: 'queued', tries: 0, next_at: 0, error: ''}));
+}
+function notify(it){
+  const m = {type: 'outbox', item: Object.assign({}, it, {blob: undefined})};
+  if (IN_SW) self.clients.matchAll({includeUncontrolled: true}).then(cs => cs.forEach(c => c.postMessage(m)));
+  else if (self.onOutbox) self.onOutbox(m);
+}
+
+/*UPLOAD*/
+// ---- Bombeo: PARALLEL subidas a la vez, backoff exponencial por elemento
+function claimable(it, now){
+  return (it.state === 'queued' && it.next_at <= now) || (it.state === 'sending' && now - it.updated > STALE_MS);
+}
+async function claim(id){   // get + put en la misma transacción: dos contextos no se llevan el mismo
+  const st = await items('readwrite'), it = await req(st.get(id));
+  if (!it || !claimable(it, Date.now())) return null;
+  Object.assign(it, {state: 'sending', owner: OWNER, tries: it.tries + 1, updated: Date.now()});
+  await req(st.put(it)); notify(it);
+  return it;
+}
+async function heartbeat(id){
+  const st = await items('readwrite'), it = await req(st.get(id));
+  if (it && it.state === 'sending' && it.owner === OWNER){ it.updated = Date.now(); await req(st.put(it)); }
+}
+async function send(id){
+  const it = await claim(id);
+  if (!it) return;
+  const beat = setInterval(() => heartbeat(id).catch(() => {}), STALE_MS / 4);
+  try{
+    const r = await upload(it);
+    Object.assign(it, {state: 'done', code: r.code, view_url: r.view_url || '', error: '', blob: null});
+  }catch(e){
+    it.error = String((e && e.message) || e);
+    if (e instanceof Later) Object.assign(it, {state: 'queued', tries: it.tries - 1, next_at: Date.now() + e.after});
+    else if (e instanceof Fatal || it.tries >= MAX_TRIES) it.state = 'failed';
+    else Object.assign(it, {state: 'queued', next_at: Date.now() + Math.min(300e3, 1000 * 2 ** it.tries)});
+  }finally{ clearInterval(beat); }
+  await outboxPut(it);
+}
+const follow = new Set();
+function after(p){ follow.add(p); p.catch(() => {}).finally(() => follow.delete(p)); }
+let pumping = null, nudge = () => {};
+function pump(){
+  const locks = self.navigator && self.navigator.locks;   // sin contexto seguro no hay: queda el reclamo
+  nudge();   // si ya bombea, que no espere al backoff para ver lo recién encolado
+  return pumping || (pumping = (locks ? locks.request('outbox', drain) : drain()).finally(() => { pumping = null; }));
+}
+async function drain(){
+  const busy = new Map();
+  for (;;){
+    const now = Date.now(), all = await outboxAll();
+    for (const it of all) if (it.state === 'done' && now - it.updated > 86400e3) await outboxDel(it.id);
+    const ready = all.filter(it => claimable(it, now) && !busy.has(it.id)).sort((a, b) => a.created - b.created);
+    while (busy.size < PARALLEL && ready.length){
+      const id = ready.shift().id;
+      busy.set(id, send(id).finally(() => busy.delete(id)));
+    }
+    if (busy.size){ await Promise.race(busy.values()); continue; }
+    const later = all.filter(it => it.state === 'queued').map(it => it.next_at)   // y lo que sube otro contexto,
+      .concat(all.filter(it => it.state === 'sending').map(it => it.updated + STALE_MS));   // por si muere
+    if (!later.length && !follow.size) return;
+    await Promise.race([sleep(later.length ? Math.max(250, Math.min(...later) - Date.now()) : 60e3),
+                        new Promise(r => { nudge = r; }), ...follow]);
+  }
+}
+
+if (IN_SW){
+  self.addEventListener('install', () => self.skipWaiting());
+  self.addEventListener('activate', e => e.waitUntil(self.clients.claim()));
+  self.addEventListener('message', e => { if (e.data === 'flush') e.waitUntil(pump()); });
+  self.addEventListener('sync', e => { if (e.tag === 'outbox') e.waitUntil(pump()); });
+}
+"""
+
+def outbox_js(upload: str) -> str:
+    """outbox.js con la función upload(it) de la variante (lanza Fatal/Later/Error si falla)."""
+    return _OUTBOX_CORE.replace("/*UPLOAD*/\n", upload)
+
+# =============================================================
+# Perfilado bajo demanda
+# =============================================================
+# @profiler.profiled en las rutas calientes: si la petición trae X-Profile: <token> o cae
+# en la fracción sample, un hilo muestrea la pila del hilo de la petición cada interval_ms
+# (sys._current_frames, sin trazar cada llamada) y guarda las pilas plegadas ("f1;f2;f3 N",
+# lo que leen flamegraph.pl y speedscope) en dir. Si no toca, el coste es una comparación.
+# Sólo ve el hilo de la petición: el render en segundo plano tiene sus tiempos en /metrics.
+
+class Profiler:
+    def __init__(self, dir: Path, token: str = "", sample: float = 0.0, interval_ms: float = 5.0, keep: int = 50):
+        self.dir, self.token, self.sample = Path(dir), token, sample
+        self.interval_ms, self.keep = interval_ms, keep
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token or self.sample)
+
+    def allowed(self) -> bool:
+        """¿Puede esta petición leer los perfiles? Con token, sólo quien lo trae (X-Profile o ?token=)."""
+        from flask import request
+        if not self.token:
+            return True
+        got = request.headers.get("X-Profile") or request.args.get("token") or ""
+        return hmac.compare_digest(got, self.token)
+
+    def _want(self) -> bool:
+        from flask import request
+        got = request.headers.get("X-Profile")
+        if self.token and got and hmac.compare_digest(got, self.token):
+            return True
+        return self.sample > 0 and random.random() < self.sample
+
+    def _sample_stacks(self, tid: int, stop: threading.Event, stacks: dict):
+        interval = max(0.001, self.interval_ms / 1000)
+        while not stop.wait(interval):
+            f = sys._current_frames().get(tid)
+            frames = []
+            while f is not None:
+                c = f.f_code
+                frames.append(f"{c.co_name} ({os.path.basename(c.co_filename)}:{c.co_firstlineno})")
+                f = f.f_back
+            if frames:
+                key = ";".join(reversed(frames))
+                stacks[key] = stacks.get(key, 0) + 1
+
+    def save(self, endpoint: str, secs: float, stacks: dict) -> str:
+        self.dir.mkdir(exist_ok=True)
+        name = f"{datetime.now():%Y%m%d-%H%M%S}_{endpoint}_{round(secs * 1000)}ms_{uuid.uuid4().hex[:6]}.folded"
+        write_atomic(self.dir / name, "".join(f"{k} {n}\n" for k, n in sorted(stacks.items())).encode())
+        for old in sorted(self.dir.glob("*.folded"), key=lambda p: p.stat().st_mtime)[:-self.keep or None]:
+            try:
+                old.unlink()
+            except FileNotFoundError:
+                pass
+        return name
+
+    def profiled(self, fn):
+        """Perfila la vista si la petición lo pide (X-Profile) o sale en el muestreo; si no, la llama tal cual."""
+        from flask import make_response, request
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self._want():
+                return fn(*args, **kwargs)
+            stacks, stop = {}, threading.Event()
+            t = threading.Thread(target=self._sample_stacks, args=(threading.get_ident(), stop, stacks),
+                                 name="profiler", daemon=True)
+            t0 = time.perf_counter()
+            t.start()
+            try:
+                rv = fn(*args, **kwargs)
+            finally:
+                stop.set()
+                t.join()
+                secs = time.perf_counter() - t0
+                name = self.save(request.endpoint, secs, stacks)
+                log_event("profile", endpoint=request.endpoint, ms=round(secs * 1000, 1),
+                          samples=sum(stacks.values()), file=name)
+            resp = make_response(rv)
+            resp.headers["X-Profile-Id"] = name
+            return resp
+        return wrapper
+
+    def items(self) -> list:
+        """Perfiles guardados, el más reciente primero."""
+        out = []
+        for p in sorted(self.dir.glob("*.folded"), key=lambda p: p.stat().st_mtime, reverse=True):
+            endpoint, ms, _ = p.stem.split("_", 1)[-1].rsplit("_", 2)  # <fecha>_<endpoint>_<N>ms_<id>
+            out.append({"name": p.name, "endpoint": endpoint, "ms": int(ms[:-2]), "bytes": p.stat().st_size,
+                        "created": p.stat().st_mtime})
+        return out
+
+    def path(self, name: str):
+        """Ruta del perfil name, o None si no es un perfil guardado (sin salir de dir)."""
+        p = self.dir / name
+        if Path(name).name != name or p.suffix != ".folded" or not p.exists():
+            return None
+        return p
+
+# =============================================================
+# Almacenamiento
+# =============================================================
+# Cuota del directorio de datos. Si pasa de quota_mb (o al disco le quedan menos de
+# min_free_mb) cada pasada libera hasta el low_pct en dos tiers:
+#   1) lo regenerable (tier_of → "derivative"), el menos usado primero; nunca lo usado hace
+#      menos de min_age ni lo de un código en protected();
+#   2) originales que la variante da por retirables (retirable: ya subidos y con más de
+#      retention_days): se mueven a archive (copia acotada a io_mb/s) o se borran.
+# El uso no se mide recorriendo el disco: un ledger SQLite (storage.sqlite3) tiene una fila
+# por archivo (inodo, bytes, directorio, tier, último uso) y hay contadores de bytes por
+# directorio y por tier que se ajustan en cada note()/forget(). La variante llama a note()
+# al escribir y a touch() al usar: el último uso es explícito (atime con relatime y mtime
+# no dicen cuándo se leyó). Lo que se escribe sin avisar (un worker de otro proceso, a
+# mano) lo recoge reconcile(): cada pasada revisa como mucho batch archivos y sigue donde
+# lo dejó la anterior; sólo la primera vuelta con el ledger vacío recorre todo de una vez.
+
+def file_code(path: Path) -> str:
+    """Código de la postal de un archivo (<code>.jpg, <code>_print.jpg, <code>_600x450.jpg…)."""
+    return Path(path).name.split("_", 1)[0].split(".", 1)[0]
+
+class Storage:
+    def __init__(self, data: Path, quota_mb: float = 0, min_free_mb: float = 0, low_pct: float = 90,
+                 sweep_secs: float = 60, min_age: float = 600, batch: int = 200, io_mb: float = 20,
+                 retention_days: float = 0, archive: str = "", chunk: int = 1024 * 1024,
+                 tier_of=None, protected=None, retirable=None, on_evict=None, on_retired=None, before_sweep=None):
+        self.data, self.db_path = Path(data), Path(data) / "storage.sqlite3"
+        self.quota_mb, self.min_free_mb, self.low_pct = quota_mb, min_free_mb, low_pct
+        self.sweep_secs, self.min_age, self.batch, self.io_mb = sweep_secs, min_age, batch, io_mb
+        self.retention_days, self.archive, self.chunk = retention_days, archive, chunk
+        self.tier_of = tier_of or (lambda path: "other")               # "derivative" | "original" | "other"
+        self.protected = protected or set                              # códigos que no se tocan
+        self.retirable = retirable or (lambda now, limit: [])          # [(code, ruta, creado)], viejos primero
+        self.on_evict = on_evict or (lambda paths: None)
+        self.on_retired = on_retired or (lambda code, dest, size: None)
+        self.before_sweep = before_sweep or (lambda: None)
+        self.status = {"usage_bytes": 0, "dirs": {}, "tiers": {}, "free_bytes": None, "need_bytes": 0,
+                       "over": False, "evicted": {"derivative": 0, "original": 0}, "evicted_bytes": 0,
+                       "archived": 0, "sweeps": 0, "last_sweep": None, "last_secs": None, "last_error": None}
+        self._lock, self._sweep_lock, self._used_lock = threading.RLock(), threading.Lock(), threading.Lock()
+        self._dirs, self._tiers, self._used = {}, {}, {}
+        self._loaded = self._bootstrap = False
+        self._walk = self._walk_dirs = None
+        self._wake, self._thread = threading.Event(), None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.quota_mb or self.min_free_mb)
+
+    # -------- ledger --------
+    @contextmanager
+    def _ledger(self):
+        with self._lock:
+            con = sqlite3.connect(self.db_path, timeout=30)
+            con.row_factory = sqlite3.Row
+            try:
+                with con:
+                    if not self._loaded:
+                        self._load(con)
+                    yield con
+            finally:
+                con.close()
+
+    def _load(self, con):
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("""CREATE TABLE IF NOT EXISTS files(
+            path TEXT PRIMARY KEY, parent TEXT NOT NULL, ino TEXT NOT NULL, bytes INTEGER NOT NULL,
+            dir TEXT NOT NULL, tier TEXT NOT NULL, code TEXT NOT NULL, last_used REAL NOT NULL)""")
+        con.execute("CREATE INDEX IF NOT EXISTS files_ino ON files(ino)")
+        con.execute("CREATE INDEX IF NOT EXISTS files_parent ON files(parent)")
+        con.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value REAL)")
+        # un inodo (varios enlaces duros) cuenta una vez, en el directorio/tier de su ruta menor
+        for r in con.execute("SELECT dir, tier, bytes, MIN(path) FROM files GROUP BY ino"):
+            self._count((r["dir"], r["tier"], r["bytes"]), 1)
+        self._bootstrap = not con.execute("SELECT 1 FROM meta WHERE key='cycle'").fetchone()
+        self._loaded = True
+
+    def _count(self, owner, sign: int):
+        if owner:
+            d, tier, n = owner
+            self._dirs[d] = self._dirs.get(d, 0) + sign * n
+            self._tiers[tier] = self._tiers.get(tier, 0) + sign * n
+
+    @staticmethod
+    def _owner(con, ino: str):
+        r = con.execute("SELECT dir, tier, bytes, MIN(path) FROM files WHERE ino=?", (ino,)).fetchone()
+        return None if r["bytes"] is None else (r["dir"], r["tier"], r["bytes"])
+
+    def _change(self, con, inos, fn):
+        """Aplica fn al ledger y mueve los bytes de los inodos afectados en los contadores."""
+        inos = {i for i in inos if i}
+        before = {i: self._owner(con, i) for i in inos}
+        fn()
+        for i in inos:
+            self._count(before[i], -1)
+            self._count(self._owner(con, i), 1)
+
+    def _put(self, con, path: str, st, used: float):
+        p = Path(path)
+        try:
+            rel = p.relative_to(self.data).parts
+        except ValueError:
+            return
+        old = con.execute("SELECT ino FROM files WHERE path=?", (path,)).fetchone()
+        ino = f"{st.st_dev}:{st.st_ino}"
+
+        def put():
+            con.execute("""INSERT INTO files(path, parent, ino, bytes, dir, tier, code, last_used)
+                           VALUES(?,?,?,?,?,?,?,?) ON CONFLICT(path) DO UPDATE SET ino=excluded.ino,
+                           bytes=excluded.bytes, last_used=MAX(last_used, excluded.last_used)""",
+                        (path, str(p.parent), ino, st.st_size, rel[0] if len(rel) > 1 else ".",
+                         self.tier_of(p), file_code(p), used))
+            con.execute("UPDATE files SET bytes=? WHERE ino=?", (st.st_size, ino))
+        self._change(con, (ino, old and old["ino"]), put)
+
+    def _drop(self, con, path: str):
+        old = con.execute("SELECT ino FROM files WHERE path=?", (path,)).fetchone()
+        if old:
+            self._change(con, (old["ino"],), lambda: con.execute("DELETE FROM files WHERE path=?", (path,)))
+
+    def note(self, path, used: float = None):
+        """Apunta un archivo que esta variante acaba de escribir (o reescribir) en data."""
+        if not self.enabled:
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return self.forget(path)
+        with self._ledger() as con:
+            self._put(con, str(path), st, time.time() if used is None else used)
+
+    def forget(self, path):
+        """Quita del ledger un archivo borrado."""
+        if self.enabled:
+            with self._ledger() as con:
+                self._drop(con, str(path))
+
+    def touch(self, path):
+        """Marca un uso (LRU del tier 1); se vuelca al ledger en la siguiente pasada."""
+        if self.enabled:
+            with self._used_lock:
+                self._used[str(path)] = time.time()
+
+    def _flush(self, con):
+        with self._used_lock:
+            used, self._used = self._used, {}
+        con.executemany("UPDATE files SET last_used=MAX(last_used, ?) WHERE path=?",
+                        [(t, p) for p, t in used.items()])
+
+    # -------- reconciliación --------
+    def _walk_files(self):
+        for root, _, files in os.walk(self.data):
+            for f in files:
+                yield os.path.join(root, f)
+            yield root, set(files)  # fin de directorio: lo apuntado que no está ya no existe
+        yield None                  # fin de vuelta
+
+    def reconcile(self, limit: int = None) -> bool:
+        """Revisa como mucho limit archivos (batch) desde donde quedó la pasada anterior:
+        corrige lo que cambió sin note()/forget(). True si con esta se cerró una vuelta."""
+        limit, n = self.batch if limit is None else limit, 0
+        with self._ledger() as con:
+            while n < limit:
+                if self._walk is None:
+                    self._walk, self._walk_dirs = self._walk_files(), set()
+                item = next(self._walk)
+                if item is None:  # directorios que ya no existen
+                    for r in con.execute("SELECT DISTINCT parent FROM files").fetchall():
+                        if r["parent"] not in self._walk_dirs and not os.path.isdir(r["parent"]):
+                            for f in con.execute("SELECT path FROM files WHERE parent=?", (r["parent"],)).fetchall():
+                                self._drop(con, f["path"])
+                    con.execute("INSERT OR REPLACE INTO meta(key, value) VALUES('cycle', ?)", (time.time(),))
+                    self._walk = None
+                    return True
+                if isinstance(item, tuple):
+                    root, names = item
+                    self._walk_dirs.add(root)
+                    for r in con.execute("SELECT path FROM files WHERE parent=?", (root,)).fetchall():
+                        if os.path.basename(r["path"]) not in names and not os.path.exists(r["path"]):
+                            self._drop(con, r["path"])
+                    continue
+                n += 1
+                try:
+                    st = os.stat(item)
+                except FileNotFoundError:
+                    self._drop(con, item)
+                    continue
+                row = con.execute("SELECT ino, bytes FROM files WHERE path=?", (item,)).fetchone()
+                if not row or row["ino"] != f"{st.st_dev}:{st.st_ino}" or row["bytes"] != st.st_size:
+                    self._put(con, item, st, st.st_mtime)  # sin uso conocido: cuenta desde que se escribió
+        return False
+
+    # -------- pasadas --------
+    def _archive_file(self, src: Path, created: float) -> str:
+        """Mueve el original al archivo (copia acotada a io_mb/s) o lo borra; devuelve el destino."""
+        if not self.archive:
+            src.unlink(missing_ok=True)
+            return "deleted"
+        dst = Path(self.archive) / datetime.fromtimestamp(created).strftime("%Y-%m-%d") / src.name
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        part = dst.with_name(f".{dst.name}.{uuid.uuid4().hex[:8]}.part")
+        rate = max(0.1, self.io_mb) * 2 ** 20
+        with open(src, "rb") as f, open(part, "wb") as out:
+            t0, n = time.monotonic(), 0
+            for chunk in iter(lambda: f.read(self.chunk), b""):
+                out.write(chunk)
+                n += len(chunk)
+                ahead = n / rate - (time.monotonic() - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(part, dst)
+        src.unlink()
+        return str(dst)
+
+    def _evict(self, need: int, now: float, limit: int) -> tuple:
+        """Tier 1: inodos regenerables por su último uso (el de cualquiera de sus enlaces)."""
+        protected, victims, freed, files = self.protected(), [], 0, 0
+        with self._ledger() as con:
+            cur = con.execute("""SELECT MAX(bytes) AS bytes, MAX(last_used) AS used,
+                                        GROUP_CONCAT(path, char(0)) AS paths, GROUP_CONCAT(code, char(0)) AS codes
+                                 FROM files GROUP BY ino HAVING MIN(tier='derivative')=1 AND used<?
+                                 ORDER BY used""", (now - self.min_age,))
+            for r in cur:
+                if freed >= need or files >= limit:
+                    break
+                if protected.intersection(r["codes"].split("\0")):
+                    continue
+                paths = r["paths"].split("\0")
+                victims += paths
+                freed += r["bytes"]
+                files += len(paths)
+            cur.close()
+            for p in victims:
+                Path(p).unlink(missing_ok=True)
+                self._drop(con, p)
+        if victims:
+            self.on_evict([Path(p) for p in victims])
+        self.status["evicted"]["derivative"] += files
+        return freed, files
+
+    def _retire(self, need: int, now: float, limit: int) -> tuple:
+        """Tier 2: originales retirables, los más viejos primero."""
+        freed, files = 0, 0
+        for code, src, created in self.retirable(now, limit):
+            if freed >= need:
+                break
+            try:
+                size = src.stat().st_size
+                dest = self._archive_file(src, created)
+            except FileNotFoundError:
+                size, dest = 0, "missing"
+            self.forget(src)
+            self.on_retired(code, dest, size)
+            freed += size
+            files += 1
+            self.status["evicted"]["original"] += 1
+            self.status["archived"] += dest not in ("deleted", "missing")
+            log_event("original_retired", code=code, dest=dest, bytes=size)
+        return freed, files
+
+    def sweep(self) -> bool:
+        """Una pasada acotada; True si aún queda por liberar (la siguiente conviene ya)."""
+        with self._sweep_lock:
+            t0, now = time.perf_counter(), time.time()
+            self.before_sweep()
+            if not self._loaded:
+                with self._ledger():
+                    pass
+            if self._bootstrap:  # ledger nuevo: una vuelta completa, por trozos para no acaparar el lock
+                while not self.reconcile(self.batch * 50):
+                    pass
+                self._bootstrap = False
+            else:
+                self.reconcile()
+            with self._ledger() as con:
+                self._flush(con)
+            used, free = sum(self._dirs.values()), shutil.disk_usage(self.data).free
+            low, need = self.low_pct / 100, 0
+            draining = self.status["need_bytes"] > 0  # una pasada anterior no llegó al low_pct
+            if self.quota_mb and (used > self.quota_mb * 2 ** 20 or draining):
+                need = max(0, used - int(self.quota_mb * 2 ** 20 * low))
+            if self.min_free_mb and (free < self.min_free_mb * 2 ** 20 or draining):
+                need = max(need, int(self.min_free_mb * 2 ** 20 / low) - free, 0)
+            freed, touched = 0, 0
+            if need > 0:
+                freed, touched = self._evict(need, now, self.batch)
+            if need > freed and self.retention_days > 0 and touched < self.batch:
+                f, t = self._retire(need - freed, now, self.batch - touched)
+                freed, touched = freed + f, touched + t
+            pending = need > freed and touched >= self.batch
+            if need > freed and not pending and not self.status["over"]:  # se avisa al entrar, no en cada pasada
+                log_event("storage_over", logging.WARNING, used_mb=round(used / 2 ** 20),
+                          free_mb=round(free / 2 ** 20), short_mb=round((need - freed) / 2 ** 20))
+            self.status.update(usage_bytes=sum(self._dirs.values()), dirs=dict(self._dirs), tiers=dict(self._tiers),
+                               free_bytes=free + freed, need_bytes=max(0, need - freed), over=need > freed,
+                               sweeps=self.status["sweeps"] + 1, last_sweep=now,
+                               last_secs=round(time.perf_counter() - t0, 3))
+            self.status["evicted_bytes"] += freed
+            if touched:
+                log_event("storage_sweep", freed_mb=round(freed / 2 ** 20, 1), files=touched,
+                          used_mb=round((used - freed) / 2 ** 20))
+            return pending
+
+    def _worker(self):
+        while True:
+            try:
+                again = self.sweep()
+            except Exception as e:
+                again = False
+                self.status["last_error"] = str(e)
+                log_event("storage_error", logging.ERROR, error=str(e))
+            self._wake.wait(1.0 if again else self.sweep_secs)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread or not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._worker, name="storage", daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict:
+        return dict(self.status, enabled=self.enabled, quota_mb=self.quota_mb, min_free_mb=self.min_free_mb,
+                    low_pct=self.low_pct, retention_days=self.retention_days, archive=self.archive or None)
@@ -0,0 +1,49 @@
+# Utilidades comunes: cada prueba importa app/app_online_movil.py de cero, con su propio
+# DATA_DIR y entorno (la configuración se lee al importar).
+import importlib.util, io, sys, time
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+APP = Path(__file__).resolve().parents[1] / "app" / "app_online_movil.py"
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    def load(**env):
+        base = {"DATA_DIR": tmp_path / "data", "RENDER_WORKERS": "0", "LOG_LEVEL": "WARNING",
+                "UPLOAD_JWT_SECRET": "pruebas-" + "x" * 32}
+        for k, v in {**base, **env}.items(): monkeypatch.setenv(k, str(v))
+        spec = importlib.util.spec_from_file_location("app_online_movil", APP)
+        m = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, "app_online_movil", m)
+        spec.loader.exec_module(m)
+        return m
+    return load
+
+
+def wait_for(pred, timeout=10.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if pred(): return True
+        time.sleep(0.02)
+    return False
+
+
+def jpeg(color=(200, 120, 40), size=(640, 480)) -> bytes:
+    b = io.BytesIO()
+    Image.new("RGB", size, color).save(b, "JPEG")
+    return b.getvalue()
+
+
+def upload(m, data: bytes, **query) -> dict:
+    """POST /upload con ticket y espera a que termine su trabajo (si lo hay)."""
+    c = m.app.test_client()
+    tk = c.post("/upload_ticket").get_json()["ticket"]
+    qs = "".join(f"&{k}={v}" for k, v in query.items())
+    j = c.post(f"/upload?tk={tk}{qs}", data={"foto": (io.BytesIO(data), "a.jpg")},
+               content_type="multipart/form-data").get_json()
+    if j.get("job_id"):
+        assert wait_for(lambda: c.get(f"/jobs/{j['job_id']}").get_json()["state"] in ("done", "error"))
+    return j
@@ -0,0 +1,77 @@
+# postal_common.BudgetEncoder (encode_budget en app/app_online_movil.py): el JPEG cabe en
+# el presupuesto y los parámetros recordados por clave se reutilizan a la primera.
+import io, json, random
+
+import pytest
+from PIL import Image, ImageFilter
+
+from conftest import upload
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+def photo(size=(1400, 1000), seed=1) -> Image.Image:
+    """Ruido suavizado: se comprime como una foto, no como un color liso."""
+    rnd = random.Random(seed)
+    im = Image.frombytes("RGB", size, rnd.randbytes(size[0]*size[1]*3))
+    return im.filter(ImageFilter.GaussianBlur(1.5))
+
+
+def count_encodes(enc, monkeypatch) -> list:
+    calls, real = [], enc._jpeg
+    monkeypatch.setattr(enc, "_jpeg", lambda *a: (calls.append(a[1:]), real(*a))[1])
+    return calls
+
+
+def test_fits_the_budget(app):
+    enc = app.budget_encoder
+    img = photo()
+    for budget in (400_000, 150_000, 90_000):   # 90 KB ya obliga a bajar la resolución
+        data, p = enc.encode(img, budget, f"k{budget}")
+        assert len(data) <= budget and Image.open(io.BytesIO(data)).format == "JPEG"
+        assert p["quality"] >= enc.min_q and enc.min_px / max(img.size) <= p["scale"] <= 1
+        assert Image.open(io.BytesIO(data)).width == round(img.width * p["scale"])
+    data, p = enc.encode(img.convert("L"), 80_000, "gris")
+    assert len(data) <= 80_000 and p["subsampling"] is None and Image.open(io.BytesIO(data)).mode == "L"
+
+
+def test_remembered_params_hit_first_try(app, monkeypatch):
+    enc = app.budget_encoder
+    _, p = enc.encode(photo(seed=1), 80_000, "postal:color:80")
+    assert json.loads((app.DATA / "eprint_params.json").read_text())["postal:color:80"] == p
+    calls = count_encodes(enc, monkeypatch)
+    data, again = enc.encode(photo(seed=2), 80_000, "postal:color:80")   # otra postal parecida
+    assert again == p and len(calls) == 1 and len(data) <= 80_000
+    fresh = app.BudgetEncoder(app.DATA / "eprint_params.json")            # tras reiniciar: del JSON
+    calls = count_encodes(fresh, monkeypatch)
+    assert fresh.encode(photo(seed=3), 80_000, "postal:color:80")[1] == p and len(calls) == 1
+
+
+def test_searches_again_when_remembered_params_no_longer_fit(app, monkeypatch):
+    enc = app.budget_encoder
+    enc._save("k", {"scale": 1.0, "quality": 95, "subsampling": 0})     # demasiado para 100 KB
+    calls = count_encodes(enc, monkeypatch)
+    data, p = enc.encode(photo(), 100_000, "k")
+    assert len(data) <= 100_000 and len(calls) > 1 and p != {"scale": 1.0, "quality": 95, "subsampling": 0}
+    assert json.loads((app.DATA / "eprint_params.json").read_text())["k"] == p
+
+
+def test_floor_when_nothing_fits(app):
+    enc = app.budget_encoder
+    img = photo()
+    data, p = enc.encode(img, 1000, "imposible")
+    assert p == {"scale": enc.min_px / max(img.size), "quality": enc.min_q, "subsampling": 2}
+    assert Image.open(io.BytesIO(data)).width == enc.min_px
+
+
+def test_eprint_derivative_stays_under_budget(make_app):
+    m = make_app(AUTO_PRINT_MODE="email", EPRINT_BUDGET_KB=150)
+    b = io.BytesIO(); photo((1600, 1200)).save(b, "JPEG", quality=95)
+    code = upload(m, b.getvalue())["codigo"]
+    pdf = m.derivative_path(code, "eprint")
+    assert pdf.exists() and pdf.stat().st_size <= 150*1024
+    params = json.loads((m.DATA / "eprint_params.json").read_text())
+    assert [k.split(":")[1:] for k in params] == [["color", "150"]]
@@ -0,0 +1,59 @@
+# Deduplicación por contenido (índice de postales): la misma foto no se recompone, ni se
+# reimprime ni se resube; reprint=1 fuerza la impresión; un prefijo de 8 hex ya ocupado por
+# otro contenido da un código más largo.
+import hashlib
+
+import pytest
+
+from conftest import jpeg, upload, wait_for
+
+
+@pytest.fixture
+def app(make_app):
+    m = make_app(AUTO_PRINT_MODE="sumatra", PRINT_BACKOFF=0.05)
+    m.printed = []
+    m.PRINTERS["sumatra"] = lambda path, label: m.printed.append(label)
+    return m
+
+
+def test_identical_reupload_reuses_code_without_job_or_reprint(app):
+    data = jpeg((1, 2, 3))
+    first = upload(app, data)
+    assert not first["duplicate"] and first["job_id"]
+    assert wait_for(lambda: app.printed == [first["codigo"]])
+    again = upload(app, data)
+    assert again["duplicate"] and again["codigo"] == first["codigo"]
+    assert again["job_id"] is None and again["job_url"] == ""
+    assert len(list(app.UPL.glob("*.jpg"))) == 1
+    assert app.printed == [first["codigo"]]
+
+
+def test_reprint_forces_print(app):
+    data = jpeg((4, 5, 6))
+    code = upload(app, data)["codigo"]
+    assert wait_for(lambda: app.printed == [code])
+    j = upload(app, data, reprint=1)
+    assert j["duplicate"] and j["job_id"]
+    assert wait_for(lambda: app.printed == [code, code])
+    job = app.app.test_client().get(j["job_url"]).get_json()
+    assert job["stages"]["render"]["state"] == "skipped"   # ya renderizada con este layout
+
+
+def test_prefix_collision_gets_longer_code(app):
+    data = jpeg((7, 8, 9))
+    digest = hashlib.sha1(data).hexdigest()
+    with app._index_db() as con:   # otro contenido ya tiene el prefijo de 8 hex
+        con.execute("INSERT INTO postcards(sha1, code, created, updated) VALUES(?,?,0,0)",
+                    ("f" * 40, digest[:8]))
+    (app.UPL / f"{digest[:8]}.jpg").write_bytes(b"otra foto")
+    j = upload(app, data)
+    assert j["codigo"] == digest[:10] and not j["duplicate"]
+    assert (app.UPL / f"{digest[:8]}.jpg").read_bytes() == b"otra foto"
+    assert upload(app, data)["codigo"] == digest[:10]
+
+
+def test_legacy_file_collision_gets_longer_code(app):
+    data = jpeg((10, 11, 12))
+    digest = hashlib.sha1(data).hexdigest()
+    (app.UPL / f"{digest[:8]}.jpg").write_bytes(jpeg((200, 0, 0)))   # subida anterior al índice
+    assert upload(app, data)["codigo"] == digest[:10]
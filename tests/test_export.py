@@ -0,0 +1,35 @@
+# /export/<kind>: ruta de operador (ADMIN_TOKEN); sin token no se descarga nada.
+import pytest
+
+from conftest import jpeg, upload
+
+
+@pytest.fixture
+def app(make_app):
+    m = make_app(ADMIN_TOKEN="operador-secreto")
+    upload(m, jpeg((30, 60, 90)))
+    return m
+
+
+@pytest.mark.parametrize("kind", ["cards", "contact", "zip"])
+def test_export_requires_admin_token(app, kind):
+    c = app.app.test_client()
+    assert c.get(f"/export/{kind}").status_code == 403
+    assert c.get(f"/export/{kind}?token=otro").status_code == 403
+    assert c.get(f"/export/{kind}", headers={"X-Admin-Token": "otro"}).status_code == 403
+
+
+def test_export_with_token(app):
+    c = app.app.test_client()
+    r = c.get("/export/cards", headers={"X-Admin-Token": "operador-secreto"})
+    assert r.status_code == 200 and r.mimetype == "application/pdf" and r.data.startswith(b"%PDF")
+    r = c.get("/export/zip?token=operador-secreto")
+    assert r.status_code == 200 and r.data.startswith(b"PK")
+
+
+def test_export_closed_without_configured_token(make_app):
+    m = make_app()
+    upload(m, jpeg())
+    c = m.app.test_client()
+    assert c.get("/export/cards").status_code == 403
+    assert c.get("/export/cards?token=").status_code == 403
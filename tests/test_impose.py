@@ -0,0 +1,68 @@
+# Imposición (app/app_online_movil.py): la rejilla de sheet_grid y print_sheet cuando a
+# alguna postal le falta el JPEG de impresión (desalojado, o sin original del que rehacerlo).
+import pytest
+
+from conftest import jpeg, upload, wait_for
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+def images_in(pdf) -> int:
+    return pdf.read_bytes().count(b"/Subtype /Image")
+
+
+def test_sheet_grid_fits_the_paper(app):
+    m = app.IMPOSE_MARGIN
+    for paper, (pw, ph) in app.PAPER_IN.items():
+        for n in (1, 2, 4):
+            k, sw, sh, rows, cols = app.sheet_grid(n, paper)
+            assert {sw, sh} == {pw, ph} and rows * cols == n and 0 < k <= 1
+            assert cols * 7.0 * k <= sw - 2*m + 1e-9 and rows * 5.5 * k <= sh - 2*m + 1e-9
+    assert app.sheet_grid(1, "letter")[0] == 1.0                         # nunca amplía
+    assert app.sheet_grid(2, "letter")[1:] == (8.5, 11.0, 2, 1)           # una sobre otra, en vertical
+    assert app.sheet_grid(4, "letter")[1:] == (11.0, 8.5, 2, 2)           # 2×2 apaisada
+    assert app.sheet_grid(4, "letter")[0] == pytest.approx((8.5 - 2*m) / 11.0)
+
+
+def test_sheet_page_centers_cards_with_cut_marks(app):
+    sw, sh, images, lines = app.sheet_page([b"a", b"b", b"c"], 4, "letter")
+    k, *_ = app.sheet_grid(4, "letter")
+    assert [(x, y) for _, x, y, _, _ in images][:2] == [pytest.approx((sw/2 - 7*k, sh/2 - 5.5*k)),
+                                                       pytest.approx((sw/2, sh/2 - 5.5*k))]
+    assert len(images) == 3 and len(lines) == 2*3 + 2*3                    # 3 cortes por eje, 2 marcas cada uno
+
+
+def test_print_sheet_rebuilds_or_skips_missing_jpegs(app):
+    ok, evicted = (upload(app, jpeg(c))["codigo"] for c in ((200, 40, 40), (40, 200, 40)))
+    app.derivative_path(evicted, "print").unlink()
+    app.cache_path(evicted, "jpg").unlink(missing_ok=True)
+    rows = [{"code": c, "pdf_path": str(app.derivative_path(c, "pdf"))} for c in (ok, evicted, "0ff11e00")]
+    pdf, placed, lost = app.print_sheet(rows)
+    assert [r["code"] for r in placed] == [ok, evicted] and images_in(pdf) == 2
+    assert app.derivative_path(evicted, "print").exists()                 # recompuesto desde el original
+    assert [(r["code"], "0ff11e00" in err) for r, err in lost] == [("0ff11e00", True)]
+    assert pdf.parent == app.SHEETS and pdf.name.endswith(f"_{ok}-{evicted}.pdf")
+
+
+def test_print_sheet_with_nothing_to_place_raises(app):
+    with pytest.raises(FileNotFoundError, match="0ff11e00"):
+        app.print_sheet([{"code": "0ff11e00", "pdf_path": "/no/existe.pdf"}])
+
+
+def test_worker_prints_the_rest_of_the_sheet(make_app):
+    m = make_app(IMPOSE_UP=2, IMPOSE_WINDOW=0.2, PRINT_BACKOFF=30)
+    sent = []
+    m.PRINTERS["sumatra"] = lambda path, label: sent.append((path, label))
+    code = upload(m, jpeg((20, 90, 160)))["codigo"]
+    m.print_enqueue(code, m.derivative_path(code, "pdf"), "sumatra")
+    m.print_enqueue("0ff11e00", m.PDFS / "0ff11e00.pdf", "sumatra")
+    assert wait_for(lambda: sent)
+    (sheet, label), = sent
+    assert label == code and images_in(sheet) == 1
+    assert wait_for(lambda: m.print_queue_status(code="0ff11e00")["last_error"] is not None)
+    assert m.print_queue_status(code=code)["state"] == "done"
+    bad = m.print_queue_status(code="0ff11e00")
+    assert bad["state"] == "pending" and bad["attempts"] == 1 and "0ff11e00" in bad["last_error"]
@@ -0,0 +1,92 @@
+# Layouts integrados (app/app_online_movil.py): square y fullbleed, ahora documentos
+# declarativos compilados en planes, dan la misma postal que compose_square y
+# compose_fullbleed de antes (copiados aquí tal cual como referencia).
+import pytest
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+CODE = "ab12cd34"
+
+
+def _canvas(m, scale):
+    return (m.W, m.H) if scale >= 1 else (max(1, round(m.W*scale)), max(1, round(m.H*scale)))
+
+
+def _font(size):
+    try: return ImageFont.truetype("DejaVuSans-Bold.ttf", size)
+    except OSError: return ImageFont.load_default()
+
+
+def old_fullbleed(m, im, scale):
+    cw, ch = _canvas(m, scale); px = lambda v: max(1, round(v*scale))
+    base = Image.new("RGB", (cw, ch), (255, 255, 255))
+    w, h = im.size; k = max(cw/w, ch/h); nw, nh = int(w*k), int(h*k)
+    im = im.resize((nw, nh), Image.LANCZOS)
+    left, top = max(0, (nw-cw)//2), max(0, (nh-ch)//2)
+    base.paste(im.crop((left, top, left+cw, top+ch)), (0, 0))
+    d = ImageDraw.Draw(base); font = _font(px(72))
+    tw = d.textlength(CODE, font=font); pad = px(30)
+    d.rectangle([cw-int(tw)-pad*2, ch-px(130), cw-px(30), ch-px(30)], fill=(255, 255, 255, 230))
+    d.text((cw-int(tw)-pad*1.5, ch-px(120)), CODE, fill=(20, 20, 20), font=font)
+    return base
+
+
+def old_square(m, im, scale, margin=120, anchor="center"):
+    cw, ch = _canvas(m, scale); px = lambda v: max(1, round(v*scale))
+    base = Image.new("RGB", (cw, ch), (255, 255, 255))
+    side = px(min(m.W, m.H) - 2*margin)
+    x, y = (cw-side)//2, (ch-side)//2
+    sq = min(im.width, im.height)
+    if anchor == "top":      left, top = (im.width-sq)//2, 0
+    elif anchor == "bottom": left, top = (im.width-sq)//2, im.height-sq
+    else:                    left, top = (im.width-sq)//2, (im.height-sq)//2
+    base.paste(im.crop((left, top, left+sq, top+sq)).resize((side, side), Image.LANCZOS), (x, y))
+    d = ImageDraw.Draw(base)
+    d.rectangle([x, y, x+side, y+side], outline=(230, 230, 230), width=px(6))
+    font = _font(px(46)); tw = d.textlength(CODE, font=font); pad = px(24)
+    d.rectangle([cw-int(tw)-pad*2, ch-px(92), cw-px(30), ch-px(30)], fill=(255, 255, 255, 210))
+    d.text((cw-int(tw)-pad*1.5, ch-px(82)), CODE, fill=(20, 20, 20), font=font)
+    return base
+
+
+@pytest.fixture
+def src():
+    """Degradados distintos por canal: cualquier desplazamiento del recorte se nota."""
+    size = (1600, 1200)
+    g = Image.linear_gradient("L")
+    return Image.merge("RGB", (Image.radial_gradient("L").resize(size), g.resize(size), g.rotate(90).resize(size)))
+
+
+def differs(a, b, tol=2) -> Image.Image:
+    """Máscara de los píxeles que cambian más que el redondeo del remuestreo."""
+    assert a.size == b.size
+    return ImageChops.difference(a, b).convert("L").point(lambda p: 255 if p > tol else 0)
+
+
+@pytest.mark.parametrize("scale", [1.0, 0.5, 0.25])
+def test_fullbleed_matches_old_compose(make_app, src, scale):
+    m = make_app(PRINT_LAYOUT="fullbleed")
+    assert differs(old_fullbleed(m, src, scale), m.compose(CODE, src, scale=scale)).getbbox() is None
+    assert m.print_cover() == (m.W, m.H) and m.capture_profile()["anchor"] == "center"
+
+
+@pytest.mark.parametrize("scale,anchor", [(1.0, "center"), (1.0, "top"), (1.0, "bottom"), (0.25, "center")])
+def test_square_matches_old_compose(make_app, src, scale, anchor):
+    m = make_app(PRINT_LAYOUT="square", PRINT_MARGIN=120, PRINT_ANCHOR=anchor)
+    old, new = old_square(m, src, scale, 120, anchor), m.compose(CODE, src, scale=scale)
+    x, y, side, _ = m.layout_plan("square", scale)["box"]
+    fw = max(1, round(6*scale))
+    assert (x, y, side) == ((old.width-side)//2, (old.height-side)//2, max(1, round((m.H - 240)*scale)))
+    # lo único distinto: el borde de antes sobresalía 1 px (rectangle incluye x+side)
+    overhang = Image.new("L", old.size, 0)
+    d = ImageDraw.Draw(overhang)
+    for v in (x+side-fw, x+side): d.line([(v, y), (v, y+side)], fill=255)
+    for v in (y+side-fw, y+side): d.line([(x, v), (x+side, v)], fill=255)
+    assert ImageChops.subtract(differs(old, new), overhang).getbbox() is None
+    if scale == 1: assert m.print_cover() == (side, side)
+    assert m.capture_profile()["anchor"] == anchor
+
+
+def test_margin_still_sizes_the_square(make_app):
+    m = make_app(PRINT_MARGIN=200)
+    assert m.print_cover("square") == (m.H - 400,)*2 and m.print_cover("fullbleed") == (m.W, m.H)
+    assert m.LAYOUT_VERSION != make_app(PRINT_MARGIN=120).LAYOUT_VERSION
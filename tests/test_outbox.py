@@ -0,0 +1,123 @@
+# Outbox de subidas (app/app_online_movil.py) contra un servidor http.server local:
+# reintento con backoff, lotes de REMOTE_UPLOAD_BATCH y filas que quedaron en 'sending'.
+import threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg, upload, wait_for
+
+
+class Remote:
+    """Imita la web: responde según script (códigos HTTP en orden) y luego 200."""
+    def __init__(self):
+        self.script, self.hits, self.lock = [], [], threading.Lock()
+        remote = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with remote.lock:
+                    status = remote.script.pop(0) if remote.script else 200
+                    remote.hits.append({"t": time.monotonic(), "status": status,
+                                        "images": body.count(b'name="imagen"'),
+                                        "auth": self.headers.get("Authorization")})
+                self.send_response(status); self.send_header("Content-Length", "2"); self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *a): pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/subir_postal"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def remote():
+    r = Remote()
+    yield r
+    r.httpd.shutdown(); r.httpd.server_close()
+
+
+@pytest.fixture
+def app(make_app, remote):
+    return make_app(REMOTE_UPLOAD_URL=remote.url, REMOTE_UPLOAD_TOKEN="secreto", OUTBOX_WORKERS=1, OUTBOX_BACKOFF=0.2)
+
+
+def photo(m, code):
+    p = m.UPL / f"{code}.jpg"
+    Image.new("RGB", (64, 48), (200, 120, 40)).save(p, "JPEG")
+    return p
+
+
+def insert(m, codes, state="pending"):
+    """Filas en la outbox de una vez, sin arrancar los workers (como las deja un reinicio)."""
+    now = time.time()
+    with m._outbox_lock, m._outbox_db() as con:
+        con.executemany("""INSERT INTO outbox(code,img_path,state,attempts,next_at,created,updated)
+                           VALUES(?,?,?,0,?,?,?)""", [(c, str(photo(m, c)), state, now, now, now) for c in codes])
+
+
+def states(m):
+    return {i["code"]: i["state"] for i in m.outbox_status()["items"]}
+
+
+def test_retry_with_backoff(app, remote):
+    remote.script = [503]
+    assert app.outbox_enqueue("a1b2c3d4", photo(app, "a1b2c3d4"))
+    assert wait_for(lambda: states(app).get("a1b2c3d4") == "sent")
+    row = app.outbox_status("a1b2c3d4")
+    assert (row["attempts"], row["last_status"], row["last_error"]) == (2, 200, None)
+    assert [h["status"] for h in remote.hits] == [503, 200]
+    assert remote.hits[0]["auth"] == "Bearer secreto"
+    # primer reintento: OUTBOX_BACKOFF * jitter(0.5–1.5)
+    assert remote.hits[1]["t"] - remote.hits[0]["t"] >= 0.2 * 0.5
+
+
+def test_client_error_is_not_retried(app, remote):
+    remote.script = [400]
+    app.outbox_enqueue("deadbeef", photo(app, "deadbeef"))
+    assert wait_for(lambda: states(app).get("deadbeef") == "failed")
+    time.sleep(0.4)
+    assert len(remote.hits) == 1 and app.outbox_status("deadbeef")["last_status"] == 400
+
+
+def test_batches_respect_remote_upload_batch(app, remote, monkeypatch):
+    monkeypatch.setattr(app, "REMOTE_UPLOAD_BATCH", 3)
+    codes = [f"c0de000{i}" for i in range(5)]
+    insert(app, codes)
+    app.outbox_start()
+    assert wait_for(lambda: set(states(app).values()) == {"sent"} and len(states(app)) == 5)
+    assert [h["images"] for h in remote.hits] == [3, 2]
+
+
+def test_sending_rows_drain_on_start(app, remote):
+    codes = ["5e4d0001", "5e4d0002"]
+    insert(app, codes, state="sending")     # el proceso cayó a mitad de un envío
+    assert app.outbox_status()["counts"] == {"sending": 2}
+    app.outbox_start()
+    assert wait_for(lambda: set(states(app).values()) == {"sent"})
+    assert sum(h["images"] for h in remote.hits) == 2
+    assert all(app.outbox_status(c)["attempts"] == 1 for c in codes)
+
+
+def test_index_status_written_before_worker_wakes(app, remote, monkeypatch):
+    real = app.index_mark
+
+    def slow_mark(code, **fields):
+        if fields.get("remote_status") == "pending": time.sleep(0.3)   # da tiempo al worker a terminar
+        real(code, **fields)
+
+    monkeypatch.setattr(app, "index_mark", slow_mark)
+    code = upload(app, jpeg((10, 200, 90)))["codigo"]
+    assert wait_for(lambda: states(app).get(code) == "sent")
+    time.sleep(0.5)
+    assert app.index_get(code)["remote_status"] == "sent"
+
+
+def test_enqueue_of_sent_code_keeps_index(app, remote):
+    code = upload(app, jpeg((90, 20, 200)))["codigo"]
+    assert wait_for(lambda: app.index_get(code)["remote_status"] == "sent")
+    app.outbox_enqueue(code, app.UPL / f"{code}.jpg")   # ya enviada: no vuelve a la cola
+    assert app.index_get(code)["remote_status"] == "sent" and len(remote.hits) == 1
@@ -0,0 +1,38 @@
+# /api/postcards*: listado del índice sólo para el operador (ADMIN_TOKEN).
+import pytest
+
+from conftest import jpeg, upload
+
+ADMIN = {"X-Admin-Token": "operador-secreto"}
+
+
+@pytest.fixture
+def app(make_app):
+    m = make_app(ADMIN_TOKEN="operador-secreto")
+    m.codes = [upload(m, jpeg((40 * i, 80, 120)))["codigo"] for i in range(3)]
+    return m
+
+
+@pytest.mark.parametrize("path", ["/api/postcards", "/api/postcards/stats", "/api/postcards/{code}"])
+def test_listing_requires_admin_token(app, path):
+    c = app.app.test_client()
+    url = path.format(code=app.codes[0])
+    assert c.get(url).status_code == 403
+    assert c.get(url, headers={"X-Admin-Token": "otro"}).status_code == 403
+    assert c.get(url, headers=ADMIN).status_code == 200
+
+
+def test_keyset_pagination(app):
+    c = app.app.test_client()
+    page = c.get("/api/postcards?limit=2", headers=ADMIN).get_json()
+    assert len(page["items"]) == 2 and page["next"]
+    rest = c.get(f"/api/postcards?limit=2&after={page['next']}", headers=ADMIN).get_json()
+    assert not rest["next"]
+    assert sorted(i["code"] for i in page["items"] + rest["items"]) == sorted(app.codes)
+    assert c.get("/api/postcards/stats", headers=ADMIN).get_json()["total"] == 3
+
+
+def test_view_image_stays_public(app):
+    c = app.app.test_client()
+    assert c.get(f"/view_image/{app.codes[0]}").status_code == 200
+    assert c.get("/view_image/0123abcd").status_code == 404
@@ -0,0 +1,139 @@
+# Cola de impresión (app/app_online_movil.py): un hilo por destino contra un SumatraPDF
+# de pega que apunta cada llamada, reintentos contra un doble HTTP de SendGrid
+# (SENDGRID_HOST), un trabajo por código y GET /print-queue.
+import json, os, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import wait_for
+
+SUMATRA = """#!{python}
+import json, sys, time
+t0 = time.time(); time.sleep({secs})
+with open({log!r}, "a") as f: f.write(json.dumps({{"pdf": sys.argv[-1], "start": t0, "end": time.time()}}) + "\\n")
+"""
+
+
+class Sumatra:
+    """SUMATRA_PATH de pega: tarda secs y apunta en calls.jsonl el PDF y cuándo empezó/acabó."""
+    def __init__(self, dir, secs=0.2):
+        self.path, self.log = dir / "sumatra", dir / "calls.jsonl"
+        self.path.write_text(SUMATRA.format(python=sys.executable, secs=secs, log=str(self.log)))
+        self.path.chmod(0o755)
+
+    def calls(self):
+        return [json.loads(l) for l in self.log.read_text().splitlines()] if self.log.exists() else []
+
+
+@pytest.fixture
+def sumatra(tmp_path):
+    return Sumatra(tmp_path)
+
+
+class SendGrid:
+    """Imita /v3/mail/send: responde según script (códigos HTTP en orden) y luego 202."""
+    def __init__(self):
+        self.script, self.hits, self.lock = [], [], threading.Lock()
+        sg = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with sg.lock:
+                    status = sg.script.pop(0) if sg.script else 202
+                    sg.hits.append({"t": time.monotonic(), "status": status, "path": self.path,
+                                    "auth": self.headers.get("Authorization"),
+                                    "files": [a["filename"] for a in body.get("attachments", [])]})
+                self.send_response(status); self.send_header("Content-Length", "2"); self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *a): pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def sendgrid():
+    s = SendGrid()
+    yield s
+    s.httpd.shutdown(); s.httpd.server_close()
+
+
+def pdf(m, code):
+    p = m.PDFS / f"{code}.pdf"
+    p.write_bytes(b"%PDF-1.4\n%%EOF\n")
+    return p
+
+
+def state(m, code):
+    return (m.print_queue_status(code=code) or {}).get("state")
+
+
+def test_one_job_at_a_time_per_destination(make_app, sumatra):
+    m = make_app(SUMATRA_PATH=sumatra.path, PRINT_BACKOFF=0.05)
+    codes = [f"5a0e000{i}" for i in range(4)]
+    for c in codes: assert m.print_enqueue(c, pdf(m, c), "sumatra")
+    assert wait_for(lambda: all(state(m, c) == "done" for c in codes))
+    calls = sorted(sumatra.calls(), key=lambda c: c["start"])
+    assert [os.path.basename(c["pdf"]) for c in calls] == [f"{c}.pdf" for c in codes]   # en orden de llegada
+    assert all(a["end"] <= b["start"] for a, b in zip(calls, calls[1:]))              # nunca dos a la vez
+    assert m.print_queue_status()["workers"] == ["sumatra"]
+
+
+def test_sendgrid_5xx_is_retried_with_backoff(make_app, sendgrid):
+    m = make_app(SENDGRID_HOST=sendgrid.url, SENDGRID_API_KEY="SG.pruebas", PRINTER_EMAIL="impresora@example.com",
+                 SENDER_EMAIL="postal@example.com", PRINT_BACKOFF=0.2)
+    sendgrid.script = [503]
+    assert m.print_enqueue("e3a11000", pdf(m, "e3a11000"), "email")
+    assert wait_for(lambda: state(m, "e3a11000") == "done")
+    row = m.print_queue_status(code="e3a11000")
+    assert (row["attempts"], row["last_error"]) == (2, None)
+    assert [h["status"] for h in sendgrid.hits] == [503, 202]
+    assert sendgrid.hits[0]["path"] == "/v3/mail/send" and sendgrid.hits[0]["auth"] == "Bearer SG.pruebas"
+    assert sendgrid.hits[1]["files"] == ["postal_e3a11000.pdf"]
+    # primer reintento: PRINT_BACKOFF * jitter(0.5–1.5)
+    assert sendgrid.hits[1]["t"] - sendgrid.hits[0]["t"] >= 0.2 * 0.5
+
+
+def test_sendgrid_4xx_fails_after_max_attempts(make_app, sendgrid):
+    m = make_app(SENDGRID_HOST=sendgrid.url, SENDGRID_API_KEY="SG.pruebas", PRINTER_EMAIL="impresora@example.com",
+                 SENDER_EMAIL="postal@example.com", PRINT_BACKOFF=0.01, PRINT_MAX_ATTEMPTS=2)
+    sendgrid.script = [400, 400]
+    m.print_enqueue("e3a11001", pdf(m, "e3a11001"), "email")
+    assert wait_for(lambda: state(m, "e3a11001") == "failed")
+    assert len(sendgrid.hits) == 2 and "400" in m.print_queue_status(code="e3a11001")["last_error"]
+
+
+def test_enqueue_dedups_by_code(make_app, sumatra):
+    m = make_app(SUMATRA_PATH=sumatra.path, PRINT_BACKOFF=0.05)
+    p = pdf(m, "d0b1e000")
+    for _ in range(3): assert m.print_enqueue("d0b1e000", p, "sumatra")   # doble toque mientras está en cola
+    assert wait_for(lambda: state(m, "d0b1e000") == "done")
+    time.sleep(0.3)
+    assert len(sumatra.calls()) == 1
+    assert m.print_queue_status()["counts"] == {"sumatra": {"done": 1}}
+    m.print_enqueue("d0b1e000", p, "sumatra")                                # ya impresa: reimpresión
+    assert wait_for(lambda: len(sumatra.calls()) == 2 and state(m, "d0b1e000") == "done")
+    assert m.print_queue_status(code="d0b1e000")["attempts"] == 1
+
+
+def test_print_queue_depth_and_latency(make_app, sumatra):
+    m = make_app(SUMATRA_PATH=sumatra.path, PRINT_BACKOFF=0.05)
+    c = m.app.test_client()
+    codes = [f"1a7e000{i}" for i in range(3)]
+    for code in codes: m.print_enqueue(code, pdf(m, code), "sumatra")
+    q = c.get("/print-queue").get_json()
+    assert q["depth"] == 3 and q["oldest_pending_secs"] is not None and q["latency"]["n"] == 0
+    assert wait_for(lambda: c.get("/print-queue").get_json()["depth"] == 0)
+    q = c.get("/print-queue").get_json()
+    assert q["counts"] == {"sumatra": {"done": 3}} and q["oldest_pending_secs"] is None
+    lat = q["latency"]
+    assert lat["n"] == 3 and lat["print_p50"] >= 0.2 and lat["p50"] >= lat["print_p50"]
+    assert lat["wait_p50"] is not None and lat["p95"] >= lat["p50"]
+    last = next(i for i in q["items"] if i["code"] == codes[-1])
+    assert last["wait_secs"] >= 0.2 * 2 and last["print_secs"] >= 0.2   # esperó a los dos anteriores
+    assert c.get(f"/print-queue/{codes[-1]}").get_json()["state"] == "done"
+    assert c.get("/print-queue/nope0000").status_code == 404
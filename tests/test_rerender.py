@@ -0,0 +1,69 @@
+# rerender (app/app_online_movil.py): se salta las postales ya al día para LAYOUT_VERSION
+# y, si se corta, la siguiente ejecución sigue desde RERENDER_CKPT sin rehacer lo terminado.
+import json
+
+import pytest
+
+from conftest import jpeg, upload
+
+COLORS = [(200, 40, 40), (40, 200, 40), (40, 40, 200), (200, 200, 40), (40, 200, 200)]
+
+
+@pytest.fixture
+def codes(make_app):
+    m = make_app(PRINT_MARGIN=120)
+    return [upload(m, jpeg(c))["codigo"] for c in COLORS]
+
+
+def spy(m, monkeypatch, fail_at=None) -> list:
+    """Apunta los códigos que llegan a render_derivatives; en la llamada fail_at (una vez), Ctrl-C."""
+    calls, real, n = [], m.render_derivatives, iter(range(1, 1000))
+
+    def render(code, *a):
+        calls.append(code)
+        if next(n) == fail_at: raise KeyboardInterrupt
+        return real(code, *a)
+    monkeypatch.setattr(m, "render_derivatives", render)
+    return calls
+
+
+def ckpt(m) -> list:
+    return [json.loads(l)["code"] for l in m.RERENDER_CKPT.read_text().splitlines()]
+
+
+def test_skips_cards_current_for_layout_version(make_app, codes, monkeypatch):
+    m = make_app(PRINT_MARGIN=120)                       # mismo layout: todo está al día
+    calls = spy(m, monkeypatch)
+    r = m.rerender(workers=0)
+    assert (r["total"], r["skipped"], r["done"], calls) == (5, 5, 0, [])
+    r = m.rerender(workers=0, codes={codes[0]}, force=True)
+    assert (r["total"], r["done"], calls) == (1, 1, [codes[0]])
+
+
+def test_resumes_from_checkpoint(make_app, codes, monkeypatch):
+    m = make_app(PRINT_MARGIN=200)                       # otro layout: todas por rehacer
+    before = {c: m.index_get(c)["rendered"] for c in codes}
+    assert m.LAYOUT_VERSION not in before.values()
+    calls = spy(m, monkeypatch, fail_at=3)
+    r = m.rerender(workers=0)
+    done = ckpt(m)                                       # 1 o 2: las que acabaron antes del corte
+    assert r["interrupted"] and r["done"] == len(done) >= 1 and done == sorted(codes)[:len(done)]
+    assert all((m.index_get(c)["rendered"] == m.LAYOUT_VERSION) == (c in done) for c in codes)
+    calls.clear()
+    r = m.rerender(workers=0, force=True)                # force no se salta el checkpoint
+    assert (r["resumed"], r["done"], r.get("interrupted")) == (len(done), 5 - len(done), None)
+    assert calls == sorted(set(codes) - set(done))
+    assert all(m.index_get(c)["rendered"] == m.LAYOUT_VERSION for c in codes)
+    assert m.print_cover() == (m.H - 400,)*2 and all(m.derivative_path(c, "pdf").exists() for c in codes)
+    calls.clear()
+    r = m.rerender(workers=0, restart=True)              # sin checkpoint: al día por el índice
+    assert (r["skipped"], r["done"], calls) == (5, 0, [])
+
+
+def test_checkpoint_entry_for_an_older_version_is_ignored(make_app, codes, monkeypatch):
+    m = make_app(PRINT_MARGIN=200)
+    m.rerender(workers=0, codes={codes[0]})
+    m = make_app(PRINT_MARGIN=160)                       # el checkpoint es del layout anterior
+    calls = spy(m, monkeypatch)
+    r = m.rerender(workers=0, codes={codes[0]})
+    assert (r["resumed"], r["done"], calls) == (0, 1, [codes[0]])
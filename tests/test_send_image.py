@@ -0,0 +1,74 @@
+# send_image (app/app_online_movil.py) a través de /local_img y /local_comp: ETag fuerte,
+# 304, Range 206 y variantes ?w= ajustadas a VARIANT_WIDTHS (WebP si el cliente lo acepta).
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg, upload
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(VARIANT_WIDTHS="480,960,1600")
+
+
+@pytest.fixture
+def code(app):
+    return upload(app, jpeg((40, 120, 200), size=(2000, 1500)))["codigo"]
+
+
+def test_etag_and_304(app, code):
+    c = app.app.test_client()
+    r = c.get(f"/local_img/{code}")
+    assert r.status_code == 200 and r.headers["ETag"] == f'"{code}-full-jpg"'
+    assert r.data == (app.UPL / f"{code}.jpg").read_bytes()
+    assert "immutable" in r.headers["Cache-Control"] and "max-age=31536000" in r.headers["Cache-Control"]
+    r = c.get(f"/local_img/{code}", headers={"If-None-Match": r.headers["ETag"]})
+    assert r.status_code == 304 and r.data == b""
+    assert c.get(f"/local_img/{code}", headers={"If-None-Match": '"otra"'}).status_code == 200
+
+
+def test_range_206(app, code):
+    c = app.app.test_client()
+    full = (app.UPL / f"{code}.jpg").read_bytes()
+    r = c.get(f"/local_img/{code}", headers={"Range": "bytes=0-99"})
+    assert r.status_code == 206 and r.data == full[:100]
+    assert r.headers["Content-Range"] == f"bytes 0-99/{len(full)}"
+    r = c.get(f"/local_img/{code}", headers={"Range": "bytes=-10"})
+    assert r.status_code == 206 and r.data == full[-10:]
+    r = c.get(f"/local_img/{code}", headers={"Range": "bytes=0-9", "If-Range": '"otra"'})   # cambió: entero
+    assert r.status_code == 200 and r.data == full
+
+
+def test_width_snaps_to_known_variants(app, code):
+    c = app.app.test_client()
+    for asked, served in ((1000, 960), (10, 480), (5000, 1600)):
+        r = c.get(f"/local_img/{code}?w={asked}")
+        assert r.status_code == 200 and r.headers["ETag"] == f'"{code}-{served}-jpg"'
+        assert r.mimetype == "image/jpeg" and "Accept" in r.headers["Vary"]
+        assert Image.open(io.BytesIO(r.data)).width == served
+    assert sorted(p.name for p in app.VARIANTS.iterdir()) == [f"{code}_{w}.jpg" for w in (1600, 480, 960)]
+
+
+def test_webp_variant_when_accepted(app, code):
+    c = app.app.test_client()
+    r = c.get(f"/local_img/{code}?w=960", headers={"Accept": "image/webp,image/*"})
+    assert r.mimetype == "image/webp" and r.headers["ETag"] == f'"{code}-960-webp"'
+    assert Image.open(io.BytesIO(r.data)).format == "WEBP"
+    made = (app.VARIANTS / f"{code}_960.webp").stat().st_mtime_ns
+    r = c.get(f"/local_img/{code}?w=900", headers={"Accept": "image/webp", "If-None-Match": r.headers["ETag"]})
+    assert r.status_code == 304
+    assert (app.VARIANTS / f"{code}_960.webp").stat().st_mtime_ns == made   # se genera una sola vez
+
+
+def test_composite_is_immutable_only_with_current_version(app, code):
+    c = app.app.test_client()
+    ver = app.comp_version(app.derivative_path(code, "print"))
+    r = c.get(f"/local_comp/{code}")
+    assert r.status_code == 200 and "no-cache" in r.headers["Cache-Control"]
+    assert r.headers["ETag"] == f'"{code}_comp_{ver}-full-jpg"'
+    r = c.get(f"/local_comp/{code}?v={ver}")
+    assert "immutable" in r.headers["Cache-Control"]
+    assert "immutable" not in c.get(f"/local_comp/{code}?v=viejo").headers["Cache-Control"]
+    assert c.get("/local_comp/00000000").status_code == 404
@@ -0,0 +1,139 @@
+# Cuota de DATA (postal_common.Storage en app/app_online_movil.py): el ledger y sus
+# contadores, el tier 1 por último uso explícito, el tier 2 de originales ya subidos y la
+# recomposición de un _print.jpg desalojado.
+import os, sqlite3, time
+from collections import defaultdict
+from pathlib import Path
+
+import pytest
+
+from conftest import jpeg, upload
+
+
+@pytest.fixture
+def app(make_app, monkeypatch, tmp_path):
+    m = make_app(STORAGE_QUOTA_MB=1000, STORAGE_MIN_AGE=0, RETENTION_DAYS=1, RETENTION_ARCHIVE=tmp_path / "archivo")
+    monkeypatch.setattr(m, "storage_start", lambda: None)   # las pasadas las lanza cada prueba
+    m.evicted = []
+    real = m.storage.on_evict
+    m.storage.on_evict = lambda paths: (m.evicted.extend(paths), real(paths))
+    return m
+
+
+def on_disk(m) -> dict:
+    """Bytes por subdirectorio de DATA contando cada inodo una vez (lo que medía el os.walk de antes)."""
+    owner = {}
+    for root, _, files in os.walk(m.DATA):
+        for f in files:
+            p = os.path.join(root, f)
+            st = os.stat(p)
+            ino = (st.st_dev, st.st_ino)
+            if ino not in owner or p < owner[ino][0]:
+                rel = Path(p).relative_to(m.DATA).parts
+                owner[ino] = (p, rel[0] if len(rel) > 1 else ".", st.st_size)
+    dirs = defaultdict(int)
+    for _, d, n in owner.values(): dirs[d] += n
+    return {d: n for d, n in dirs.items() if d != "."}   # "." = el ledger y las bases SQLite, cambian solas
+
+
+def counted(dirs: dict) -> dict:
+    return {d: n for d, n in dirs.items() if d != "." and n}
+
+
+def ledger_paths(m) -> set:
+    with sqlite3.connect(m.storage.db_path) as con:
+        return {r[0] for r in con.execute("SELECT path FROM files")}
+
+
+def shrink(m):
+    m.storage.quota_mb = 1e-6   # todo lo regenerable sobra
+
+
+def test_counters_follow_writes_without_walking(app):
+    upload(app, jpeg((200, 30, 30)))
+    upload(app, jpeg((30, 30, 200)))
+    app.storage_sweep()                     # primera vuelta: ledger vacío, se recorre entero
+    assert counted(app.STORAGE["dirs"]) == on_disk(app)
+    walks, real = [], app.storage._walk_files
+
+    def walk():
+        walks.append(1)
+        return real()
+    app.storage._walk_files = walk
+    code = upload(app, jpeg((30, 200, 30)))["codigo"]   # note() en cada escritura: sin recorrer DATA
+    assert app.storage._dirs["uploads"] == on_disk(app)["uploads"]
+    assert app.storage._tiers["derivative"] > 0 and app.storage._tiers["original"] > 0
+    app.storage.batch = 3
+    app.storage_sweep()
+    assert app.storage.status["sweeps"] == 2 and len(walks) <= 1   # la pasada sigue la vuelta, no la rehace
+    assert (app.UPL / f"{code}.jpg").exists()
+
+
+def test_reconcile_picks_up_files_written_behind_its_back(app):
+    upload(app, jpeg((120, 120, 20)))
+    app.storage_sweep()
+    stray = app.VARIANTS / "manual_100.jpg"
+    stray.write_bytes(b"x" * 5000)
+    gone = next(app.PDFS.glob("*_thumb.jpg"))
+    gone.unlink()
+    app.storage.batch = 2
+    while not app.storage.reconcile(): pass   # vuelta por trozos de 2 archivos
+    assert counted(app.storage._dirs) == on_disk(app)
+    assert str(stray) in ledger_paths(app) and str(gone) not in ledger_paths(app)
+
+
+def test_lru_uses_explicit_last_use_not_mtime(app):
+    a = upload(app, jpeg((200, 30, 30)))["codigo"]
+    b = upload(app, jpeg((30, 30, 200)))["codigo"]
+    app.storage_sweep()
+    time.sleep(0.01)
+    app.print_jpeg(a)                                   # uso de a, posterior a escribir b
+    future = time.time() + 3600
+    os.utime(app.derivative_path(b, "print"), (future, future))   # mtime engañoso: no cuenta
+    shrink(app)
+    app.storage_sweep()
+    order = [p.name for p in app.evicted]
+    assert order.index(f"{b}_print.jpg") < order.index(f"{a}_print.jpg")
+    assert not app.derivative_path(a, "pdf").exists() and (app.UPL / f"{a}.jpg").exists()
+    assert app.STORAGE["evicted"]["derivative"] == len(order) and app.STORAGE["tiers"].get("derivative", 0) == 0
+
+
+def test_pending_print_is_protected(app):
+    a = upload(app, jpeg((200, 30, 30)))["codigo"]
+    b = upload(app, jpeg((30, 30, 200)))["codigo"]
+    now = time.time()
+    with app._print_db() as con:
+        con.execute("""INSERT INTO printq(code,pdf_path,dest,state,attempts,next_at,created,updated)
+                       VALUES(?,?,'sumatra','pending',0,?,?,?)""", (a, str(app.derivative_path(a, "pdf")), now, now, now))
+    shrink(app)
+    app.storage_sweep()
+    assert app.derivative_path(a, "pdf").exists() and app.cache_path(a, "pdf").exists()
+    assert not app.derivative_path(b, "pdf").exists()
+
+
+def test_evicted_print_jpeg_is_rebuilt(app):
+    code = upload(app, jpeg((90, 160, 40)))["codigo"]
+    app.cache_get(code, app.UPL / f"{code}.jpg", "jpg")      # también en la caché en memoria
+    shrink(app)
+    app.storage_sweep()
+    assert not app.derivative_path(code, "print").exists() and not app.cache_path(code, "jpg").exists()
+    assert app.index_get(code)["rendered"] is None            # pending_stages/rerender lo ven por hacer
+    p = app.print_jpeg(code)
+    assert p == app.derivative_path(code, "print") and p.stat().st_size > 0
+    assert {str(p), str(app.cache_path(code, "jpg"))} <= ledger_paths(app)
+
+
+def test_retention_archives_sent_originals_only(app, tmp_path):
+    old = time.time() - 2*86400
+    sent, unsent, recent = (upload(app, jpeg(c))["codigo"] for c in ((200, 0, 0), (0, 200, 0), (0, 0, 200)))
+    for code, status, created in ((sent, "sent", old), (unsent, "pending", old), (recent, "sent", time.time())):
+        app.index_mark(code, remote_status=status, created=created)
+    shrink(app)
+    app.storage_sweep()
+    dest = app.index_get(sent)["archived"]
+    assert dest and Path(dest).parent.parent == tmp_path / "archivo" and Path(dest).read_bytes()
+    assert not (app.UPL / f"{sent}.jpg").exists()
+    assert (app.UPL / f"{unsent}.jpg").exists() and (app.UPL / f"{recent}.jpg").exists()
+    assert app.index_get(unsent)["archived"] is None and app.index_get(recent)["archived"] is None
+    assert app.STORAGE["evicted"]["original"] == 1 and app.STORAGE["archived"] == 1
+    assert app.storage._dirs["uploads"] == on_disk(app)["uploads"]
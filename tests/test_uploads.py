@@ -0,0 +1,93 @@
+# Subida reanudable (/uploads): ticket en cada paso, reanudación por offset (409),
+# verificación del SHA-1 final y GC de sesiones abandonadas.
+import hashlib, json, os, time
+
+import pytest
+
+from conftest import jpeg
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(UPLOAD_SESSION_CHUNK=4096, UPLOAD_SESSION_TTL=60)
+
+
+@pytest.fixture
+def client(app):
+    c = app.app.test_client()
+    c.tk = lambda: c.post("/upload_ticket").get_json()["ticket"]
+    return c
+
+
+def create(c, data, sha1=None):
+    r = c.post(f"/uploads?tk={c.tk()}", json={"size": len(data), "sha1": sha1})
+    assert r.status_code == 201
+    return r.get_json()["upload_id"]
+
+
+def put(c, sid, data, offset):
+    return c.put(f"/uploads/{sid}?offset={offset}&tk={c.tk()}", data=data)
+
+
+def test_every_step_needs_a_ticket(client):
+    sid = create(client, jpeg())
+    for r in (client.post("/uploads", json={"size": 10}), client.get(f"/uploads/{sid}"),
+              client.get(f"/uploads/{sid}?tk=falso"), client.put(f"/uploads/{sid}?offset=0", data=b"x"),
+              client.post(f"/uploads/{sid}/commit")):
+        assert r.status_code == 401 and r.get_json()["error"].startswith("invalid_ticket")
+    assert client.get(f"/uploads/{sid}?tk={client.tk()}").get_json()["offset"] == 0
+
+
+def test_resume_from_server_offset(client):
+    data = jpeg(size=(1200, 900))
+    sid = create(client, data, hashlib.sha1(data).hexdigest())
+    assert put(client, sid, data[:4096], 0).get_json()["offset"] == 4096
+    # el cliente perdió la respuesta y cree que va por el principio
+    r = put(client, sid, data[:4096], 0)
+    assert r.status_code == 409 and r.get_json() == {"status": "error", "error": "offset_mismatch", "offset": 4096}
+    assert client.get(f"/uploads/{sid}?tk={client.tk()}").get_json()["offset"] == 4096
+    off = 4096
+    while off < len(data):
+        off = put(client, sid, data[off:off + 4096], off).get_json()["offset"]
+    j = client.post(f"/uploads/{sid}/commit?tk={client.tk()}").get_json()
+    assert j["status"] == "ok"
+    assert j["codigo"] == hashlib.sha1(data).hexdigest()[:8]
+
+
+def test_commit_rejects_hash_mismatch(app, client):
+    data = jpeg()
+    sid = create(client, data, "0" * 40)
+    assert put(client, sid, data, 0).get_json()["offset"] == len(data)
+    r = client.post(f"/uploads/{sid}/commit?tk={client.tk()}")
+    assert r.status_code == 422 and r.get_json()["error"] == "hash_mismatch"
+    assert not list(app.SESSIONS.iterdir())   # la sesión se descarta: el cliente empieza de cero
+    assert not list(app.UPL.glob("*.jpg"))
+
+
+def test_commit_of_incomplete_upload(client):
+    data = jpeg(size=(1200, 900))
+    sid = create(client, data)
+    put(client, sid, data[:4096], 0)
+    r = client.post(f"/uploads/{sid}/commit?tk={client.tk()}")
+    assert r.status_code == 409 and r.get_json()["offset"] == 4096
+
+
+def test_gc_removes_abandoned_sessions(app, client):
+    data = jpeg(size=(1200, 900))
+    old, fresh = create(client, data), create(client, data)
+    put(client, old, data[:4096], 0)
+    meta = app.SESSIONS / f"{old}.json"
+    m = json.loads(meta.read_text()); m["updated"] = time.time() - 3600; meta.write_text(json.dumps(m))
+    assert app.gc_upload_sessions() == 1
+    assert not (app.SESSIONS / f"{old}.part").exists() and not meta.exists()
+    assert (app.SESSIONS / f"{fresh}.part").exists()
+    assert client.get(f"/uploads/{old}?tk={client.tk()}").status_code == 404
+
+
+def test_gc_removes_part_with_unreadable_meta(app, client):
+    sid = create(client, jpeg())
+    meta = app.SESSIONS / f"{sid}.json"
+    meta.write_text("{roto")
+    past = time.time() - 3600
+    os.utime(meta, (past, past))
+    assert app.gc_upload_sessions() == 1 and not (app.SESSIONS / f"{sid}.part").exists()